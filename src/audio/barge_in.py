@@ -0,0 +1,78 @@
+import os
+import time
+from collections import deque
+
+import numpy as np
+import sounddevice as sd
+from utils.log import get_logger
+
+logger = get_logger("barge_in")
+
+
+class BargeInDetector:
+    """播放回應期間持續收音，偵測使用者插話並立即停止播放。
+
+    以播放中麥克風收到的能量估計回音水準，只有明顯高於回音 (margin 倍)
+    且連續多個區塊都超過門檻時才判定為插話，避免機器人被自己的聲音打斷。
+    """
+
+    def __init__(self, recorder, speaker, margin=None, min_frames=None, frame_seconds=0.1,
+                 calibration_frames=3, min_level=None):
+        self.recorder = recorder
+        self.speaker = speaker
+        self.margin = float(margin or os.getenv('BARGE_IN_MARGIN', 2.5))
+        self.min_frames = int(min_frames or os.getenv('BARGE_IN_MIN_FRAMES', 3))
+        self.min_level = float(min_level or os.getenv('BARGE_IN_MIN_LEVEL', 500))
+        self.frame_seconds = frame_seconds
+        self.calibration_frames = calibration_frames
+        self.reaction_times = deque(maxlen=200)
+
+    def _read_level(self):
+        """讀取一個短區塊並回傳平均能量"""
+        block = sd.rec(int(self.recorder.sample_rate * self.frame_seconds),
+                       samplerate=self.recorder.sample_rate,
+                       channels=self.recorder.channels,
+                       dtype=np.int16)
+        sd.wait()
+        return float(np.mean(np.abs(block)))
+
+    def listen(self, playing_event, stop_event=None):
+        """播放期間監聽；偵測到插話時停止播放並回傳 True，播放自然結束時回傳 False"""
+        echo_levels = deque(maxlen=10)
+        consecutive, onset = 0, None
+
+        while playing_event.is_set() and (stop_event is None or not stop_event.is_set()):
+            block_start = time.perf_counter()
+            level = self._read_level()
+
+            # 播放剛開始的區塊只用來估計回音水準
+            if len(echo_levels) < self.calibration_frames:
+                echo_levels.append(level)
+                continue
+
+            threshold = max(self.min_level, float(np.median(echo_levels)) * self.margin)
+            if level <= threshold:
+                echo_levels.append(level)
+                consecutive, onset = 0, None
+                continue
+
+            consecutive += 1
+            onset = onset or block_start
+            if consecutive >= self.min_frames:
+                self.speaker.stop_playback()
+                reaction = time.perf_counter() - onset
+                self.reaction_times.append(reaction)
+                logger.info(f"偵測到插話，已停止播放 (反應時間 {reaction * 1000:.0f} ms)")
+                return True
+        return False
+
+    def stats(self):
+        """回傳插話反應時間統計 (毫秒)"""
+        if not self.reaction_times:
+            return {'count': 0}
+        ordered = sorted(self.reaction_times)
+
+        def pct(q):
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+        return {'count': len(ordered), 'p50_ms': pct(0.5), 'p95_ms': pct(0.95), 'max_ms': ordered[-1] * 1000}
@@ -0,0 +1,189 @@
+import os
+import sys
+import glob
+import time
+import wave
+import select
+import socket
+from datetime import datetime
+
+import numpy as np
+from utils.log import get_logger
+
+logger = get_logger("input")
+
+
+class _Pacer:
+    """依音訊時長控制產生速度：speed=1 為即時，speed=4 為四倍速，speed<=0 為不等待"""
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.start = time.monotonic()
+        self.audio_seconds = 0.0
+
+    def advance(self, seconds):
+        self.audio_seconds += seconds
+        if self.speed <= 0:
+            return
+        delay = self.start + self.audio_seconds / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _PollingReader:
+    """可中斷的位元流讀取：每隔 poll_seconds 檢查一次 stop_event，被設定時視為串流結束
+
+    阻塞的 read() / recv() 在執行緒中無法被取消，daemon 收到 SIGTERM 時會卡住無法結束。
+    直接讀取檔案描述子 / socket (不經緩衝)，避免資料留在緩衝區而 select 看不到。
+    """
+
+    def __init__(self, source, stop_event=None, poll_seconds=0.2):
+        self.source = source
+        self.stop_event = stop_event
+        self.poll_seconds = poll_seconds
+
+    def read(self, size):
+        while self.stop_event is None or not self.stop_event.is_set():
+            if isinstance(self.source, socket.socket):
+                try:
+                    return self.source.recv(size)
+                except socket.timeout:
+                    continue
+            ready, _, _ = select.select([self.source], [], [], self.poll_seconds)
+            if ready:
+                return os.read(self.source, size)
+        return b""
+
+
+class WavDirectorySource:
+    """依檔名順序重播資料夾中的 WAV 錄音"""
+
+    def __init__(self, directory, speed=1.0, pattern="*.wav"):
+        self.directory = directory
+        self.speed = speed
+        self.pattern = pattern
+
+    def __iter__(self):
+        pacer = _Pacer(self.speed)
+        for path in sorted(glob.glob(os.path.join(self.directory, self.pattern))):
+            with wave.open(path, "rb") as wf:
+                duration = wf.getnframes() / float(wf.getframerate())
+            # 模擬錄音所需的時間後才交出檔案
+            pacer.advance(duration)
+            yield path
+
+
+class PcmStreamSource:
+    """從原始 16-bit PCM 位元流切出語句：偵測到非靜音後擷取固定長度 (與麥克風錄音行為一致)"""
+
+    def __init__(self, stream, sample_rate=None, channels=None, record_seconds=None, speed=1.0,
+                 silence_threshold=500, frame_seconds=0.2, audio_dir=None):
+        self.stream = stream
+        self.sample_rate = int(sample_rate or os.getenv("SAMPLE_RATE", 16000))
+        self.channels = int(channels or os.getenv("CHANNELS", 1))
+        self.record_seconds = float(record_seconds or os.getenv("RECORD_SECONDS", 3))
+        self.speed = speed
+        self.silence_threshold = silence_threshold
+        self.frame_seconds = frame_seconds
+        self.audio_dir = audio_dir or os.path.join(os.path.dirname(__file__), "../../data/audio")
+        os.makedirs(self.audio_dir, exist_ok=True)
+        self._count = 0
+
+    def _read_frame(self, frame_bytes):
+        """讀取一個完整的區塊；串流結束時回傳 None"""
+        data = b""
+        while len(data) < frame_bytes:
+            chunk = self.stream.read(frame_bytes - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _write_wav(self, pcm):
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        wav_path = os.path.join(self.audio_dir, f"replay_{timestamp}_{self._count:05d}.wav")
+        self._count += 1
+        with wave.open(wav_path, "wb") as wf:
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(2)  # int16 -> 2 bytes
+            wf.setframerate(self.sample_rate)
+            wf.writeframes(pcm)
+        return wav_path
+
+    def __iter__(self):
+        pacer = _Pacer(self.speed)
+        frame_bytes = int(self.sample_rate * self.frame_seconds) * self.channels * 2
+        utterance_frames = max(1, int(round(self.record_seconds / self.frame_seconds)))
+
+        while True:
+            frame = self._read_frame(frame_bytes)
+            if frame is None:
+                return
+            pacer.advance(self.frame_seconds)
+            if np.mean(np.abs(np.frombuffer(frame, dtype=np.int16))) < self.silence_threshold:
+                continue
+
+            # 偵測到語音：連同觸發的區塊擷取 record_seconds 長度
+            frames = [frame]
+            while len(frames) < utterance_frames:
+                frame = self._read_frame(frame_bytes)
+                if frame is None:
+                    break
+                pacer.advance(self.frame_seconds)
+                frames.append(frame)
+            yield self._write_wav(b"".join(frames))
+            if frame is None:
+                return
+
+
+class SocketSource:
+    """TCP 伺服器：依序接受連線，將每條連線的原始 PCM 位元流切成語句
+
+    等待連線與接收資料時每隔 poll_seconds 檢查 stop_event，被設定時關閉連線與監聽 socket 並結束。
+    """
+
+    def __init__(self, host="0.0.0.0", port=9300, speed=0, stop_event=None, poll_seconds=0.2, **pcm_options):
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.stop_event = stop_event
+        self.poll_seconds = poll_seconds
+        self.pcm_options = pcm_options
+
+    def _stopped(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def __iter__(self):
+        with socket.create_server((self.host, self.port)) as server:
+            server.settimeout(self.poll_seconds)
+            logger.info(f"等待 PCM 串流連線於 {self.host}:{self.port}")
+            while not self._stopped():
+                try:
+                    conn, address = server.accept()
+                except socket.timeout:
+                    continue
+                logger.info(f"接收來自 {address[0]}:{address[1]} 的音訊串流")
+                with conn:
+                    conn.settimeout(self.poll_seconds)
+                    stream = _PollingReader(conn, self.stop_event, self.poll_seconds)
+                    yield from PcmStreamSource(stream, speed=self.speed, **self.pcm_options)
+
+
+def open_source(spec, speed=1.0, stop_event=None):
+    """依規格字串建立輸入來源：dir:PATH、stdin、tcp:HOST:PORT
+
+    Args:
+        stop_event: 被設定時 (threading.Event) 串流來源停止等待資料並結束，讓管線可以平順停止
+    """
+    if spec.startswith("dir:"):
+        return WavDirectorySource(spec[4:], speed=speed)
+    if spec == "stdin":
+        stream = sys.stdin.buffer
+        if os.name != "nt":
+            # Windows 的 select 不支援管線，只能阻塞讀取
+            stream = _PollingReader(sys.stdin.fileno(), stop_event)
+        return PcmStreamSource(stream, speed=speed)
+    if spec.startswith("tcp:"):
+        host, _, port = spec[4:].rpartition(":")
+        return SocketSource(host or "0.0.0.0", int(port), speed=speed, stop_event=stop_event)
+    raise ValueError(f"不支援的輸入來源: {spec}")
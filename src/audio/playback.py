@@ -0,0 +1,240 @@
+import io
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+def completed(result):
+    """回傳已完成的播放 Future (例如沒有可播放的音訊或播放前已被中斷)"""
+    future = Future()
+    future.set_running_or_notify_cancel()
+    future.set_result(result)
+    return future
+
+
+def _pending_future():
+    # 標記為執行中：播放一旦排入就不能由 Future.cancel() 取消，要中斷請呼叫 stop()
+    future = Future()
+    future.set_running_or_notify_cancel()
+    return future
+
+
+class PCMPlayer:
+    """以 sounddevice 的 RawOutputStream (callback 模式) 直接播放 16-bit PCM，不經過檔案或解碼。
+
+    play() 將資料排入緩衝區後立即回傳 Future，由音訊裝置的 callback 取用資料並在播完時完成，
+    呼叫端不必輪詢或等待，可以一邊播放一邊處理其他工作；連續排入的多段之間不會有空隙。
+    Future 的結果為是否完整播放 (被 stop() 中斷時為 False)，可用 result()、add_done_callback()
+    或 asyncio.wrap_future() 等待。
+    """
+
+    def __init__(self, sample_rate=16000, channels=1, device=None):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        device = device if device is not None else os.getenv('OUTPUT_DEVICE') or None
+        # 環境變數可給裝置名稱或編號
+        self.device = int(device) if isinstance(device, str) and device.isdigit() else device
+        self.frame_bytes = 2 * channels
+        self._stream = None
+        self._callback_stop = None
+        # 串流的開啟、重新開始與中止 (callback 不會取用，避免與 PortAudio 互相等待)
+        self._stream_lock = threading.Lock()
+        # 緩衝區狀態 (callback 會短暫取用)
+        self._lock = threading.Lock()
+        self._pending = bytearray()  # 已排入、尚未交給音訊裝置的 PCM
+        self._queued = 0    # 累計排入的位元組數
+        self._consumed = 0  # 累計交給音訊裝置的位元組數
+        self._marks = deque()  # (該段結束位置, Future)，依排入順序
+        self._feeding = 0   # 仍在逐塊排入資料的 play() 數量
+        self._running = False
+        self._generation = 0  # 每次 stop() 加一，進行中的 play() 據此停止排入
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _start_stream(self):
+        with self._stream_lock:
+            if self._stream is None:
+                import sounddevice as sd
+                self._stream = sd.RawOutputStream(samplerate=self.sample_rate, channels=self.channels,
+                                                  dtype='int16', device=self.device,
+                                                  callback=self._callback,
+                                                  finished_callback=self._finished)
+                self._callback_stop = sd.CallbackStop
+            if not self._stream.stopped:
+                # 上次由 callback 自行結束的串流須先停止才能重新開始 (會等最後的資料播完)
+                self._stream.stop()
+            self._stream.start()
+
+    def _enqueue(self, data, generation):
+        """排入一塊 PCM；串流未在播放時開始播放。已被 stop() 中斷時回傳 False"""
+        with self._lock:
+            if generation != self._generation:
+                return False
+            self._pending += data
+            self._queued += len(data)
+            start = not self._running
+            self._running = True
+        if start:
+            self._start_stream()
+        return True
+
+    def _callback(self, outdata, frames, time_info, status):
+        """音訊裝置需要資料時呼叫：取出緩衝區的資料，不足的部分補靜音"""
+        size = len(outdata)
+        done = []
+        with self._lock:
+            data = bytes(self._pending[:size])
+            del self._pending[:size]
+            self._consumed += len(data)
+            more = bool(self._pending) or self._feeding > 0
+            # 後面還有資料時，前面的段落在最後一塊交給音訊裝置時完成；
+            # 最後一段則等串流播完 (見 _finished)
+            while more and self._marks and self._marks[0][0] <= self._consumed:
+                done.append(self._marks.popleft()[1])
+            if not more:
+                self._running = False
+        outdata[:len(data)] = data
+        if len(data) < size:
+            outdata[len(data):] = b"\x00" * (size - len(data))
+        for future in done:
+            future.set_result(True)
+        if not more:
+            raise self._callback_stop
+
+    def _finished(self):
+        """串流播完最後的資料 (或被中止) 後呼叫：完成已播完的段落"""
+        done = []
+        with self._lock:
+            while self._marks and self._marks[0][0] <= self._consumed:
+                done.append(self._marks.popleft()[1])
+        for future in done:
+            future.set_result(True)
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    def play(self, chunks):
+        """排入 PCM (bytes 或可迭代的 bytes 區塊) 並回傳播放的 Future
+
+        逐塊產生的資料 (例如邊下載邊合成) 在呼叫的執行緒中一塊一塊排入，第一塊到達就開始播放；
+        資料全部排入後即返回，不等待播放結束。
+        """
+        if isinstance(chunks, (bytes, bytearray)):
+            chunks = [bytes(chunks)]
+        future = _pending_future()
+        with self._lock:
+            generation = self._generation
+            self._feeding += 1
+        remainder = b""
+        try:
+            for chunk in chunks:
+                data = remainder + chunk
+                usable = len(data) - len(data) % self.frame_bytes
+                data, remainder = data[:usable], data[usable:]
+                if data and not self._enqueue(data, generation):
+                    break
+        finally:
+            with self._lock:
+                self._feeding -= 1
+                if generation != self._generation:
+                    result = False
+                elif self._running:
+                    self._marks.append((self._queued, future))
+                    result = None
+                else:
+                    result = True  # 沒有資料，或資料已全部播完
+        if result is not None:
+            future.set_result(result)
+        return future
+
+    def stop(self):
+        """立即停止並丟棄尚未播放的音訊，進行中的 Future 以 False 完成 (可從其他執行緒呼叫)"""
+        with self._lock:
+            self._generation += 1
+            self._queued -= len(self._pending)
+            self._pending.clear()
+            self._running = False
+            interrupted = [future for _, future in self._marks]
+            self._marks.clear()
+        with self._stream_lock:
+            if self._stream is not None and not self._stream.stopped:
+                self._stream.abort()
+        for future in interrupted:
+            future.set_result(False)
+
+    def close(self):
+        self.stop()
+        with self._stream_lock:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
+
+
+class PygamePlayer:
+    """以 pygame 播放 MP3 位元組或音訊檔，介面與 PCMPlayer 相同。
+
+    各段依序播放；每段開始時依其長度排定計時器，到時完成該段的 Future 並接著播放下一段，
+    不輪詢 pygame 的播放狀態。
+    """
+
+    def __init__(self):
+        self._pygame = None
+        self._lock = threading.Lock()
+        self._queue = deque()  # (Sound, Future)，等待播放
+        self._current = None   # (計時器, Future)，播放中
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _mixer(self):
+        """第一次播放時才匯入 pygame 並初始化音訊裝置"""
+        if self._pygame is None:
+            import pygame
+            pygame.mixer.init()
+            self._pygame = pygame
+        return self._pygame
+
+    def _start_next(self):
+        """播放佇列中的下一段 (須持有 _lock)"""
+        if not self._queue:
+            self._current = None
+            return
+        sound, future = self._queue.popleft()
+        sound.play()
+        timer = threading.Timer(sound.get_length(), self._on_end, args=(future,))
+        timer.daemon = True
+        self._current = (timer, future)
+        timer.start()
+
+    def _on_end(self, future):
+        with self._lock:
+            if self._current is None or self._current[1] is not future:
+                return  # 已被 stop() 中斷
+            self._start_next()
+        future.set_result(True)
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    def play(self, audio):
+        """排入音訊 (位元組或檔案路徑) 並回傳播放的 Future；前一段還在播放時接在其後"""
+        pygame = self._mixer()
+        sound = pygame.mixer.Sound(io.BytesIO(audio) if isinstance(audio, (bytes, bytearray)) else audio)
+        future = _pending_future()
+        with self._lock:
+            self._queue.append((sound, future))
+            if self._current is None:
+                self._start_next()
+        return future
+
+    def stop(self):
+        """立即停止並丟棄尚未播放的音訊 (可從其他執行緒呼叫)"""
+        with self._lock:
+            current, queued = self._current, [future for _, future in self._queue]
+            self._current = None
+            self._queue.clear()
+        if current is not None:
+            current[0].cancel()
+            queued.insert(0, current[1])
+        if self._pygame is not None:
+            self._pygame.mixer.stop()
+        for future in queued:
+            future.set_result(False)
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
@@ -1,19 +1,25 @@
 import os
+import sys
 import wave
+import logging
 import uuid
+import threading
 from datetime import datetime
 
 import numpy as np
 import sounddevice as sd
 from dotenv import load_dotenv
-from resemblyzer import VoiceEncoder, preprocess_wav
 import soundfile as sf
 import json
-from sklearn.metrics.pairwise import cosine_similarity
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.tracing import traced
+from utils.log import get_logger
 
 # 加載環境變數
 load_dotenv(os.path.join(os.path.dirname(__file__), '../config/.env'))
 
+logger = get_logger("recorder")
+
 
 class AudioRecorder:
     """使用 Resemblyzer 進行聲紋提取與語者識別的錄音器。"""
@@ -33,7 +39,11 @@ class AudioRecorder:
 
         # ─── 語者識別參數 ───────────────────────────────────────────────────────
         self.similarity_threshold: float = float(os.getenv("SIM_THRESHOLD", 0.75))  # 提高閾值
-        self.encoder = VoiceEncoder()  # Resemblyzer 語者嵌入模型
+        # Resemblyzer 語者嵌入模型：匯入 torch 並載入權重需數秒，第一次提取聲紋時才載入 (見 encoder)
+        self._encoder = None
+        self._encoder_lock = threading.Lock()
+        # 語者資料庫的鎖：CommandClassifier 與語音服務共用同一個資料庫物件時也共用此鎖 (見 VoiceAssistant)
+        self.db_lock = threading.RLock()
 
         # 確保資料夾存在
         os.makedirs(self.audio_dir, exist_ok=True)
@@ -66,7 +76,7 @@ class AudioRecorder:
         reset_db = False
         if reset_db and os.path.exists(self.speaker_data_file):
             os.remove(self.speaker_data_file)
-            print("[Info] 已重置語者資料庫")
+            logger.info("已重置語者資料庫")
             self.speaker_db = {"speakers": {}}
         
         # 清理資料庫（可選）
@@ -80,35 +90,41 @@ class AudioRecorder:
                 with open(self.speaker_data_file, "r", encoding='utf-8') as f:
                     return json.load(f)
             except Exception as e:
-                print(f"[Warning] 載入語者資料庫失敗: {e}，將重新建立。")
+                logger.warning(f"載入語者資料庫失敗: {e}，將重新建立。")
         return {"speakers": {}}
 
+    @traced('save_speaker_db')
     def _save_speaker_db(self):
-        """將語者資料庫儲存到磁碟"""
-        speakers_copy = {"speakers": {}}
-        for spk_id, data in self.speaker_db["speakers"].items():
-            speakers_copy["speakers"][spk_id] = {
-                "created_at": data.get("created_at", datetime.now().isoformat()),
-                "conversations": data.get("conversations", [])
-            }
-            
-            if "embeddings" in data:
-                embeddings_list = []
-                for emb in data["embeddings"]:
-                    if hasattr(emb, 'tolist'):  # 如果是numpy陣列
-                        embeddings_list.append(emb.tolist())
-                    else:  # 已經是列表
-                        embeddings_list.append(emb)
-                speakers_copy["speakers"][spk_id]["embeddings"] = embeddings_list
-                
-        with open(self.speaker_data_file, "w", encoding='utf-8') as f:
-            json.dump(speakers_copy, f, ensure_ascii=False, indent=2)
-        print(f"[Info] 語者資料庫已更新，目前共有 {len(self.speaker_db['speakers'])} 位說話者。")
+        """將語者資料庫儲存到磁碟 (暫存檔 + 取代，避免寫到一半的檔案)"""
+        with self.db_lock:
+            speakers_copy = {"speakers": {}}
+            for spk_id, data in self.speaker_db["speakers"].items():
+                speakers_copy["speakers"][spk_id] = {
+                    "created_at": data.get("created_at", datetime.now().isoformat()),
+                    "conversations": data.get("conversations", [])
+                }
+
+                if "embeddings" in data:
+                    embeddings_list = []
+                    for emb in data["embeddings"]:
+                        if hasattr(emb, 'tolist'):  # 如果是numpy陣列
+                            embeddings_list.append(emb.tolist())
+                        else:  # 已經是列表
+                            embeddings_list.append(emb)
+                    speakers_copy["speakers"][spk_id]["embeddings"] = embeddings_list
+
+            tmp_path = self.speaker_data_file + '.tmp'
+            with open(tmp_path, "w", encoding='utf-8') as f:
+                json.dump(speakers_copy, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.speaker_data_file)
+            logger.debug(f"語者資料庫已更新，目前共有 {len(self.speaker_db['speakers'])} 位說話者。")
         
     def clean_speaker_database(self):
         """清理語者資料庫，移除不一致的嵌入"""
-        print("[Info] 開始清理語者資料庫...")
-        for speaker_id, data in list(self.speaker_db['speakers'].items()):
+        logger.info("開始清理語者資料庫...")
+        with self.db_lock:
+            speakers = list(self.speaker_db['speakers'].items())
+        for speaker_id, data in speakers:
             # 確保所有嵌入向量都是numpy陣列
             embeddings = []
             for emb in data["embeddings"]:
@@ -129,7 +145,7 @@ class AudioRecorder:
                 
                 for j, embed2 in enumerate(embeddings):
                     if i != j:
-                        similarity = cosine_similarity([embed1], [embed2])[0][0]
+                        similarity = self._cosine_similarity(embed1, embed2)
                         avg_similarity += similarity
                         count += 1
                 
@@ -145,40 +161,70 @@ class AudioRecorder:
                 to_keep = [embeddings[0]]
                     
             # 更新該說話者的嵌入向量
-            self.speaker_db['speakers'][speaker_id]['embeddings'] = [embed.tolist() for embed in to_keep]
-            print(f"[Info] 已清理說話者 {speaker_id} 的嵌入，保留 {len(to_keep)}/{len(embeddings)} 個特徵")
+            with self.db_lock:
+                self.speaker_db['speakers'][speaker_id]['embeddings'] = [embed.tolist() for embed in to_keep]
+            logger.info(f"已清理說話者 {speaker_id} 的嵌入，保留 {len(to_keep)}/{len(embeddings)} 個特徵")
             
         self._save_speaker_db()
-        print("[Info] 語者資料庫清理完成")
+        logger.info("語者資料庫清理完成")
 
     # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
 
     # ╭─────────────────────────────── Public API ───────────────────────────╮
-    def wait_for_speech(self) -> bool:
-        """持續監聽麥克風，直到偵測到非靜音訊號才返回 True"""
-        print("等待語音輸入…")
-        while True:
+    @property
+    def encoder(self):
+        """Resemblyzer 語者嵌入模型，第一次使用時才載入 (多執行緒同時使用也只載入一次)"""
+        if self._encoder is None:
+            with self._encoder_lock:
+                if self._encoder is None:
+                    from resemblyzer import VoiceEncoder
+                    self._encoder = VoiceEncoder()
+        return self._encoder
+
+    @traced()
+    def wait_for_speech(self, stop_event=None, paused=None) -> bool:
+        """持續監聽麥克風，直到偵測到非靜音訊號才返回 True；stop_event 被設定時返回 False
+
+        Args:
+            paused: 被設定時 (例如開始播放回應) 也立即返回 False，避免把播放的聲音當成語音
+        """
+        logger.info("等待語音輸入…")
+        while stop_event is None or not stop_event.is_set():
+            if paused is not None and paused.is_set():
+                return False
             audio_data = sd.rec(int(self.sample_rate * 0.2),  # 每 0.2 秒檢測一次
                                 samplerate=self.sample_rate,
                                 channels=self.channels,
                                 dtype=np.int16)
             sd.wait()
+            if paused is not None and paused.is_set():
+                return False  # 這個區塊可能錄到剛開始播放的回應
             if not self._is_silent(audio_data):
-                print("偵測到語音！")
+                logger.info("偵測到語音！")
                 return True
+        return False
 
     def record(self):
         """錄製固定長度語音 → 存 wav → 語者識別 → 回傳 (檔名, speaker_id, 相似度)"""
+        wav_path = self.capture()
+
+        # 執行語者識別
+        speaker_id, similarity = self.identify_speaker(wav_path)
+        return wav_path, speaker_id, similarity
+
+    @traced('record')
+    def capture(self):
+        """只錄製固定長度語音並存成 wav，回傳檔名 (語者識別由呼叫端另外進行)"""
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         wav_path = os.path.join(self.audio_dir, f"recording_{timestamp}.wav")
 
-        print("開始錄音…")
+        logger.info("開始錄音…")
         recording = sd.rec(int(self.sample_rate * self.record_seconds),
                            samplerate=self.sample_rate,
                            channels=self.channels,
                            dtype=np.int16)
         sd.wait()
-        print("錄音完成！")
+        logger.debug("錄音完成！")
 
         # 儲存 wav
         with wave.open(wav_path, "wb") as wf:
@@ -186,102 +232,114 @@ class AudioRecorder:
             wf.setsampwidth(2)  # int16 -> 2 bytes
             wf.setframerate(self.sample_rate)
             wf.writeframes(recording.tobytes())
-        print(f"音訊已保存至: {wav_path}")
-
-        # 執行語者識別
-        speaker_id, similarity = self.identify_speaker(wav_path)
-        return wav_path, speaker_id, similarity
+        logger.debug(f"音訊已保存至: {wav_path}")
+        return wav_path
 
     # ╰─────────────────────────────── Public API ───────────────────────────╯
 
     # ╭─────────────────────────────── Helper Functions ─────────────────────╮
+    @staticmethod
+    def _cosine_similarity(a, b) -> float:
+        """兩個向量的餘弦相似度 (取代 sklearn，省下其匯入時間)"""
+        a = np.asarray(a, dtype=np.float64)
+        b = np.asarray(b, dtype=np.float64)
+        denom = np.linalg.norm(a) * np.linalg.norm(b)
+        return float(np.dot(a, b) / denom) if denom else 0.0
+
     def _is_silent(self, audio_data, silence_threshold: int = 500) -> bool:
         """檢測短音訊是否安靜 (極簡能量法)"""
         return np.mean(np.abs(audio_data)) < silence_threshold
 
+    @traced('extract_embedding')
     def _extract_embedding(self, audio_file: str):
         """利用 Resemblyzer 取得 256‑D 語者嵌入"""
         try:
+            from resemblyzer import preprocess_wav
             wav, sr = sf.read(audio_file)
             wav = preprocess_wav(wav, source_sr=sr)
             embed = self.encoder.embed_utterance(wav)  # ndarray (256,)
             return embed
         except Exception as e:
-            print(f"[Error] 提取嵌入時發生錯誤: {e}")
+            logger.error(f"提取嵌入時發生錯誤: {e}")
             return None
 
+    @traced()
     def identify_speaker(self, audio_file: str):
         """比對資料庫決定語者 ID；若為新語者則註冊，並列印候選相似度"""
         embed = self._extract_embedding(audio_file)
-        # 0) 嵌入失敗 → 回傳 unknown + 0.0
-        if embed is None:
-            unknown_id = f"unknown_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-            return unknown_id, 0.0
-            
-        # 1) 首次運行 → 直接建立新用戶
-        if not self.speaker_db["speakers"]:
-            print("[Info] 數據庫為空，這是第一次運行，直接創建新用戶")
-            first_id = f"speaker_{str(uuid.uuid4())[:8]}"
-            self.speaker_db["speakers"][first_id] = {
-                "embeddings": [embed.tolist()],  # 將numpy數組轉換為列表以便JSON序列化
-                "created_at": datetime.now().isoformat(),
-                "conversations": []
-            }
-            print(f"🆕 創建首位說話者 → {first_id}")
-            self._save_speaker_db()
-            return first_id, 1.0  # 返回1.0的相似度，確保不會觸發再次確認
+        return self.identify_embedding(embed)
 
+    def match_embedding(self, embed):
+        """只比對不修改資料庫，回傳 (最相似的語者 ID, 相似度, 所有候選相似度)"""
         best_id, best_sim = None, 0.0
         similarities = []
+        with self.db_lock:
+            speakers = [(spk_id, list(data.get("embeddings") or [])) for spk_id, data in self.speaker_db["speakers"].items()]
+
+        for spk_id, stored in speakers:
+            if not stored:
+                continue  # 沒有embeddings無法計算相似度
 
-        for spk_id, data in self.speaker_db["speakers"].items():
-            # 檢查是否存在embeddings字段
-            if "embeddings" not in data or not data["embeddings"]:
-                # 如果沒有embeddings，為這個用戶創建一個空的embeddings列表
-                self.speaker_db["speakers"][spk_id]["embeddings"] = []
-                continue  # 跳過這個用戶，因為沒有embeddings無法計算相似度
-                
             # 將JSON中的列表轉換回numpy陣列
-            embeddings = []
-            for emb in data["embeddings"]:
-                if isinstance(emb, list):
-                    embeddings.append(np.array(emb))
-                else:
-                    embeddings.append(emb)
-                    
-            if not embeddings:
-                continue
-                
+            embeddings = [np.array(emb) if isinstance(emb, list) else emb for emb in stored]
             avg_vec = np.mean(np.vstack(embeddings), axis=0)
-            sim = cosine_similarity([embed], [avg_vec])[0][0]
+            sim = self._cosine_similarity(embed, avg_vec)
             similarities.append((spk_id, sim))
             if sim > best_sim:
                 best_sim, best_id = sim, spk_id
+        return best_id, best_sim, similarities
 
-        # 列印所有候選相似度
-        print("\n🧠 辨識候選相似度列表：")
-        for spk_id, sim in sorted(similarities, key=lambda x: x[1], reverse=True):
-            print(f" - 語者 {spk_id}: 相似度 {sim:.4f}")
-        print("")
-
-        # 2) 已知語者
-        if best_sim >= self.similarity_threshold and best_id is not None:
-            print(f"✅ 識別到已知說話者: {best_id} (相似度 {best_sim:.4f})")
-            # 將新的嵌入添加到數據庫，確保添加為列表格式
-            self.speaker_db["speakers"][best_id]["embeddings"].append(embed.tolist())
-            self._save_speaker_db()
-            return best_id, best_sim
+    def identify_embedding(self, embed):
+        """以已提取的嵌入決定語者 ID；若為新語者則註冊 (比對與註冊在 db_lock 內完成)"""
+        with self.db_lock:
+            # 0) 嵌入失敗 → 回傳 unknown + 0.0
+            if embed is None:
+                unknown_id = f"unknown_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+                return unknown_id, 0.0
+            
+            # 1) 首次運行 → 直接建立新用戶
+            if not self.speaker_db["speakers"]:
+                logger.info("數據庫為空，這是第一次運行，直接創建新用戶")
+                first_id = f"speaker_{str(uuid.uuid4())[:8]}"
+                self.speaker_db["speakers"][first_id] = {
+                    "embeddings": [embed.tolist()],  # 將numpy數組轉換為列表以便JSON序列化
+                    "created_at": datetime.now().isoformat(),
+                    "conversations": []
+                }
+                logger.info(f"🆕 創建首位說話者 → {first_id}")
+                self._save_speaker_db()
+                return first_id, 1.0  # 返回1.0的相似度，確保不會觸發再次確認
 
-        # 3) 新語者 → 回傳 new_id + 0.0
-        new_id = f"speaker_{str(uuid.uuid4())[:8]}"
-        self.speaker_db["speakers"][new_id] = {
-            "embeddings": [embed.tolist()],  # 確保存儲為列表，而不是numpy數組
-            "created_at": datetime.now().isoformat(),
-            "conversations": []  # 確保添加conversations字段
-        }
-        print(f"🆕 註冊新說話者 → {new_id}")
-        self._save_speaker_db()
-        return new_id, 0.0
+            for spk_id, data in self.speaker_db["speakers"].items():
+                # 如果沒有embeddings，為這個用戶創建一個空的embeddings列表
+                if "embeddings" not in data:
+                    data["embeddings"] = []
+            best_id, best_sim, similarities = self.match_embedding(embed)
+
+            # 候選相似度只在 DEBUG 等級記錄
+            if logger.isEnabledFor(logging.DEBUG):
+                candidates = ", ".join(f"{spk_id}: {sim:.4f}"
+                                       for spk_id, sim in sorted(similarities, key=lambda x: x[1], reverse=True))
+                logger.debug(f"🧠 辨識候選相似度: {candidates}")
+
+            # 2) 已知語者
+            if best_sim >= self.similarity_threshold and best_id is not None:
+                logger.info(f"✅ 識別到已知說話者: {best_id} (相似度 {best_sim:.4f})")
+                # 將新的嵌入添加到數據庫，確保添加為列表格式
+                self.speaker_db["speakers"][best_id]["embeddings"].append(embed.tolist())
+                self._save_speaker_db()
+                return best_id, best_sim
+
+            # 3) 新語者 → 回傳 new_id + 0.0
+            new_id = f"speaker_{str(uuid.uuid4())[:8]}"
+            self.speaker_db["speakers"][new_id] = {
+                "embeddings": [embed.tolist()],  # 確保存儲為列表，而不是numpy數組
+                "created_at": datetime.now().isoformat(),
+                "conversations": []  # 確保添加conversations字段
+            }
+            logger.info(f"🆕 註冊新說話者 → {new_id}")
+            self._save_speaker_db()
+            return new_id, 0.0
 
 
         
@@ -294,14 +352,15 @@ class AudioRecorder:
             return unknown_id
         
         new_id = f"speaker_{str(uuid.uuid4())[:8]}"
-        self.speaker_db["speakers"][new_id] = {
-            "embeddings": [embed.tolist()],  # 轉換為列表以便JSON序列化
-            "created_at": datetime.now().isoformat(),
-            "conversations": []
-        }
+        with self.db_lock:
+            self.speaker_db["speakers"][new_id] = {
+                "embeddings": [embed.tolist()],  # 轉換為列表以便JSON序列化
+                "created_at": datetime.now().isoformat(),
+                "conversations": []
+            }
+            self._save_speaker_db()
         
-        print(f"[Info] 已創建新說話者，ID: {new_id}")
-        self._save_speaker_db()
+        logger.info(f"已創建新說話者，ID: {new_id}")
         
         return new_id
     # ╰─────────────────────────────── Helper Functions ─────────────────────╯ 
\ No newline at end of file
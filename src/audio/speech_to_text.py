@@ -5,14 +5,9 @@ from dotenv import load_dotenv
 import base64
 from datetime import datetime
 import sys
-import boto3
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 from src.utils.command_classifier import CommandClassifier
-
-endpoint_name = "whisper-base-145428-Endpoint-20250421-150459"
-region = "us-east-1"
-
-runtime = boto3.client("sagemaker-runtime", region_name=region)
+from src.audio.stt_upload import UploadPreparer
 
 
 # 加载环境变量
@@ -25,6 +20,8 @@ class SpeechToText:
         self.sample_rate = int(os.getenv('SAMPLE_RATE', 16000))
         self.transcript_dir = os.path.join(os.path.dirname(__file__), '../../data/transcripts')
         self.classifier = CommandClassifier()
+        # 上傳前切除前後靜音並壓縮；base64 會再放大 33%，壓縮後的節省更明顯
+        self.upload = UploadPreparer()
         
         # 确保目录存在
         os.makedirs(self.transcript_dir, exist_ok=True)
@@ -57,12 +54,18 @@ class SpeechToText:
         """将音频文件转换为文字并分类"""
         print("开始转换语音为文字...")
 
-        # 读取音频文件
-        with open(audio_file_path, "rb") as audio_file:
-            content = base64.b64encode(audio_file.read()).decode('utf-8')
+        # 读取音频文件，切除靜音並壓縮 (Google 接受 LINEAR16、FLAC 與 OGG_OPUS)
+        prepared = self.upload.prepare(audio_file_path, accepted=('wav', 'flac', 'opus'))
+        if prepared.is_silent:
+            print("錄音中沒有語音，略過轉換")
+            return []
+        self.upload.record_upload(prepared)
+        content = base64.b64encode(prepared.data).decode('utf-8')
 
         # 准备API请求
-        url = f"https://speech.googleapis.com/v1/speech:recognize?key={self.api_key}"
+        # GOOGLE_STT_ENDPOINT_URL 可導向本地假後端
+        base_url = os.getenv('GOOGLE_STT_ENDPOINT_URL', 'https://speech.googleapis.com')
+        url = f"{base_url}/v1/speech:recognize?key={self.api_key}"
         
         headers = {
             'Content-Type': 'application/json'
@@ -70,8 +73,8 @@ class SpeechToText:
         
         data = {
             'config': {
-                'encoding': 'LINEAR16',
-                'sampleRateHertz': self.sample_rate,
+                'encoding': prepared.google_encoding,
+                'sampleRateHertz': prepared.sample_rate,
                 'languageCode': self.language_code,
                 'enableAutomaticPunctuation': True
             },
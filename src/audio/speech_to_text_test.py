@@ -1,26 +1,36 @@
 import os
 import json
 import sys
-import boto3
+import uuid
 from dotenv import load_dotenv
 from datetime import datetime
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from audio.stt_upload import UploadPreparer
+from audio.stt_backends import STTRouter, create_backends
+from audio.transcript_cache import TranscriptCache
+from utils.tracing import traced
+from utils.log import get_logger
 
 # 加载环境变量
 load_dotenv(os.path.join(os.path.dirname(__file__), '../config/.env'))
 
+logger = get_logger("stt")
+
 class SpeechToText:
     def __init__(self):
-        # Whisper 模型配置
-        self.endpoint_name = os.getenv('SAGEMAKER_ENDPOINT_NAME', 'jumpstart-dft-hf-asr-whisper-large-20250426-025518')
-        self.region = os.getenv('AWS_REGION', 'us-west-2')
+        # 語音轉文字後端 (STT_BACKENDS：sagemaker、google、local，預設 sagemaker)
+        # 依 STT_POLICY 逐一嘗試 (fallback) 或同時送出取最先可接受的結果 (race)
+        # 上傳前切除前後靜音並壓縮 (STT_UPLOAD_FORMAT，預設 flac)；上傳量依實際送出的後端請求計入
+        self.upload = UploadPreparer()
         
-        # 創建 SageMaker 客戶端
-        self.runtime = boto3.client(
-            "sagemaker-runtime", 
-            region_name=self.region,
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-        )
+        self.backends = create_backends()
+        self.router = STTRouter(self.backends, upload=self.upload)
+        
+        # SageMaker Whisper 端點的客戶端 (未啟用時為 None)
+        self.stt_client = next((backend.client for backend in self.backends if backend.name == 'sagemaker'), None)
+        
+        # 相同錄音 (修剪後的 PCM) 與相同後端版本的結果直接取自快取，不經網路
+        self.transcript_cache = TranscriptCache() if os.getenv('STT_CACHE', '1') == '1' else None
         
         # 設置轉錄存儲目錄
         self.transcript_dir = os.path.join(os.path.dirname(__file__), '../../data/transcripts')
@@ -28,14 +38,15 @@ class SpeechToText:
         # 确保目录存在
         os.makedirs(self.transcript_dir, exist_ok=True)
 
-    def save_transcript(self, transcript_text, audio_file_path, confidence=0.9):
+    def save_transcript(self, transcript_text, audio_file_path, confidence=0.9, backend=None):
         """保存转写结果"""
         # 生成转写文件名（基于音频文件名）
         audio_filename = os.path.basename(audio_file_path)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # 同一秒內並行轉換的多段語音 (多個轉錄工作者) 不會互相覆蓋
         transcript_filename = os.path.join(
             self.transcript_dir,
-            f"transcript_{timestamp}.json"
+            f"transcript_{timestamp}_{uuid.uuid4().hex[:8]}.json"
         )
         
         # 准备保存的数据
@@ -43,55 +54,62 @@ class SpeechToText:
             'audio_file': audio_filename,
             'timestamp': timestamp,
             'transcript': transcript_text,
-            'confidence': confidence
+            'confidence': confidence,
+            'backend': backend
         }
         
         # 保存为JSON文件
         with open(transcript_filename, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
             
-        print(f"转写文本已保存至: {transcript_filename}")
+        logger.debug(f"转写文本已保存至: {transcript_filename}")
         return transcript_filename
 
-    def transcribe_file(self, audio_file_path):
-        """将音频文件转换为文字"""
-        print("开始转换语音为文字...")
+    @traced()
+    def transcribe_file(self, audio_file_path, save=True):
+        """将音频文件转换为文字
+
+        Args:
+            save: 是否另存轉錄 JSON (批次重新處理時結果寫在 manifest，不需要)
+        """
+        logger.debug("开始转换语音为文字...")
 
         try:
-            # 读取音频文件内容（不需要Base64编码）
-            with open(audio_file_path, "rb") as audio_file:
-                audio_bytes = audio_file.read()
-            
-            # 调用SageMaker端点进行语音识别
-            response = self.runtime.invoke_endpoint(
-                EndpointName=self.endpoint_name,
-                ContentType="audio/wav",  # 直接使用wav格式
-                Body=audio_bytes
-            )
-            
-            # 解析响应
-            response_body = response["Body"].read().decode("utf-8")
-            result = json.loads(response_body)
-            
-            # 从结果中提取文本
-            transcript_text = ""
-            confidence = 0.9  # 默认置信度
+            # 切除靜音；整段都是靜音時不必上傳
+            prepared = self.upload.prepare(audio_file_path)
+            if prepared.is_silent:
+                logger.debug("錄音中沒有語音，略過轉換")
+                return ""
             
-            if "text" in result and isinstance(result["text"], list) and len(result["text"]) > 0:
-                transcript_text = result["text"][0]
-                confidence = result.get("confidence", 0.9) if "confidence" in result else 0.9
-                print(f"識別結果: {transcript_text}")
+            # 重播或重試的相同錄音：依目前路由順序取任一後端已有的結果
+            fingerprint = None
+            if self.transcript_cache is not None:
+                fingerprint = self.transcript_cache.fingerprint(prepared)
+                cached = self.transcript_cache.get(fingerprint, [backend.version for backend in self.router.ranked()])
+                if cached is not None:
+                    logger.debug(f"轉錄快取命中 ({cached[2]}): {cached[0]}")
+                    return cached[0]
             
-            print("语音转换完成!")
+            # 壓縮（不需要Base64编码）後依路由策略送給一個或多個後端
+            self.upload.encode(prepared, self.router.accepted_formats)
+            backend, transcript_text, confidence = self.router.transcribe(prepared)
+            if backend is None:
+                logger.error("所有語音轉文字後端都失敗")
+                return None
+            logger.debug(f"識別結果 ({backend.name}): {transcript_text}")
+            # 只快取可採用的結果；空白或信心不足的結果下次仍會重新嘗試 (可能換到其他後端)
+            if fingerprint is not None and self.router.acceptable((transcript_text, confidence)):
+                self.transcript_cache.put(fingerprint, backend.version, transcript_text, confidence,
+                                          audio_file_path)
             
             # 保存转写结果
-            if transcript_text:
-                self.save_transcript(transcript_text, audio_file_path, confidence)
+            if transcript_text and save:
+                self.save_transcript(transcript_text, audio_file_path, confidence, backend.version)
             
             return transcript_text
 
         except Exception as e:
-            print(f"转换过程中出现错误: {str(e)}")
+            logger.error(f"转换过程中出现错误: {str(e)}")
             return None 
 
 def main():
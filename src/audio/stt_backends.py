@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.async_clients import AsyncBackendClient, AsyncRuntime, CallPolicy, create_backend_client
+from utils.log import get_logger
+
+logger = get_logger("stt")
+
+
+class STTBackend:
+    """語音轉文字後端的共同介面
+
+    子類別提供 name、version (模型或端點，用於區分不同後端的結果)、accepted_formats
+    (可接受的上傳格式) 與 client (AsyncBackendClient，負責期限、重試與延後建立)，
+    並實作 _request：在執行緒中送出 PreparedAudio，回傳 (文字, 信心)。
+    """
+
+    name = None
+    accepted_formats = ('wav',)
+
+    def __init__(self, client, version):
+        self.client = client
+        self.version = version
+
+    def _request(self, prepared):
+        raise NotImplementedError
+
+    async def transcribe(self, prepared):
+        """回傳 (文字, 信心)；失敗時拋出 BackendError"""
+        return await self.client.call(self._request, prepared)
+
+
+class SageMakerBackend(STTBackend):
+    """SageMaker 上的 Whisper 端點；Hugging Face 推論容器以 ffmpeg 解碼，可直接上傳 FLAC 與 Ogg Opus"""
+
+    name = 'sagemaker'
+    accepted_formats = ('wav', 'flac', 'opus')
+
+    def __init__(self, endpoint_name=None, region=None):
+        self.endpoint_name = endpoint_name or os.getenv(
+            'SAGEMAKER_ENDPOINT_NAME', 'jumpstart-dft-hf-asr-whisper-large-20250426-025518')
+        region = region or os.getenv('AWS_REGION', 'us-west-2')
+        # 含期限與重試策略；boto3 客戶端在第一次轉錄時才建立
+        super().__init__(create_backend_client("sagemaker", "sagemaker-runtime", region_name=region),
+                         version=f"sagemaker:{self.endpoint_name}")
+
+    def _request(self, prepared):
+        response = self.client.raw.invoke_endpoint(
+            EndpointName=self.endpoint_name,
+            ContentType=prepared.content_type,
+            Body=prepared.data
+        )
+        result = json.loads(response["Body"].read().decode("utf-8"))
+        if isinstance(result.get("text"), list) and result["text"]:
+            return result["text"][0], result.get("confidence", 0.9)
+        return "", 0.0
+
+
+class GoogleBackend(STTBackend):
+    """Google Speech-to-Text REST API (GOOGLE_STT_ENDPOINT_URL 可導向本地假後端)"""
+
+    name = 'google'
+    accepted_formats = ('wav', 'flac', 'opus')
+
+    def __init__(self, language_code=None):
+        self.api_key = os.getenv('GOOGLE_API_KEY')
+        self.language_code = language_code or os.getenv('STT_GOOGLE_LANGUAGE', 'zh-TW')
+        self.base_url = os.getenv('GOOGLE_STT_ENDPOINT_URL', 'https://speech.googleapis.com')
+        policy = CallPolicy(prefix="GOOGLE_STT", deadline=15.0, attempt_timeout=8.0)
+
+        def session():
+            import requests
+            return requests.Session()
+
+        super().__init__(AsyncBackendClient("google_stt", policy=policy, raw_factory=session),
+                         version=f"google:{self.language_code}")
+
+    def _request(self, prepared):
+        import base64
+        data = {
+            'config': {
+                'encoding': prepared.google_encoding,
+                'sampleRateHertz': prepared.sample_rate,
+                'languageCode': self.language_code,
+                'enableAutomaticPunctuation': True
+            },
+            'audio': {'content': base64.b64encode(prepared.data).decode('utf-8')}
+        }
+        response = self.client.raw.post(f"{self.base_url}/v1/speech:recognize?key={self.api_key}",
+                                        json=data, timeout=self.client.policy.attempt_timeout)
+        response.raise_for_status()
+        # 較長的語音會分成多個結果，依序接起
+        alternatives = [result['alternatives'][0] for result in response.json().get('results', [])
+                        if result.get('alternatives')]
+        if not alternatives:
+            return "", 0.0
+        text = "".join(alternative.get('transcript', '') for alternative in alternatives)
+        confidence = sum(alternative.get('confidence', 0.0) for alternative in alternatives) / len(alternatives)
+        return text, confidence
+
+
+class LocalWhisperBackend(STTBackend):
+    """本機 CPU 上的 faster-whisper (CTranslate2) 模型，不需網路；直接使用修剪後的 PCM
+
+    模型在第一次轉錄 (或 VoiceAssistant.warm_up) 時才載入；CPU 運算一次只跑一個請求。
+    """
+
+    name = 'local'
+    accepted_formats = ('wav', 'flac', 'opus')  # 不上傳，任何格式都可以
+
+    def __init__(self, model_size=None, compute_type=None, language=None):
+        self.model_size = model_size or os.getenv('STT_LOCAL_MODEL', 'small')
+        self.compute_type = compute_type or os.getenv('STT_LOCAL_COMPUTE_TYPE', 'int8')
+        self.language = language or os.getenv('STT_LOCAL_LANGUAGE', 'zh')
+        policy = CallPolicy(prefix="LOCAL_STT", deadline=30.0, attempt_timeout=30.0, max_retries=0,
+                            max_concurrency=1)
+
+        def load_model():
+            from faster_whisper import WhisperModel
+            return WhisperModel(self.model_size, device='cpu', compute_type=self.compute_type,
+                                cpu_threads=int(os.getenv('STT_LOCAL_THREADS', 0)))
+
+        super().__init__(AsyncBackendClient("local_stt", policy=policy, raw_factory=load_model),
+                         version=f"local:faster-whisper-{self.model_size}:{self.compute_type}")
+
+    def _request(self, prepared):
+        import numpy as np
+        audio = np.frombuffer(prepared.pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        if prepared.channels > 1:
+            audio = audio.reshape(-1, prepared.channels).mean(axis=1)
+        if prepared.sample_rate != 16000:
+            raise ValueError(f"本機模型需要 16 kHz 音訊 (收到 {prepared.sample_rate} Hz)")
+        segments, _ = self.client.raw.transcribe(audio, language=self.language, beam_size=1)
+        segments = list(segments)  # 產生器，須在這個執行緒中跑完
+        if not segments:
+            return "", 0.0
+        text = "".join(segment.text for segment in segments).strip()
+        confidence = math.exp(sum(segment.avg_logprob for segment in segments) / len(segments))
+        return text, confidence
+
+
+BACKENDS = {backend.name: backend for backend in (SageMakerBackend, GoogleBackend, LocalWhisperBackend)}
+
+
+def create_backends(names=None):
+    """依名稱建立後端 (STT_BACKENDS，逗號分隔，預設 sagemaker)，順序即靜態路由的優先順序"""
+    names = names or os.getenv('STT_BACKENDS', 'sagemaker')
+    if isinstance(names, str):
+        names = [name.strip() for name in names.split(',') if name.strip()]
+    unknown = [name for name in names if name not in BACKENDS]
+    if unknown:
+        raise ValueError(f"未知的語音轉文字後端: {', '.join(unknown)} (可用: {', '.join(BACKENDS)})")
+    return [BACKENDS[name]() for name in names]
+
+
+class _BackendStats:
+    """單一後端最近的延遲與成敗，用於路由排序
+
+    延遲樣本超過 max_age 秒即不再計入：排在後面、久未被呼叫的後端分數回到 0，
+    下一次會先被試用一次 (探索)，避免一次失敗或舊的慢速紀錄讓它永遠排在最後。
+    """
+
+    def __init__(self, window=50, max_age=300.0):
+        self.latencies = deque(maxlen=window)  # (時間, 秒數)
+        self.max_age = max_age
+        self.calls = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.wins = 0
+
+    def score(self, now=None):
+        """最近延遲的中位數 (秒；失敗已以懲罰延遲計入)。沒有未過期的樣本時為 0，會先被試用"""
+        now = time.monotonic() if now is None else now
+        ordered = sorted(seconds for at, seconds in self.latencies if now - at <= self.max_age)
+        if not ordered:
+            return 0.0
+        return ordered[len(ordered) // 2]
+
+
+class STTRouter:
+    """在多個語音轉文字後端之間路由
+
+    - fallback：依序嘗試，失敗或結果不可接受時換下一個
+    - race：同時送給前 race_width 個後端，取第一個可接受的結果並取消其餘請求
+
+    routing=latency 時依各後端最近延遲的中位數排序 (失敗視為慢)，最快的優先；樣本超過
+    STT_STATS_MAX_AGE 秒即過期，久未使用的後端會重新被試用。static 則固定依 STT_BACKENDS 的順序。
+    """
+
+    POLICIES = ('fallback', 'race')
+
+    def __init__(self, backends, policy=None, race_width=None, routing=None, min_confidence=None,
+                 failure_penalty=None, upload=None):
+        if not backends:
+            raise ValueError("至少需要一個語音轉文字後端")
+        self.backends = list(backends)
+        self.policy = policy or os.getenv('STT_POLICY', 'fallback')
+        if self.policy not in self.POLICIES:
+            raise ValueError(f"未知的路由策略: {self.policy} (可用: {', '.join(self.POLICIES)})")
+        self.race_width = int(race_width or os.getenv('STT_RACE_WIDTH', 2))
+        self.routing = routing or os.getenv('STT_ROUTING', 'latency')
+        self.min_confidence = float(min_confidence or os.getenv('STT_MIN_CONFIDENCE', 0.0))
+        self.failure_penalty = float(failure_penalty or os.getenv('STT_FAILURE_PENALTY', 5.0))
+        # UploadPreparer (選用)：每送出一個後端請求就計入一次上傳量
+        self.upload = upload
+        self._lock = threading.Lock()
+        max_age = float(os.getenv('STT_STATS_MAX_AGE', 300))
+        self._stats = {backend.name: _BackendStats(max_age=max_age) for backend in self.backends}
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _record(self, backend, seconds, outcome):
+        with self._lock:
+            stats = self._stats[backend.name]
+            stats.calls += 1
+            if outcome == 'failed':
+                stats.failures += 1
+                seconds = max(seconds, self.failure_penalty)
+            elif outcome == 'cancelled':
+                # 被取消時的耗時只是實際延遲的下限 (約等於勝出者的延遲)；不低於目前的中位數計入，
+                # 否則總是落敗的後端看起來會和勝出者一樣快
+                stats.cancelled += 1
+                seconds = max(seconds, stats.score())
+            stats.latencies.append((time.monotonic(), seconds))
+
+    async def _run(self, backend, prepared):
+        """呼叫單一後端並記錄延遲；失敗時回傳 None"""
+        if self.upload is not None:
+            self.upload.record_upload(prepared)
+        start = time.perf_counter()
+        try:
+            result = await backend.transcribe(prepared)
+        except asyncio.CancelledError:
+            self._record(backend, time.perf_counter() - start, 'cancelled')
+            raise
+        except Exception as e:
+            self._record(backend, time.perf_counter() - start, 'failed')
+            logger.warning(f"{backend.name} 語音轉文字失敗: {e}")
+            return None
+        self._record(backend, time.perf_counter() - start, 'ok')
+        return result
+
+    async def _fallback(self, backends, prepared):
+        best = None
+        for backend in backends:
+            result = await self._run(backend, prepared)
+            if result is None:
+                continue
+            if self.acceptable(result):
+                return backend, result
+            best = best or (backend, result)
+        return best
+
+    async def _race(self, prepared):
+        ranked = self.ranked()
+        contenders, reserves = ranked[:self.race_width], ranked[self.race_width:]
+        tasks = {asyncio.ensure_future(self._run(backend, prepared)): backend for backend in contenders}
+        best = None
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result is None:
+                        continue
+                    if self.acceptable(result):
+                        return tasks[task], result
+                    best = best or (tasks[task], result)
+        finally:
+            # 已送出的請求無法收回，只是不再等待其結果
+            for task in pending:
+                task.cancel()
+        # 參賽的後端都失敗或不可接受時，再依序試其餘後端
+        return await self._fallback(reserves, prepared) or best
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    @property
+    def accepted_formats(self):
+        """所有後端都接受的上傳格式 (同一份音訊可能送給多個後端)"""
+        formats = set(self.backends[0].accepted_formats)
+        for backend in self.backends[1:]:
+            formats &= set(backend.accepted_formats)
+        return tuple(formats) or ('wav',)
+
+    def acceptable(self, result):
+        """(文字, 信心) 是否可採用：非空且信心不低於 STT_MIN_CONFIDENCE"""
+        text, confidence = result
+        return bool(text) and confidence >= self.min_confidence
+
+    def ranked(self):
+        """依路由方式排序的後端；延遲相同時維持設定的順序"""
+        if self.routing == 'static':
+            return list(self.backends)
+        with self._lock:
+            scores = {name: stats.score() for name, stats in self._stats.items()}
+        return sorted(self.backends, key=lambda backend: scores[backend.name])
+
+    def transcribe(self, prepared):
+        """轉換 PreparedAudio，回傳 (後端, 文字, 信心)；所有後端都失敗時回傳 (None, None, 0.0)"""
+        if self.policy == 'race' and len(self.backends) > 1:
+            coro = self._race(prepared)
+        else:
+            coro = self._fallback(self.ranked(), prepared)
+        outcome = AsyncRuntime.get().run(coro)
+        if outcome is None:
+            return None, None, 0.0
+        backend, (text, confidence) = outcome
+        with self._lock:
+            self._stats[backend.name].wins += 1
+        return backend, text, confidence
+
+    def stats(self):
+        """各後端的呼叫次數、失敗、被取消、採用次數與延遲中位數"""
+        with self._lock:
+            return {name: {
+                'calls': stats.calls,
+                'failures': stats.failures,
+                'cancelled': stats.cancelled,
+                'wins': stats.wins,
+                'latency_p50': round(stats.score(), 3),
+            } for name, stats in self._stats.items()}
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
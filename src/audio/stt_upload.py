@@ -0,0 +1,191 @@
+import io
+import os
+import sys
+import wave
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.tracing import traced
+from utils.log import get_logger
+
+logger = get_logger("stt")
+
+# 上傳格式 -> (SageMaker 的 Content-Type, Google Speech 的 encoding)
+UPLOAD_FORMATS = {
+    'wav': ('audio/wav', 'LINEAR16'),
+    'flac': ('audio/x-flac', 'FLAC'),
+    'opus': ('audio/ogg', 'OGG_OPUS'),
+}
+
+
+def trim_silence(pcm, sample_rate, channels=1, threshold=500, padding=0.2, frame_seconds=0.03):
+    """以短時能量切除 16-bit PCM 前後的靜音；全為靜音時回傳空位元組
+
+    每個短區塊的平均振幅與 AudioRecorder._is_silent 的判斷方式相同；
+    前後各保留 padding 秒，避免切掉字首字尾的弱音。句中的停頓不會被切除。
+    """
+    import numpy as np
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    frame = max(1, int(sample_rate * frame_seconds)) * channels
+    count = len(samples) // frame
+    if count == 0:
+        return pcm
+    levels = np.abs(samples[:count * frame].reshape(count, frame).astype(np.int32)).mean(axis=1)
+    voiced = np.flatnonzero(levels >= threshold)
+    if len(voiced) == 0:
+        return b""
+    pad = int(sample_rate * padding) * channels
+    start = max(0, voiced[0] * frame - pad)
+    end = len(samples) if voiced[-1] == count - 1 else min(len(samples), (voiced[-1] + 1) * frame + pad)
+    return samples[start:end].tobytes()
+
+
+class PreparedAudio:
+    """準備上傳的一段語音：修剪後的 PCM 與編碼後的內容 (UploadPreparer.encode 之前 data 為 None)"""
+
+    def __init__(self, data, audio_format, pcm, sample_rate, channels, original_bytes):
+        self.data = data
+        self.audio_format = audio_format
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.original_bytes = original_bytes
+
+    @property
+    def content_type(self):
+        """SageMaker 的 Content-Type"""
+        return UPLOAD_FORMATS[self.audio_format][0]
+
+    @property
+    def google_encoding(self):
+        """Google Speech 的 encoding"""
+        return UPLOAD_FORMATS[self.audio_format][1]
+
+    @property
+    def is_silent(self):
+        """修剪後沒有語音 (不必上傳)"""
+        return not self.pcm
+
+    @property
+    def seconds(self):
+        return len(self.pcm) / (2 * self.channels * self.sample_rate)
+
+
+class UploadPreparer:
+    """上傳語音轉文字前的處理：切除錄音前後的靜音，並以後端可接受的壓縮格式編碼。
+
+    固定長度的錄音通常前後都有一段靜音，切除後再以 FLAC (無損) 或 Opus (有損，最小) 編碼，
+    可大幅減少行動網路上傳的資料量；累計的節省量由 stats() 提供給指標端點。
+    """
+
+    def __init__(self, audio_format=None, trim=None, threshold=None, padding=None):
+        self.audio_format = (audio_format or os.getenv('STT_UPLOAD_FORMAT', 'flac')).lower()
+        if self.audio_format not in UPLOAD_FORMATS:
+            raise ValueError(f"未知的上傳格式: {self.audio_format} (可用: {', '.join(UPLOAD_FORMATS)})")
+        self.trim = trim if trim is not None else os.getenv('STT_TRIM_SILENCE', '1') == '1'
+        self.threshold = float(threshold or os.getenv('STT_TRIM_THRESHOLD', 500))
+        self.padding = float(padding or os.getenv('STT_TRIM_PADDING', 0.2))
+
+        self._lock = threading.Lock()
+        self.files = 0
+        self.silent_files = 0
+        self.original_bytes = 0
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.trimmed_seconds = 0.0
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    @staticmethod
+    def _encode(pcm, sample_rate, channels, audio_format):
+        buffer = io.BytesIO()
+        if audio_format == 'wav':
+            with wave.open(buffer, 'wb') as wf:
+                wf.setnchannels(channels)
+                wf.setsampwidth(2)
+                wf.setframerate(sample_rate)
+                wf.writeframes(pcm)
+            return buffer.getvalue()
+
+        import numpy as np
+        import soundfile as sf
+        samples = np.frombuffer(pcm, dtype=np.int16).reshape(-1, channels)
+        if audio_format == 'flac':
+            sf.write(buffer, samples, sample_rate, format='FLAC', subtype='PCM_16')
+        else:
+            sf.write(buffer, samples, sample_rate, format='OGG', subtype='OPUS')
+        return buffer.getvalue()
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    @traced('stt_prepare')
+    def prepare(self, audio_file_path, accepted=None):
+        """讀取錄音 (16-bit WAV) 並切除前後靜音，回傳 PreparedAudio
+
+        Args:
+            accepted: 後端可接受的格式；有指定時一併編碼 (見 encode)，否則由呼叫端在上傳前再編碼
+        """
+        original_bytes = os.path.getsize(audio_file_path)
+        with wave.open(audio_file_path, 'rb') as wf:
+            sample_rate, channels, sample_width = wf.getframerate(), wf.getnchannels(), wf.getsampwidth()
+            pcm = wf.readframes(wf.getnframes())
+        if sample_width != 2:
+            raise ValueError(f"只支援 16-bit 錄音: {audio_file_path}")
+
+        seconds = len(pcm) / (2 * channels * sample_rate)
+        if self.trim:
+            pcm = trim_silence(pcm, sample_rate, channels, self.threshold, self.padding)
+
+        prepared = PreparedAudio(None, None, pcm, sample_rate, channels, original_bytes)
+        with self._lock:
+            self.files += 1
+            self.silent_files += prepared.is_silent
+            self.original_bytes += original_bytes
+            self.trimmed_seconds += seconds - prepared.seconds
+        logger.debug(f"切除 {seconds - prepared.seconds:.1f} 秒靜音")
+        if accepted is not None:
+            self.encode(prepared, accepted)
+        return prepared
+
+    def encode(self, prepared, accepted=('wav',)):
+        """以設定的格式編碼 (不在 accepted 中或編碼失敗時用 WAV)；上傳量在實際送出時由 record_upload 計入"""
+        audio_format = self.audio_format if self.audio_format in accepted else 'wav'
+        pcm, sample_rate, channels = prepared.pcm, prepared.sample_rate, prepared.channels
+        if not pcm:
+            data = b""
+        else:
+            try:
+                data = self._encode(pcm, sample_rate, channels, audio_format)
+            except Exception as e:
+                if audio_format == 'wav':
+                    raise
+                logger.warning(f"{audio_format} 編碼失敗，改以 WAV 上傳: {e}")
+                audio_format = 'wav'
+                data = self._encode(pcm, sample_rate, channels, audio_format)
+
+        prepared.data, prepared.audio_format = data, audio_format
+        logger.debug(f"編碼語音 {prepared.original_bytes} → {len(data)} 位元組 ({audio_format})")
+        return prepared
+
+    def record_upload(self, prepared):
+        """計入一次上傳：同一段語音送給幾個後端 (race 或 fallback) 就計入幾次"""
+        with self._lock:
+            self.uploads += 1
+            self.uploaded_bytes += len(prepared.data or b"")
+
+    def stats(self):
+        """累計的上傳量與節省量 (切除的靜音、壓縮以及不必上傳的錄音)
+
+        同一段語音送給多個後端時上傳量會重複計入，race 的節省量可能低於單一後端，甚至為負
+        """
+        with self._lock:
+            saved = self.original_bytes - self.uploaded_bytes
+            return {
+                'files': self.files,
+                'silent_files': self.silent_files,
+                'original_bytes': self.original_bytes,
+                'uploads': self.uploads,
+                'uploaded_bytes': self.uploaded_bytes,
+                'saved_bytes': saved,
+                'saved_ratio': round(saved / self.original_bytes, 3) if self.original_bytes else 0.0,
+                'trimmed_seconds': round(self.trimmed_seconds, 2),
+            }
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
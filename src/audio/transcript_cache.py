@@ -0,0 +1,107 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class TranscriptCache:
+    """語音轉文字結果的快取：以 (修剪後 PCM 的雜湊, 後端與模型版本) 為鍵，保存在 SQLite。
+
+    重播、重新處理與重試時同一段錄音不會再送到後端；換了端點或模型 (版本不同) 時不會誤用舊結果。
+    項目數超過上限時淘汰最久未使用的項目 (last_used_at 有索引)。
+    """
+
+    def __init__(self, db_path=None, max_entries=None):
+        self.db_path = db_path or os.path.join(os.path.dirname(__file__), '../../data/stt_cache/transcripts.sqlite3')
+        self.max_entries = int(max_entries or os.getenv('STT_CACHE_MAX_ENTRIES', 10000))
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # 管線的多個轉錄工作者共用同一個連線，以 _lock 保護
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS transcripts (
+                fingerprint TEXT NOT NULL,
+                backend_version TEXT NOT NULL,
+                transcript TEXT NOT NULL,
+                confidence REAL,
+                audio_file TEXT,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (fingerprint, backend_version)
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_transcripts_last_used ON transcripts (last_used_at)")
+        self._conn.commit()
+        self._entries = self._conn.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _evict(self):
+        """刪除最久未使用的項目直到不超過上限 (須持有 _lock)"""
+        excess = self._entries - self.max_entries
+        if excess <= 0:
+            return
+        self._conn.execute("""
+            DELETE FROM transcripts WHERE rowid IN (
+                SELECT rowid FROM transcripts ORDER BY last_used_at LIMIT ?)""", (excess,))
+        self._entries -= excess
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    @staticmethod
+    def fingerprint(prepared):
+        """修剪後 PCM (含取樣率與聲道數) 的 SHA-256；與上傳格式無關"""
+        digest = hashlib.sha256(f"{prepared.sample_rate}:{prepared.channels}:".encode('ascii'))
+        digest.update(prepared.pcm)
+        return digest.hexdigest()
+
+    def get(self, fingerprint, versions):
+        """依 versions 的優先順序回傳第一個快取的 (文字, 信心, 後端版本)，沒有時回傳 None"""
+        versions = list(versions)
+        if not versions:
+            return None
+        placeholders = ",".join("?" * len(versions))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT backend_version, transcript, confidence FROM transcripts "
+                f"WHERE fingerprint = ? AND backend_version IN ({placeholders})",
+                (fingerprint, *versions)).fetchall()
+            if not rows:
+                self.misses += 1
+                return None
+            version, transcript, confidence = min(rows, key=lambda row: versions.index(row[0]))
+            self._conn.execute(
+                "UPDATE transcripts SET last_used_at = ?, hits = hits + 1 "
+                "WHERE fingerprint = ? AND backend_version = ?", (time.time(), fingerprint, version))
+            self._conn.commit()
+            self.hits += 1
+        return transcript, confidence, version
+
+    def put(self, fingerprint, version, transcript, confidence=None, audio_file=None):
+        """保存一筆結果 (呼叫端只保存路由可採用的結果)"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO transcripts "
+                "(fingerprint, backend_version, transcript, confidence, audio_file, created_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (fingerprint, version, transcript, confidence,
+                 os.path.basename(audio_file) if audio_file else None, now, now))
+            # 每次寫入都伴隨一次後端呼叫，重新計數的成本可以忽略
+            self._entries = self._conn.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+            self._evict()
+            self._conn.commit()
+
+    def stats(self):
+        """命中次數與目前項目數"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': self._entries}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import glob
+import time
+import hashlib
+import functools
+import asyncio
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ─── 工作程序：每個程序只載入一次聲紋編碼器 (語音服務也以此計算嵌入) ──────────────
+_encoder = None
+
+
+def init_embed_worker():
+    global _encoder
+    from resemblyzer import VoiceEncoder
+    _encoder = VoiceEncoder()
+
+
+def embed_file(path):
+    """在工作程序中提取語者嵌入 (CPU 密集)，回傳 (嵌入列表或 None, 耗時秒數)"""
+    import soundfile as sf
+    from resemblyzer import preprocess_wav
+
+    start = time.perf_counter()
+    try:
+        wav, sr = sf.read(path)
+        embed = _encoder.embed_utterance(preprocess_wav(wav, source_sr=sr)).tolist()
+    except Exception as e:
+        print(f"[Error] 提取嵌入失敗 {path}: {e}")
+        embed = None
+    return embed, time.perf_counter() - start
+
+
+class StageStats:
+    """統計每個階段的處理數量與累計耗時"""
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        entry = self.stages.setdefault(stage, {'count': 0, 'busy_s': 0.0})
+        entry['count'] += 1
+        entry['busy_s'] += seconds
+
+    def report(self, wall_seconds):
+        return {
+            stage: {
+                'count': entry['count'],
+                'avg_s': round(entry['busy_s'] / entry['count'], 3),
+                'throughput_per_s': round(entry['count'] / wall_seconds, 3) if wall_seconds > 0 else 0.0
+            }
+            for stage, entry in self.stages.items() if entry['count']
+        }
+
+
+class AudioBatchRunner:
+    """離線重新處理錄音檔：嵌入以程序池分片計算，語音轉文字與分類以非同步 I/O 重疊執行，可依 manifest 續跑"""
+
+    def __init__(self, manifest_path=None, processes=None, io_concurrency=None, register=False):
+        from audio.recorder import AudioRecorder
+        from audio.speech_to_text_test import SpeechToText
+        from utils.command_classifier_claude import CommandClassifier
+
+        self.recorder = AudioRecorder()
+        self.transcriber = SpeechToText()
+        self.classifier = CommandClassifier()
+
+        self.manifest_path = manifest_path or os.path.join(
+            os.path.dirname(__file__), '../data/batch_runs/manifest.jsonl')
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_path)), exist_ok=True)
+        self.processes = processes or os.cpu_count() or 2
+        self.io_concurrency = io_concurrency or self.processes * 2
+        self.register = register
+        self.stats = StageStats()
+
+        # 語音轉文字後端 / 模型、分類模型與分類範例的版本；任一改變後舊的結果不算已完成，同一個 manifest 會重新處理
+        examples = json.dumps(self.classifier.reference_data, ensure_ascii=False, sort_keys=True)
+        self.examples_version = hashlib.sha1(examples.encode('utf-8')).hexdigest()[:12]
+        versions = sorted(backend.version for backend in self.transcriber.backends) + [
+            self.classifier.model_id, self.examples_version]
+        self.run_id = hashlib.sha1("|".join(versions).encode('utf-8')).hexdigest()[:12]
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _completed(self):
+        """讀取 manifest 中以目前版本 (run_id) 成功處理的檔案"""
+        done = set()
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if row.get('status') == 'ok' and row.get('run_id') == self.run_id:
+                        done.add(row['audio_file'])
+        return done
+
+    def _identify(self, embed):
+        import numpy as np
+
+        if embed is None:
+            return None, 0.0
+        embed = np.array(embed)
+        if self.register:
+            # 會修改語者資料庫；在事件迴圈執行緒中依序進行
+            return self.recorder.identify_embedding(embed)
+        best_id, best_sim, _ = self.recorder.match_embedding(embed)
+        if best_id is None or best_sim < self.recorder.similarity_threshold:
+            return None, float(best_sim)
+        return best_id, float(best_sim)
+
+    async def _timed(self, stage, executor, fn, *args):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        result = await loop.run_in_executor(executor, fn, *args)
+        self.stats.add(stage, time.perf_counter() - start)
+        return result
+
+    async def _process(self, path, process_pool, io_pool):
+        row = {'audio_file': os.path.abspath(path), 'run_id': self.run_id, 'status': 'ok'}
+        try:
+            embed, embed_seconds = await asyncio.wrap_future(process_pool.submit(embed_file, path))
+            self.stats.add('embed', embed_seconds)
+
+            start = time.perf_counter()
+            row['speaker_id'], row['similarity'] = self._identify(embed)
+            self.stats.add('identify', time.perf_counter() - start)
+
+            # 結果寫入 manifest (與轉錄快取)，不另外為每個封存檔產生轉錄 JSON
+            transcribe = functools.partial(self.transcriber.transcribe_file, save=False)
+            row['transcript'] = await self._timed('transcribe', io_pool, transcribe, path)
+            if row['transcript'] is None:
+                # 所有後端都失敗；標記為錯誤，下次續跑時重新處理
+                row.update(status='error', error='transcription failed')
+            elif row['transcript']:
+                classify = functools.partial(self.classifier.classify_command, strict=True)
+                row['command_type'] = await self._timed('classify', io_pool, classify, row['transcript'])
+                if row['command_type'] is None:
+                    row.update(status='error', error='classification failed')
+        except Exception as e:
+            row.update(status='error', error=str(e))
+        row['processed_at'] = datetime.now().isoformat()
+        return row
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    async def run(self, files):
+        """處理所有尚未完成的檔案，回傳各階段吞吐量報告"""
+        done = self._completed()
+        pending = iter([path for path in files if os.path.abspath(path) not in done])
+        if done:
+            print(f"[Info] 依 manifest 續跑 (版本 {self.run_id})，略過已完成的 {len(done)} 個檔案")
+
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.processes, initializer=init_embed_worker) as process_pool, \
+                ThreadPoolExecutor(max_workers=self.io_concurrency) as io_pool, \
+                open(self.manifest_path, 'a', encoding='utf-8') as manifest:
+
+            async def worker():
+                # 共用同一個迭代器：工作者數量即為同時處理中的檔案上限
+                for path in pending:
+                    row = await self._process(path, process_pool, io_pool)
+                    manifest.write(json.dumps(row, ensure_ascii=False) + "\n")
+                    manifest.flush()
+
+            await asyncio.gather(*(worker() for _ in range(self.io_concurrency)))
+
+        wall_seconds = time.perf_counter() - started
+        report = {'wall_s': round(wall_seconds, 2), 'stages': self.stats.report(wall_seconds)}
+        print(f"[Info] 批次處理完成: {json.dumps(report, ensure_ascii=False, indent=2)}")
+        return report
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
+
+
+def main():
+    parser = argparse.ArgumentParser(description="離線重新處理錄音檔 (嵌入、語者辨識、語音轉文字、分類)")
+    parser.add_argument('--input', default=os.path.join(os.path.dirname(__file__), '../data/audio'),
+                        help="錄音檔資料夾")
+    parser.add_argument('--manifest', default=None, help="manifest 路徑 (預設 data/batch_runs/manifest.jsonl)")
+    parser.add_argument('--processes', type=int, default=None, help="嵌入計算的程序數 (預設 CPU 核心數)")
+    parser.add_argument('--io-concurrency', type=int, default=None, help="同時進行的語音轉文字 / 分類請求數")
+    parser.add_argument('--register', action='store_true', help="將未知語者註冊到語者資料庫 (預設只比對)")
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(args.input, '**', '*.wav'), recursive=True))
+    runner = AudioBatchRunner(args.manifest, args.processes, args.io_concurrency, args.register)
+    asyncio.run(runner.run(files))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# 語音轉文字的假回覆：依音訊內容雜湊挑選，同一段錄音永遠得到同一句
+DEFAULT_TRANSCRIPTS = [
+    "你好，今天過得怎麼樣",
+    "講個笑話給我聽",
+    "今天台北的天氣如何",
+    "最近有什麼科技新聞",
+    "附近有推薦的餐廳嗎",
+    "請幫我把水杯拿到客廳",
+    "去廚房拿一瓶水給我",
+    "幫我把書放回書架",
+]
+
+QUERY_KEYWORDS = ("天氣", "新聞", "推薦", "幾點", "哪裡")
+MOVEMENT_KEYWORDS = ("拿", "放", "去", "幫我把")
+
+# 以 MP3 frame header 開頭的靜音資料，讓下游至少能判斷為音訊
+FAKE_MP3 = b"\xff\xfb\x90\x64" + b"\x00" * 4096
+
+
+class FaultProfile:
+    """單一後端的延遲與錯誤注入設定
+
+    Args:
+        latency: 基本延遲秒數
+        jitter: 延遲抖動 (標準差，秒)
+        error_rate: 回傳 500 的機率
+        throttle_rate: 回傳 429 節流錯誤的機率
+        hang_rate: 不回應直到客戶端逾時的機率
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, hang_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.hang_rate = hang_rate
+
+    @classmethod
+    def from_spec(cls, spec):
+        """解析 'latency=0.8,jitter=0.2,error_rate=0.05' 形式的設定"""
+        values = {}
+        for part in filter(None, (spec or "").split(",")):
+            key, _, value = part.partition("=")
+            values[key.strip()] = float(value)
+        return cls(**values)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    """模擬 Bedrock、SageMaker、Lambda、Polly 與 Google Speech REST 的最小 API"""
+
+    protocol_version = "HTTP/1.1"
+    backend = None
+    profile = None
+    transcripts = DEFAULT_TRANSCRIPTS
+    stats = None
+    lock = threading.Lock()
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _send(self, status, body, content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def _inject_fault(self):
+        """依設定延遲或回傳錯誤；已回應錯誤時回傳 True"""
+        profile = self.profile
+        delay = max(0.0, random.gauss(profile.latency, profile.jitter)) if profile.jitter else profile.latency
+        roll = random.random()
+        if roll < profile.hang_rate:
+            self._count("hang")
+            time.sleep(600)
+            return True
+        time.sleep(delay)
+        roll -= profile.hang_rate
+        if roll < profile.throttle_rate:
+            self._count("throttled")
+            self._send(429, {"message": "Rate exceeded"},
+                       headers={"x-amzn-ErrorType": "ThrottlingException"})
+            return True
+        roll -= profile.throttle_rate
+        if roll < profile.error_rate:
+            self._count("errors")
+            self._send(500, {"message": "Injected failure"},
+                       headers={"x-amzn-ErrorType": "InternalServerException"})
+            return True
+        return False
+
+    def _transcript_for(self, audio_bytes):
+        digest = hashlib.sha1(audio_bytes).digest()
+        return self.transcripts[digest[0] % len(self.transcripts)]
+
+    @staticmethod
+    def _model_reply(request):
+        """依提示詞內容產生與真實模型格式相同的回覆"""
+        system = " ".join(block.get("text", "") for block in request.get("system", []) or [])
+        prompt = request["messages"][-1]["content"]
+        if isinstance(prompt, list):
+            prompt = " ".join(block.get("text", "") for block in prompt)
+
+        if "命令進行分類" in system:
+            match = re.search(r'輸入："(.*?)"', prompt, re.S)
+            text = match.group(1) if match else prompt
+            if any(keyword in text for keyword in QUERY_KEYWORDS):
+                return "查詢"
+            if any(keyword in text for keyword in MOVEMENT_KEYWORDS):
+                return "行動"
+            return "聊天"
+        if "動作規劃" in system:
+            plan = {"動作順序": ["1", "2"], "說明": ["移動到目標位置", "拿取目標物品"]}
+            return "```json\n" + json.dumps(plan, ensure_ascii=False) + "\n```"
+        if '"可以"或"不可以"' in prompt:
+            return "不可以"
+        return "這是測試用的模型回覆。"
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+        self._count("requests")
+        if self._inject_fault():
+            return
+        path = self.path.split("?")[0]
+
+        if self.backend == "bedrock" and path.endswith("/invoke"):
+            reply = self._model_reply(json.loads(body))
+            self._send(200, {"content": [{"type": "text", "text": reply}],
+                             "usage": {"input_tokens": len(body) // 4, "output_tokens": len(reply)}})
+        elif self.backend == "sagemaker" and path.endswith("/invocations"):
+            self._send(200, {"text": [self._transcript_for(body)]})
+        elif self.backend == "lambda" and path.endswith("/invocations"):
+            query = json.loads(body or b"{}").get("query", "")
+            self._send(200, [{"title": f"{query} 搜尋結果 {i}", "snippet": "測試用搜尋摘要"} for i in range(3)])
+        elif self.backend == "polly" and path.endswith("/speech"):
+            request = json.loads(body or b"{}")
+            if request.get("OutputFormat") == "pcm":
+                # 每個字約 0.15 秒的靜音 16-bit PCM
+                frames = int(int(request.get("SampleRate", 16000)) * 0.15 * max(1, len(request.get("Text", ""))))
+                self._send(200, b"\x00\x00" * frames, content_type="audio/pcm")
+            else:
+                self._send(200, FAKE_MP3, content_type="audio/mpeg")
+        elif self.backend == "google_stt" and path.endswith("speech:recognize"):
+            import base64
+            audio = base64.b64decode(json.loads(body)["audio"]["content"])
+            self._send(200, {"results": [{"alternatives": [
+                {"transcript": self._transcript_for(audio), "confidence": 0.9}]}]})
+        else:
+            self._send(404, {"message": f"{self.backend} 不支援 {path}"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBackend:
+    """在背景執行緒提供單一假後端"""
+
+    def __init__(self, backend, profile=None, host="127.0.0.1", port=0, transcripts=None):
+        handler = type(f"{backend}Handler", (_FakeHandler,), {
+            "backend": backend,
+            "profile": profile or FaultProfile(),
+            "transcripts": transcripts or DEFAULT_TRANSCRIPTS,
+            "stats": {},
+        })
+        self.backend = backend
+        self.handler = handler
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    @property
+    def stats(self):
+        return dict(self.handler.stats)
+
+
+# 後端名稱 -> 真實程式碼讀取的 endpoint 環境變數
+BACKEND_ENV = {
+    "bedrock": "BEDROCK_ENDPOINT_URL",
+    "sagemaker": "SAGEMAKER_ENDPOINT_URL",
+    "lambda": "LAMBDA_ENDPOINT_URL",
+    "polly": "POLLY_ENDPOINT_URL",
+    "google_stt": "GOOGLE_STT_ENDPOINT_URL",
+}
+
+
+def serve_all(profiles, host="127.0.0.1", base_port=8900, ready=None):
+    """啟動所有假後端並阻塞；ready 為 multiprocessing 佇列時回報各後端網址"""
+    backends = [FakeBackend(name, profiles.get(name), host, base_port + i if base_port else 0).start()
+                for i, name in enumerate(BACKEND_ENV)]
+    urls = {backend.backend: backend.url for backend in backends}
+    if ready is not None:
+        ready.put(urls)
+    else:
+        for name, url in urls.items():
+            print(f"[Info] {BACKEND_ENV[name]}={url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地假後端 (Bedrock / SageMaker / Lambda / Polly / Google STT)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--base-port', type=int, default=8900)
+    for name in BACKEND_ENV:
+        parser.add_argument(f'--{name.replace("_", "-")}', default="",
+                            help=f"{name} 的延遲與錯誤設定，例如 latency=0.8,jitter=0.2,error_rate=0.05")
+    args = parser.parse_args()
+    profiles = {name: FaultProfile.from_spec(getattr(args, name)) for name in BACKEND_ENV}
+    serve_all(profiles, args.host, args.base_port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+import os
+import sys
+import json
+import glob
+import time
+import wave
+import asyncio
+import argparse
+import resource
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark.fake_backends import FaultProfile, BACKEND_ENV, serve_all
+from utils.pipeline import OVERFLOW_POLICIES
+
+
+# 預設的後端延遲情境 (秒)
+PRESETS = {
+    'ideal': {},
+    'realistic': {
+        'bedrock': 'latency=0.8,jitter=0.25',
+        'sagemaker': 'latency=0.6,jitter=0.15',
+        'lambda': 'latency=1.2,jitter=0.3',
+        'polly': 'latency=0.3,jitter=0.1',
+        'google_stt': 'latency=0.7,jitter=0.2',
+    },
+    'flaky': {
+        'bedrock': 'latency=0.8,jitter=0.4,error_rate=0.05,throttle_rate=0.05',
+        'sagemaker': 'latency=0.6,jitter=0.3,error_rate=0.05',
+        'lambda': 'latency=1.2,jitter=0.6,error_rate=0.05,hang_rate=0.02',
+        'polly': 'latency=0.3,jitter=0.2,throttle_rate=0.05',
+        'google_stt': 'latency=0.7,jitter=0.3,error_rate=0.05',
+    },
+}
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), '../../data/benchmarks')
+
+# 比較時檢查的指標：(顯示名稱, 取值函式, 數值越大越好)
+COMPARED_METRICS = [
+    ('turn p50 (s)', lambda r: r['stages'].get('turn', {}).get('p50'), False),
+    ('turn p95 (s)', lambda r: r['stages'].get('turn', {}).get('p95'), False),
+    ('turn p99 (s)', lambda r: r['stages'].get('turn', {}).get('p99'), False),
+    ('throughput (turns/s)', lambda r: r['throughput_turns_per_s'], True),
+    ('cpu (s)', lambda r: r['cpu_s'], False),
+    ('peak rss (MB)', lambda r: r['peak_rss_mb'], False),
+]
+
+
+def generate_audio(directory, turns, speakers, seconds, sample_rate):
+    """產生合成語音：每位「說話者」有固定的基頻與諧波組成，加上音節般的振幅起伏與雜訊"""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(0)
+    voices = [(rng.uniform(90, 260), rng.uniform(0.3, 0.8, size=5)) for _ in range(speakers)]
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    for i in range(turns):
+        f0, harmonics = voices[i % speakers]
+        signal = sum(weight * np.sin(2 * np.pi * f0 * (k + 1) * t + rng.uniform(0, np.pi))
+                     for k, weight in enumerate(harmonics))
+        syllables = 0.5 * (1 + np.sin(2 * np.pi * rng.uniform(3, 5) * t))
+        signal = signal * syllables + rng.normal(0, 0.05, size=t.size)
+        pcm = (signal / np.max(np.abs(signal)) * 12000).astype(np.int16)
+        with wave.open(os.path.join(directory, f"bench_{i:04d}.wav"), "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(sample_rate)
+            wf.writeframes(pcm.tobytes())
+    return directory
+
+
+def git_revision():
+    """目前的 commit 與是否有未提交的修改"""
+    root = os.path.join(os.path.dirname(__file__), '../..')
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                             cwd=root, stderr=subprocess.DEVNULL).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+
+class SynthesisSink:
+    """管線最後一個階段：只合成語音回應 (不播放)，量測語音合成的延遲"""
+
+    def __init__(self, speaker):
+        self.speaker = speaker
+
+    def write(self, turn):
+        if turn.skipped or turn.response is None:
+            return turn
+        if turn.response.speech_text:
+            self.speaker.synthesize(turn.response.speech_text)
+        return turn
+
+
+class BenchmarkRunner:
+    """以本地假後端執行真實的管線程式碼，量測每輪延遲、吞吐量與 CPU / 記憶體用量"""
+
+    def __init__(self, profiles, run_dir, tts=False, speed=0.0, stt_workers=None, handler_workers=None,
+                 overflow=None):
+        self.profiles = profiles
+        self.run_dir = run_dir
+        self.tts = tts
+        self.speed = speed
+        self.stt_workers = stt_workers
+        self.handler_workers = handler_workers
+        self.overflow = overflow
+        self._server = None
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _start_backends(self):
+        """假後端在獨立程序中執行，不計入被量測程序的 CPU 用量"""
+        ready = multiprocessing.Queue()
+        self._server = multiprocessing.Process(target=serve_all, args=(self.profiles, '127.0.0.1', 0, ready),
+                                               daemon=True)
+        self._server.start()
+        urls = ready.get(timeout=30)
+        for name, url in urls.items():
+            os.environ[BACKEND_ENV[name]] = url
+        # botocore 需要憑證才能簽署請求；假後端不檢查
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+        os.environ['TRACE_FILE'] = os.path.join(self.run_dir, 'trace.jsonl')
+        return urls
+
+    def _create_assistant(self):
+        """建立真實元件，並將語者資料庫、快取與歷史記錄改到本次執行的目錄，避免污染 data/"""
+        from audio.recorder import AudioRecorder
+        from audio.speech_to_text_test import SpeechToText
+        from utils.command_classifier_claude import CommandClassifier
+        from utils.answer_cache import AnswerCache
+        from utils.plan_library import PlanLibrary
+        from utils.conversation_summarizer import ConversationSummarizer
+        from utils.history_writer import HistoryWriter
+        from utils.voice_pipeline import VoiceAssistant
+
+        recorder = AudioRecorder()
+        recorder.speaker_data_file = os.path.join(self.run_dir, 'speaker_data.json')
+        recorder.speaker_db = {"speakers": {}}
+
+        classifier = CommandClassifier()
+        classifier.answer_cache = AnswerCache(cache_file=os.path.join(self.run_dir, 'answer_cache.json'))
+        classifier.plan_library = PlanLibrary(
+            seed_tasks=classifier.prompts.get_data('movement_system')['任務拆解'],
+            action_codes=lambda: classifier.action_codes,
+            library_file=os.path.join(self.run_dir, 'plans.json')
+        )
+        classifier.history_writer.close()
+        classifier.history_writer = HistoryWriter(data_dir=self.run_dir)
+        classifier.summarizer.close(timeout=1)
+        classifier.summarizer = ConversationSummarizer(
+            summarize_fn=classifier._send_to_model,
+            summary_file=os.path.join(self.run_dir, 'conversation_summaries.json')
+        )
+
+        speaker = None
+        if self.tts:
+            from utils.text_to_speech_test import ResponseSpeaker
+            from utils.tts_cache import TTSCache
+            speaker = ResponseSpeaker()
+            if speaker.tts_cache is not None:
+                speaker.tts_cache = TTSCache(cache_dir=os.path.join(self.run_dir, 'tts_cache'))
+        transcriber = SpeechToText()
+        if transcriber.transcript_cache is not None:
+            from audio.transcript_cache import TranscriptCache
+            transcriber.transcript_cache.close()
+            transcriber.transcript_cache = TranscriptCache(db_path=os.path.join(self.run_dir, 'transcripts.sqlite3'))
+        return VoiceAssistant(recorder, transcriber, classifier, speaker)
+
+    @staticmethod
+    def _client_stats(assistant):
+        clients = {
+            'bedrock': assistant.classifier.model_client,
+            'lambda': assistant.classifier.search_client,
+        }
+        for backend in assistant.transcriber.backends:
+            clients[backend.client.name] = backend.client
+        if assistant.speaker is not None:
+            clients['polly'] = assistant.speaker.tts_client
+        return {name: dict(client.stats) for name, client in clients.items()}
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    def run(self, audio_dir):
+        from audio.input_adapters import WavDirectorySource
+
+        os.makedirs(self.run_dir, exist_ok=True)
+        self._start_backends()
+        try:
+            init_started = time.perf_counter()
+            assistant = self._create_assistant()
+            init_seconds = time.perf_counter() - init_started
+
+            sink = SynthesisSink(assistant.speaker) if self.tts else None
+            assistant.build_pipeline(stt_workers=self.stt_workers, handler_workers=self.handler_workers,
+                                     speak=False, sink=sink, overflow=self.overflow)
+            source = assistant.replay(WavDirectorySource(audio_dir, speed=self.speed))
+
+            usage_before = resource.getrusage(resource.RUSAGE_SELF)
+            started = time.perf_counter()
+            asyncio.run(assistant.run(source))
+            wall_seconds = time.perf_counter() - started
+            usage_after = resource.getrusage(resource.RUSAGE_SELF)
+        finally:
+            self._server.terminate()
+
+        cpu_seconds = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+        stats = assistant.pipeline.stats()
+        turns = stats['handle']['processed']
+        assistant.close()
+        return {
+            'turns': turns,
+            'failed': sum(stage['failed'] for stage in stats.values()),
+            'shed': sum(sum(stage['shed'].values()) for stage in stats.values()),
+            'init_s': round(init_seconds, 3),
+            'wall_s': round(wall_seconds, 3),
+            'throughput_turns_per_s': round(turns / wall_seconds, 3) if wall_seconds > 0 else 0.0,
+            'cpu_s': round(cpu_seconds, 3),
+            'cpu_percent': round(100 * cpu_seconds / wall_seconds, 1) if wall_seconds > 0 else 0.0,
+            # Linux 的 ru_maxrss 單位為 KB
+            'peak_rss_mb': round(usage_after.ru_maxrss / 1024, 1),
+            'stages': assistant.tracer.summary(),
+            'pipeline': stats,
+            'clients': self._client_stats(assistant),
+            'tts_cache': assistant.speaker.tts_cache.stats() if getattr(assistant.speaker, 'tts_cache', None) else None,
+            'stt_upload': assistant.transcriber.upload.stats() if getattr(assistant.transcriber, 'upload', None) else None,
+            'stt_backends': assistant.transcriber.router.stats(),
+            'stt_cache': assistant.transcriber.transcript_cache.stats() if assistant.transcriber.transcript_cache else None,
+        }
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
+
+
+def compare(current, baseline, threshold):
+    """列出與基準的差異，回傳是否有超過門檻的退步"""
+    print(f"\n與基準比較 ({baseline.get('git_commit')} @ {baseline.get('timestamp')})：")
+    regressed = False
+    for name, getter, higher_is_better in COMPARED_METRICS:
+        new, old = getter(current), getter(baseline)
+        if new is None or old is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        worse = change < -threshold if higher_is_better else change > threshold
+        regressed |= worse
+        print(f"  {name:<22} {old:>10.3f} → {new:>10.3f}  ({change:+.1f}%){'  ⚠️ 退步' if worse else ''}")
+    return regressed
+
+
+def find_baseline(spec, exclude):
+    if spec and spec != 'latest':
+        with open(spec, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    candidates = sorted((path for path in glob.glob(os.path.join(RESULTS_DIR, 'bench_*.json')) if path != exclude),
+                        key=os.path.getmtime)
+    if not candidates:
+        return None
+    with open(candidates[-1], 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以本地假後端執行端到端效能測試")
+    parser.add_argument('--turns', type=int, default=20, help="合成語音的數量")
+    parser.add_argument('--speakers', type=int, default=3, help="合成語音的說話者數量")
+    parser.add_argument('--audio', default=None, help="改用此資料夾中錄好的 WAV 檔")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='realistic', help="後端延遲情境")
+    for name in BACKEND_ENV:
+        parser.add_argument(f'--{name.replace("_", "-")}', default=None,
+                            help=f"覆寫 {name} 的設定，例如 latency=0.8,jitter=0.2,error_rate=0.05")
+    parser.add_argument('--speed', type=float, default=0.0, help="輸入速度：0 為不等待 (量測吞吐量)，1 為即時")
+    parser.add_argument('--tts', action='store_true', help="包含語音合成 (不播放)")
+    parser.add_argument('--stt-workers', type=int, default=None)
+    parser.add_argument('--handler-workers', type=int, default=None)
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=None,
+                        help="管線佇列已滿時的策略 (預設讀取 PIPELINE_OVERFLOW)")
+    parser.add_argument('--stt-backends', default=None,
+                        help="語音轉文字後端，例如 sagemaker,google (預設讀取 STT_BACKENDS)")
+    parser.add_argument('--stt-policy', choices=('fallback', 'race'), default=None,
+                        help="多個語音轉文字後端的路由策略 (預設讀取 STT_POLICY)")
+    parser.add_argument('--label', default='', help="結果標籤")
+    parser.add_argument('--compare', default='latest', help="比較基準：latest (上一次結果)、結果檔路徑或 none")
+    parser.add_argument('--fail-threshold', type=float, default=None,
+                        help="任一指標退步超過此百分比時以非零狀態結束 (供 CI 使用)")
+    args = parser.parse_args()
+
+    specs = dict(PRESETS[args.preset])
+    for name in BACKEND_ENV:
+        if getattr(args, name) is not None:
+            specs[name] = getattr(args, name)
+    profiles = {name: FaultProfile.from_spec(specs.get(name)) for name in BACKEND_ENV}
+    if args.stt_backends:
+        os.environ['STT_BACKENDS'] = args.stt_backends
+    if args.stt_policy:
+        os.environ['STT_POLICY'] = args.stt_policy
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    commit, dirty = git_revision()
+    run_dir = os.path.join(RESULTS_DIR, f"run_{timestamp}")
+    sample_rate = int(os.getenv('SAMPLE_RATE', 16000))
+    audio_dir = args.audio or generate_audio(os.path.join(run_dir, 'audio'), args.turns, args.speakers,
+                                             float(os.getenv('RECORD_SECONDS', 3)), sample_rate)
+
+    runner = BenchmarkRunner(profiles, run_dir, tts=args.tts, speed=args.speed,
+                             stt_workers=args.stt_workers, handler_workers=args.handler_workers,
+                             overflow=args.overflow)
+    result = runner.run(audio_dir)
+    result.update({
+        'label': args.label,
+        'git_commit': commit,
+        'git_dirty': dirty,
+        'timestamp': datetime.now().isoformat(),
+        'config': {
+            'preset': args.preset,
+            'profiles': {name: profile.to_dict() for name, profile in profiles.items()},
+            'audio': args.audio or 'synthetic',
+            'speed': args.speed,
+            'tts': args.tts,
+            'stt_workers': args.stt_workers,
+            'handler_workers': args.handler_workers,
+            'overflow': args.overflow,
+            'stt_backends': os.getenv('STT_BACKENDS', 'sagemaker'),
+            'stt_policy': os.getenv('STT_POLICY', 'fallback'),
+        },
+    })
+
+    result_path = os.path.join(RESULTS_DIR, f"bench_{timestamp}_{commit or 'nogit'}.json")
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if result['shed']:
+        print(f"\n過載卸載 {result['shed']} 輪")
+    if len(result['stt_backends']) > 1:
+        print("\n語音轉文字後端：" + "，".join(f"{name} 採用 {stats['wins']}/{stats['calls']} 次 "
+                                            f"(p50 {stats['latency_p50']:.3f} 秒)"
+                                            for name, stats in result['stt_backends'].items()))
+    upload = result['stt_upload']
+    if upload and upload['original_bytes']:
+        print(f"\n語音上傳 {upload['uploaded_bytes']} / {upload['original_bytes']} 位元組 "
+              f"(節省 {upload['saved_ratio']:.0%}，切除 {upload['trimmed_seconds']} 秒靜音)")
+    print(f"\n完成 {result['turns']} 輪：{result['throughput_turns_per_s']} 輪/秒，"
+          f"CPU {result['cpu_s']} 秒 ({result['cpu_percent']}%)，峰值記憶體 {result['peak_rss_mb']} MB")
+    for name, stats in sorted(result['stages'].items(), key=lambda item: -item[1]['avg']):
+        print(f"  {name:<20} p50 {stats['p50']:.3f}  p95 {stats['p95']:.3f}  p99 {stats['p99']:.3f}")
+    print(f"結果已保存至: {result_path}")
+
+    baseline = None if args.compare == 'none' else find_baseline(args.compare, result_path)
+    if baseline is not None:
+        regressed = compare(result, baseline, args.fail_threshold or 10.0)
+        if regressed and args.fail_threshold is not None:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
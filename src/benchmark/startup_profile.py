@@ -0,0 +1,205 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import importlib
+import subprocess
+from collections import defaultdict
+from datetime import datetime
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(SRC_DIR)
+
+BUDGET_FILE = os.path.join(os.path.dirname(__file__), '../../assets/startup_budget.json')
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), '../../data/benchmarks')
+
+# (元件名稱, 模組, 類別)，依 main.create_assistant 的建立順序
+COMPONENTS = [
+    ('recorder', 'audio.recorder', 'AudioRecorder'),
+    ('stt', 'audio.speech_to_text_test', 'SpeechToText'),
+    ('classifier', 'utils.command_classifier_claude', 'CommandClassifier'),
+    ('tts', 'utils.text_to_speech_test', 'ResponseSpeaker'),
+    ('pipeline', 'utils.voice_pipeline', 'VoiceAssistant'),
+]
+
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def importtime_breakdown(module, top=8):
+    """在乾淨的子行程以 -X importtime 匯入模組，回傳 (總毫秒, 依頂層套件彙總的前幾名)
+
+    每個行程只會匯入一次相同的套件，因此各元件分開量測，才看得出誰拖慢了啟動。
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=SRC_DIR, capture_output=True, text=True)
+    if proc.returncode != 0:
+        error = proc.stderr.strip().splitlines()
+        return None, {'error': error[-1] if error else f'exit {proc.returncode}'}
+
+    total_us, by_package = 0, defaultdict(int)
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        by_package[name.split('.')[0]] += int(self_us)
+        if name == module:
+            total_us = int(cumulative_us)
+    packages = sorted(by_package.items(), key=lambda item: -item[1])[:top]
+    return round(total_us / 1000, 1), {name: round(us / 1000, 1) for name, us in packages}
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    try:
+        return fn(), round((time.perf_counter() - start) * 1000, 1), None
+    except Exception as e:
+        return None, round((time.perf_counter() - start) * 1000, 1), f'{type(e).__name__}: {e}'
+
+
+def profile_in_process():
+    """在目前行程依序匯入並建立所有元件 (與實際啟動相同)，再量測延後到第一次使用的成本"""
+    imports, inits, first_use, errors = {}, {}, {}, {}
+
+    classes = {}
+    for name, module, class_name in COMPONENTS:
+        mod, imports[module], error = _timed(lambda: importlib.import_module(module))
+        if error:
+            errors[module] = error
+        else:
+            classes[name] = getattr(mod, class_name)
+
+    components = {}
+    for name, _, _ in COMPONENTS[:-1]:
+        if name not in classes:
+            continue
+        components[name], inits[name], error = _timed(classes[name])
+        if error:
+            errors[name] = error
+    if 'pipeline' in classes and len(components) == len(COMPONENTS) - 1:
+        _, inits['pipeline'], error = _timed(lambda: classes['pipeline'](
+            components['recorder'], components['stt'], components['classifier'], components['tts']))
+        if error:
+            errors['pipeline'] = error
+
+    # 這些成本不在啟動路徑上，而是落在第一輪對話
+    deferred = []
+    if 'recorder' in components:
+        deferred.append(('voice_encoder', lambda: components['recorder'].encoder))
+    if 'stt' in components:
+        for backend in getattr(components['stt'], 'backends', []):
+            deferred.append((f'stt_{backend.name}', lambda backend=backend: backend.client.raw))
+    if 'classifier' in components:
+        deferred.append(('bedrock_client', lambda: components['classifier'].model_client.raw))
+        deferred.append(('lambda_client', lambda: components['classifier'].search_client.raw))
+    if 'tts' in components:
+        deferred.append(('polly_client', lambda: components['tts'].tts_client.raw))
+        deferred.append(('sounddevice', lambda: importlib.import_module('sounddevice')))
+    for name, fn in deferred:
+        _, first_use[name], error = _timed(fn)
+        if error:
+            errors[name] = error
+
+    if 'classifier' in components:
+        components['classifier'].close()  # 停止背景歷史寫入執行緒
+    return imports, inits, first_use, errors
+
+
+def load_budget(path=None):
+    with open(path or BUDGET_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def check_budget(report, budget):
+    """回傳超出預算的項目 [(項目, 實測毫秒, 預算毫秒)]"""
+    over = []
+    for section in ('import_ms', 'init_ms'):
+        for name, limit in budget.get(section, {}).items():
+            actual = report[section].get(name)
+            if actual is not None and actual > limit:
+                over.append((f'{section}.{name}', actual, limit))
+    limit = budget.get('startup_ms')
+    if limit is not None and report['startup_ms'] > limit:
+        over.append(('startup_ms', report['startup_ms'], limit))
+    return over
+
+
+def profile_startup(budget_path=None, isolated=True):
+    """量測冷啟動：各元件匯入時間 (含套件明細)、建構時間與延後的首次使用成本"""
+    report = {'timestamp': datetime.now().strftime('%Y%m%d_%H%M%S'), 'python': sys.version.split()[0]}
+
+    if isolated:
+        report['import_isolated'] = {}
+        for _, module, _ in COMPONENTS:
+            total, packages = importtime_breakdown(module)
+            report['import_isolated'][module] = {'total_ms': total, 'packages_ms': packages}
+
+    imports, inits, first_use, errors = profile_in_process()
+    report['import_ms'] = imports
+    report['init_ms'] = inits
+    report['first_use_ms'] = first_use
+    report['startup_ms'] = round(sum(imports.values()) + sum(inits.values()), 1)
+    report['errors'] = errors
+
+    budget = load_budget(budget_path)
+    report['over_budget'] = [{'item': item, 'actual_ms': actual, 'budget_ms': limit}
+                             for item, actual, limit in check_budget(report, budget)]
+    return report
+
+
+def print_report(report):
+    if 'import_isolated' in report:
+        print("各元件單獨匯入 (毫秒，含主要套件)：")
+        for module, data in report['import_isolated'].items():
+            total = '失敗' if data['total_ms'] is None else f"{data['total_ms']:.1f}"
+            packages = ', '.join(f'{name} {ms}' if isinstance(ms, float) else f'{name}: {ms}'
+                                 for name, ms in data['packages_ms'].items())
+            print(f"  {module:<34} {total:>8}  {packages}")
+
+    print("\n啟動路徑 (毫秒)：")
+    for module, ms in report['import_ms'].items():
+        print(f"  import {module:<34} {ms:>8.1f}")
+    for name, ms in report['init_ms'].items():
+        print(f"  init   {name:<34} {ms:>8.1f}")
+    print(f"  {'合計':<41} {report['startup_ms']:>8.1f}")
+
+    print("\n延後到第一次使用 (毫秒)：")
+    for name, ms in report['first_use_ms'].items():
+        print(f"  {name:<41} {ms:>8.1f}")
+
+    for name, error in report['errors'].items():
+        print(f"[Warning] {name}: {error}")
+    if report['over_budget']:
+        print("\n超出啟動預算：")
+        for item in report['over_budget']:
+            print(f"  {item['item']:<40} {item['actual_ms']:>8.1f} > {item['budget_ms']}")
+    else:
+        print("\n所有項目都在啟動預算內")
+
+
+def save_report(report, output=None):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = output or os.path.join(RESULTS_DIR, f"startup_{report['timestamp']}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return output
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="量測冷啟動時間並與預算比較")
+    parser.add_argument('--budget', default=None, help="啟動預算檔 (預設 assets/startup_budget.json)")
+    parser.add_argument('--no-isolated', action='store_true', help="不在子行程逐一量測各元件的匯入明細")
+    parser.add_argument('--save', action='store_true', help="將結果存到 data/benchmarks/startup_<時間>.json")
+    args = parser.parse_args(argv)
+
+    report = profile_startup(args.budget, isolated=not args.no_isolated)
+    print_report(report)
+    if args.save:
+        print(f"結果已保存至: {save_report(report)}")
+    return 1 if report['over_budget'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
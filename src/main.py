@@ -1,101 +1,156 @@
-from audio.recorder import AudioRecorder
-from audio.speech_to_text_test import SpeechToText
-from utils.command_classifier_claude import CommandClassifier
-from utils.text_to_speech_test import ResponseSpeaker
+from utils.tracing import start_metrics_server
 import os
-import json
-from datetime import datetime
+import signal
+import asyncio
+import argparse
+
+
+def create_assistant(barge_in_enabled=True):
+    """初始化所有組件 (元件模組在此才匯入，--profile-startup 等指令不必載入它們)"""
+    from audio.recorder import AudioRecorder
+    from audio.speech_to_text_test import SpeechToText
+    from utils.command_classifier_claude import CommandClassifier
+    from utils.text_to_speech_test import ResponseSpeaker
+    from utils.voice_pipeline import VoiceAssistant
 
-def main():
-    # 初始化所有組件
     recorder = AudioRecorder()
     transcriber = SpeechToText()
     classifier = CommandClassifier()
     speaker = ResponseSpeaker()
     
-    # 確保共用同一個speaker_db文件路徑
-    classifier.speaker_data_file = recorder.speaker_data_file
-    
+    # 播放期間持續收音，使用者插話時立即停止播放
+    barge_in = None
+    if barge_in_enabled and os.getenv('BARGE_IN', '1') == '1':
+        from audio.barge_in import BargeInDetector
+        barge_in = BargeInDetector(recorder, speaker)
+    return VoiceAssistant(recorder, transcriber, classifier, speaker, barge_in=barge_in)
+
+
+def run_compat(assistant):
+    """相容模式：一次處理一句，每輪結束後詢問是否繼續"""
     try:
         while True:
             print("\n等待語音輸入...")
-            # 等待語音輸入
-            if recorder.wait_for_speech():
-                # 錄製音頻並進行語者辨識
-                audio_file, speaker_id, similarity = recorder.record()
-                print(f"🎤 語者辨識 → ID: {speaker_id}，相似度: {similarity:.4f}")
-                
-                # 將recorder的speaker_db同步到classifier
-                classifier.speaker_db = recorder.speaker_db
-                
-                # 顯示識別結果和相似度
-                if similarity < recorder.similarity_threshold:
-                    print(f"⚠️ 相似度低於閾值 ({similarity:.2f} < {recorder.similarity_threshold})")
-                    print(f"✅ 已自動註冊為新用戶: {speaker_id}")
-                else:
-                    print(f"✅ 已識別為已知說話者: {speaker_id} (相似度 {similarity:.2f})")
-                
-                # 轉換為文字
-                transcript_text = transcriber.transcribe_file(audio_file)
-                
-                if transcript_text:
-                    print("\n識別結果：")
-                    print("-" * 50)
-                    print(f"文本: {transcript_text}")
-                    
-                    # 分類命令
-                    command_type = classifier.classify_command(transcript_text)
-                    print(f"命令類型: {command_type}")
-                    print("-" * 50)
-                    
-                    # 根據命令類型處理，並傳入語者ID以使用對話歷史
-                    if command_type == '聊天':
-                        # 傳入speaker_id以使用歷史對話
-                        response = classifier.chat_with_gemini(transcript_text, speaker_id)
-                        classifier.save_chat_history(transcript_text, response, command_type)
-                        print(f"\n聊天回應：\n{response}")
-                        
-                    elif command_type == '查詢':
-                        # 傳入speaker_id以使用歷史對話
-                        response = classifier.handle_query(transcript_text, speaker_id)
-                        classifier.save_query_history(transcript_text, response, command_type)
-                        print(f"\n查詢結果：\n{response}")
-                        
-                    elif command_type == '行動':
-                        # 傳入speaker_id以使用歷史對話
-                        response = classifier.handle_movement(transcript_text, speaker_id)
-                        classifier.save_movement_history(transcript_text, response, command_type)
-                        print("\n行動計劃：")
-                        print(json.dumps(response, ensure_ascii=False, indent=2))
-                    
-                    # 獲取最新的歷史記錄文件
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    history_file = None
-                    
-                    if command_type == '聊天':
-                        history_dir = os.path.join(os.path.dirname(__file__), '../data/chat_history')
-                        history_file = os.path.join(history_dir, f"chat_{timestamp}.json")
-                    elif command_type == '查詢':
-                        history_dir = os.path.join(os.path.dirname(__file__), '../data/query_history')
-                        history_file = os.path.join(history_dir, f"query_{timestamp}.json")
-                    elif command_type == '行動':
-                        history_dir = os.path.join(os.path.dirname(__file__), '../data/movement_history')
-                        history_file = os.path.join(history_dir, f"movement_{timestamp}.json")
-                    
-                    # 播放語音回應
-                    if history_file and os.path.exists(history_file):
-                        print("\n正在生成語音回應...")
-                        speaker.process_history_file(history_file)
-                
-                # 詢問是否繼續
-                response = input("\n是否繼續錄音? (y/n): ")
-                if response.lower() != 'y':
-                    break
-    
+            assistant.run_turn()
+
+            # 詢問是否繼續
+            response = input("\n是否繼續錄音? (y/n): ")
+            if response.lower() != 'y':
+                break
+
     except KeyboardInterrupt:
         print("\n程序已終止")
     except Exception as e:
         print(f"發生錯誤: {str(e)}")
+    finally:
+        assistant.close()
+        print_latency_summary(assistant)
+
+
+def print_latency_summary(assistant):
+    """列出各階段延遲統計 (秒)"""
+    summary = assistant.tracer.summary()
+    if not summary:
+        return
+    print("\n各階段延遲 (秒)：")
+    for name, stats in sorted(summary.items(), key=lambda item: -item[1]['avg']):
+        print(f"  {name:<20} 次數 {stats['count']:>4}  p50 {stats['p50']:.3f}  "
+              f"p95 {stats['p95']:.3f}  p99 {stats['p99']:.3f}")
+    print(f"追蹤記錄已保存至: {assistant.tracer.trace_file}")
+
+
+async def run_pipelined(assistant, source=None, sink=None, speak=True, daemon=False):
+    """管線模式：第一次 Ctrl+C 停止收音並處理完在途語音，第二次立即取消
+
+    daemon 模式下 SIGTERM 也會觸發平順停止，適合以系統服務方式執行。
+    """
+    loop = asyncio.get_running_loop()
+    assistant.build_pipeline(speak=speak, sink=sink)
+    task = asyncio.ensure_future(assistant.run(source))
+
+    def on_interrupt():
+        if assistant.stop_event.is_set():
+            print("\n立即終止")
+            task.cancel()
+        else:
+            print("\n停止收音，等待處理中的語音完成 (再按一次 Ctrl+C 立即終止)")
+            assistant.stop()
+
+    try:
+        loop.add_signal_handler(signal.SIGINT, on_interrupt)
+        if daemon:
+            loop.add_signal_handler(signal.SIGTERM, on_interrupt)
+    except NotImplementedError:
+        # Windows 不支援 add_signal_handler，維持預設的 KeyboardInterrupt
+        pass
+
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        assistant.stop()
+        if assistant.barge_in is not None and assistant.barge_in.reaction_times:
+            print(f"插話反應時間統計: {assistant.barge_in.stats()}")
+        if sink is not None:
+            print(f"處理統計: {sink.summary()}，結果已保存至: {sink.path}")
+            sink.close()
+        assistant.close()
+        print_latency_summary(assistant)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="語音指令辨識與語音回應系統")
+    parser.add_argument('--compat', action='store_true',
+                        help="相容模式：依序處理每一句並在每輪後詢問是否繼續")
+    parser.add_argument('--daemon', action='store_true',
+                        help="常駐模式：無互動提示，持續運作，SIGTERM 時處理完在途語音後結束")
+    parser.add_argument('--input', default='mic',
+                        help="輸入來源：mic、dir:PATH (WAV 資料夾)、stdin (原始 PCM)、tcp:HOST:PORT")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="重播速度：1 為即時，4 為四倍速，0 為不等待")
+    parser.add_argument('--sink', default=None,
+                        help="結果輸出的 JSONL 路徑 (daemon 模式預設寫入 data/results/)")
+    parser.add_argument('--mute', action='store_true', help="不播放語音回應")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="提供 Prometheus /metrics 的連接埠 (預設讀取 METRICS_PORT，未設定則不啟動)")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="量測各元件的匯入與初始化時間並與 assets/startup_budget.json 比較後結束")
+    args = parser.parse_args()
+    if args.compat and args.input != 'mic':
+        parser.error("--compat 只支援麥克風輸入；重播其他來源請改用管線模式 (不加 --compat)")
+
+    if args.profile_startup:
+        from benchmark.startup_profile import main as profile_main
+        raise SystemExit(profile_main(['--save']))
+
+    live_input = args.input == 'mic'
+    assistant = create_assistant(barge_in_enabled=live_input and not args.mute)
+    assistant.register_metrics()
+    # 聲紋模型與後端客戶端延後載入；在背景預先載入，等待第一句話時就緒
+    assistant.warm_up()
+    start_metrics_server(args.metrics_port)
+    if args.compat:
+        run_compat(assistant)
+        return
+
+    source = None
+    if not live_input:
+        from audio.input_adapters import open_source
+        source = assistant.replay(open_source(args.input, speed=args.speed, stop_event=assistant.stop_event))
+
+    sink = None
+    if args.sink or args.daemon:
+        from utils.result_sink import JsonlSink
+        sink = JsonlSink(args.sink)
+
+    try:
+        asyncio.run(run_pipelined(assistant, source=source, sink=sink,
+                                  speak=not args.mute, daemon=args.daemon))
+    except KeyboardInterrupt:
+        print("\n程序已終止")
+    print("程序已結束")
+
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
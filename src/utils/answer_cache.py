@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from utils.text_similarity import normalize_text, embed_text, cosine_similarity
+from utils.log import get_logger
+
+logger = get_logger("answer_cache")
+
+
+# 依主題決定答案的新鮮度 (秒)；依序比對，第一個符合的關鍵字決定類別
+# TTL 為 0 的類別 (時間、日期等隨時在變的問題) 不寫入快取
+FRESHNESS_CLASSES = [
+    ("weather", ["天氣", "氣溫", "下雨", "降雨", "溫度", "颱風", "空氣品質"], 30 * 60),
+    ("news", ["新聞", "頭條", "最新", "股價", "股市", "匯率", "比分"], 60 * 60),
+    ("realtime", ["幾點", "時間", "現在", "今天", "今日", "明天", "昨天", "幾號", "日期", "星期幾", "禮拜幾"], 0),
+    ("places", ["附近", "餐廳", "店", "美食", "地址", "怎麼去", "在哪"], 7 * 24 * 60 * 60),
+]
+DEFAULT_CLASS = ("general", 24 * 60 * 60)
+
+
+class AnswerCache:
+    """查詢答案的語意快取：以正規化文字 + 本地向量相似度為鍵，具備主題 TTL、LRU 淘汰與磁碟持久化。
+
+    相似度以字元 n-gram 計算，預設門檻 0.9 (ANSWER_CACHE_SIM) 幾乎只接受相同的問題：
+    「行天宮附近的披薩店」與「…有哪些」約 0.85、「…推薦」約 0.89，都不會命中；
+    但只差一個地名字的長句 (「故宮南部院區…」vs「北部院區…」) 也可達 0.87，
+    因此不建議調低到 0.85 以下，以免把不同地點的答案互用。
+    """
+
+    def __init__(self, cache_file=None, max_entries=None, similarity_threshold=None):
+        self.cache_file = cache_file or os.path.join(
+            os.path.dirname(__file__), '../../data/query_cache/answer_cache.json')
+        self.max_entries = int(max_entries or os.getenv('ANSWER_CACHE_SIZE', 256))
+        self.similarity_threshold = float(similarity_threshold or os.getenv('ANSWER_CACHE_SIM', 0.9))
+
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # normalized_text -> entry，越後面越新
+        self._vectors = {}
+        self._load()
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _load(self):
+        """從磁碟載入快取並丟棄已過期的項目"""
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except Exception as e:
+            logger.warning(f"載入查詢快取失敗: {e}，將重新建立。")
+            return
+        now = time.time()
+        for entry in entries:
+            if entry['expires_at'] > now:
+                key = normalize_text(entry['query'])
+                self._entries[key] = entry
+                self._vectors[key] = embed_text(entry['query'])
+
+    def _save(self):
+        """以暫存檔 + 取代的方式寫入快取"""
+        with self._lock:
+            data = json.dumps(list(self._entries.values()), ensure_ascii=False, indent=2)
+        tmp_path = self.cache_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.cache_file)
+
+    def _evict(self, key):
+        self._entries.pop(key, None)
+        self._vectors.pop(key, None)
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    @staticmethod
+    def freshness_class(query):
+        """回傳 (類別名稱, TTL 秒數)"""
+        for name, keywords, ttl in FRESHNESS_CLASSES:
+            if any(keyword in query for keyword in keywords):
+                return name, ttl
+        return DEFAULT_CLASS
+
+    def lookup(self, query):
+        """尋找語意相近且未過期的答案，找不到回傳 None"""
+        key = normalize_text(query)
+        if not key:
+            return None
+        topic, _ = self.freshness_class(query)
+        now = time.time()
+
+        with self._lock:
+            best_key, best_sim = None, 0.0
+            if key in self._entries:
+                best_key, best_sim = key, 1.0
+            else:
+                vector = embed_text(query)
+                for cached_key, cached_vector in self._vectors.items():
+                    # 不同主題的答案不可互用 (例如天氣 vs 店家)
+                    if self._entries[cached_key]['topic'] != topic:
+                        continue
+                    sim = cosine_similarity(vector, cached_vector)
+                    if sim > best_sim:
+                        best_key, best_sim = cached_key, sim
+
+            if best_key is None or best_sim < self.similarity_threshold:
+                return None
+            entry = self._entries[best_key]
+            if entry['expires_at'] <= now:
+                self._evict(best_key)
+                return None
+            self._entries.move_to_end(best_key)
+            entry['hits'] = entry.get('hits', 0) + 1
+
+        logger.info(f"查詢快取命中 ({entry['topic']}, 相似度 {best_sim:.2f}): {entry['query']}")
+        return entry['response']
+
+    def store(self, query, response):
+        """儲存查詢答案；超出容量時淘汰最久未使用的項目，不可快取的主題直接略過"""
+        key = normalize_text(query)
+        if not key or not response:
+            return
+        topic, ttl = self.freshness_class(query)
+        if ttl <= 0:
+            return
+        now = time.time()
+
+        with self._lock:
+            self._evict(key)
+            self._entries[key] = {
+                'query': query,
+                'response': response,
+                'topic': topic,
+                'created_at': datetime.now().isoformat(),
+                'expires_at': now + ttl,
+                'hits': 0
+            }
+            self._vectors[key] = embed_text(query)
+            while len(self._entries) > self.max_entries:
+                oldest_key = next(iter(self._entries))
+                self._evict(oldest_key)
+        self._save()
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
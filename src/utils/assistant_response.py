@@ -0,0 +1,87 @@
+import re
+import uuid
+from datetime import datetime
+
+
+# 命令類型 -> 歷史記錄種類 (決定存放的資料夾與檔名前綴)
+HISTORY_KINDS = {'聊天': 'chat', '查詢': 'query', '行動': 'movement'}
+
+_SENTENCE_END = re.compile(r'(?<=[。！？!?；;\n])')
+
+
+def split_sentences(text, min_chars=6):
+    """依句號、問號、驚嘆號、分號與換行切句；過短的句子併入下一句，避免零碎的合成請求"""
+    segments, buffer = [], ""
+    for part in _SENTENCE_END.split(text or ""):
+        buffer += part
+        if len(buffer.strip()) >= min_chars:
+            segments.append(buffer.strip())
+            buffer = ""
+    if buffer.strip():
+        if segments and len(buffer.strip()) < min_chars:
+            segments[-1] += buffer.strip()
+        else:
+            segments.append(buffer.strip())
+    return segments
+
+
+class AssistantResponse:
+    """處理完一個命令後的回應：直接交給語音輸出，歷史記錄另外非同步保存
+
+    Args:
+        command: 使用者的原始指令文字
+        command_type: 命令類型 (聊天 / 查詢 / 行動)
+        content: 回應內容；聊天與查詢為文字，行動為 {"動作順序": [...], "說明": [...]}
+        speaker_id: 說話者 ID (可選)
+    """
+
+    def __init__(self, command, command_type, content, speaker_id=None, timestamp=None):
+        self.response_id = uuid.uuid4().hex[:8]
+        self.command = command
+        self.command_type = command_type
+        self.content = content
+        self.speaker_id = speaker_id
+        self.timestamp = timestamp or datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    @property
+    def history_kind(self):
+        return HISTORY_KINDS.get(self.command_type, 'chat')
+
+    @property
+    def is_movement(self):
+        return isinstance(self.content, dict)
+
+    @property
+    def speech_text(self):
+        """要念給使用者聽的文字"""
+        if self.is_movement:
+            return "\n".join(self.content.get('說明', []))
+        return self.content or ""
+
+    @property
+    def speech_segments(self):
+        """分段念出的文字：行動計劃每個步驟一段，其他回應每句一段"""
+        if self.is_movement:
+            return [step for step in self.content.get('說明', []) if step]
+        return split_sentences(self.content)
+
+    def to_history_record(self):
+        """轉為與既有歷史記錄檔相同格式的字典"""
+        record = {
+            "timestamp": self.timestamp,
+            "command": self.command,
+            ("movement_plan" if self.history_kind == 'movement' else "response"): self.content,
+            "command_type": self.command_type
+        }
+        return record
+
+    @classmethod
+    def from_history_record(cls, data):
+        """從歷史記錄檔內容還原回應"""
+        if 'movement_plan' in data:  # movement_history
+            content = data['movement_plan']
+        elif 'response' in data:  # chat_history 或 query_history
+            content = data['response']
+        else:
+            raise ValueError("不支援的文件格式")
+        return cls(data.get('command', ''), data.get('command_type', ''), content, timestamp=data.get('timestamp'))
@@ -0,0 +1,285 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.log import get_logger
+
+logger = get_logger("backend")
+
+
+# 可重試的 AWS 錯誤代碼 (節流、暫時性服務錯誤)
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException",
+    "InternalServerException", "ModelTimeoutException", "ModelNotReadyException",
+    "RequestTimeout", "RequestTimeoutException", "ServiceUnavailable", "Throttling",
+}
+
+
+class BackendError(Exception):
+    """後端呼叫在重試後仍失敗"""
+
+
+class BackendTimeoutError(BackendError):
+    """後端呼叫超過期限"""
+
+
+class CallPolicy:
+    """單一後端的呼叫策略，預設值可用環境變數 <PREFIX>_TIMEOUT 等覆寫"""
+
+    def __init__(self, prefix="MODEL", deadline=30.0, attempt_timeout=15.0, max_retries=2,
+                 base_delay=0.2, max_delay=2.0, max_concurrency=4, hedge=False, hedge_delay=2.0,
+                 idempotent=True):
+        def env(name, default, cast=float):
+            return cast(os.getenv(f"{prefix}_{name}", default))
+
+        self.deadline = env("DEADLINE", deadline)                    # 整體期限 (含重試)
+        self.attempt_timeout = env("TIMEOUT", attempt_timeout)       # 單次嘗試期限
+        self.max_retries = env("MAX_RETRIES", max_retries, int)
+        self.base_delay = env("BACKOFF_BASE", base_delay)
+        self.max_delay = env("BACKOFF_MAX", max_delay)
+        self.max_concurrency = env("MAX_CONCURRENCY", max_concurrency, int)
+        self.hedge = env("HEDGE", "1" if hedge else "0", str) == "1"
+        self.hedge_delay = env("HEDGE_DELAY", hedge_delay)          # 樣本不足時的避險延遲
+        # 非冪等的呼叫逾時後不重試：逾時只代表不再等待，請求可能仍在後端執行
+        self.idempotent = env("IDEMPOTENT", "1" if idempotent else "0", str) == "1"
+
+
+class AsyncRuntime:
+    """在背景執行緒中常駐的 asyncio 事件迴圈，讓同步程式碼也能使用非同步客戶端"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="async-runtime", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def submit(self, coro):
+        """提交協程，回傳 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """阻塞等待協程完成；不可在事件迴圈執行緒內呼叫"""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("AsyncRuntime.run 不可在事件迴圈執行緒中呼叫")
+        return self.submit(coro).result()
+
+
+def is_retryable(error):
+    """判斷錯誤是否值得重試：逾時、連線錯誤、節流與 5xx"""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, TimeoutError)):
+        return True
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code", "")
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return code in RETRYABLE_ERROR_CODES or status >= 500 or status == 429
+    # botocore 的 EndpointConnectionError / ReadTimeoutError 等沒有 response
+    return type(error).__name__ in ("EndpointConnectionError", "ConnectTimeoutError",
+                                    "ReadTimeoutError", "ConnectionClosedError")
+
+
+def is_ambiguous(error):
+    """請求可能已送達後端 (逾時、讀取中斷)，無法確定是否已執行"""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return True
+    return type(error).__name__ in ("ReadTimeoutError", "ConnectionClosedError")
+
+
+class AsyncBackendClient:
+    """包裝阻塞式後端呼叫：期限、並行上限、指數退避 + 抖動、選擇性避險請求"""
+
+    def __init__(self, name, raw_client=None, policy=None, raw_factory=None):
+        self.name = name
+        # 底層客戶端可延後到第一次使用時才建立 (匯入 boto3 與建立客戶端約需數百毫秒)
+        self._raw = raw_client
+        self._raw_factory = raw_factory
+        self._raw_lock = threading.Lock()
+        self.policy = policy or CallPolicy(prefix=name.upper())
+        # 專用執行緒池：卡住的請求不會佔滿預設執行緒池
+        self._executor = ThreadPoolExecutor(max_workers=self.policy.max_concurrency * 2,
+                                            thread_name_prefix=f"{name}-call")
+        self._semaphore = None
+        self._latencies = deque(maxlen=200)
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "timeouts": 0, "failures": 0}
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.policy.max_concurrency)
+        return self._semaphore
+
+    def _backoff(self, attempt):
+        """Full jitter：在 [0, min(max_delay, base * 2^attempt)] 之間隨機等待"""
+        return random.uniform(0, min(self.policy.max_delay, self.policy.base_delay * (2 ** attempt)))
+
+    def _hedge_delay(self):
+        """累積足夠樣本後以 p95 延遲作為發出第二個請求的時機"""
+        if len(self._latencies) < 20:
+            return self.policy.hedge_delay
+        return self.percentile(0.95)
+
+    async def _attempt(self, fn, args, kwargs, timeout):
+        """執行單次嘗試並記錄延遲
+
+        逾時或被取消時只是不再等待，執行緒中的請求仍會跑完；並行名額在請求真正結束時才釋放，
+        因此 max_concurrency 限制的是實際進行中的請求數
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = self._get_semaphore()
+        await semaphore.acquire()
+        try:
+            future = loop.run_in_executor(self._executor, lambda: fn(*args, **kwargs))
+        except BaseException:
+            semaphore.release()
+            raise
+
+        def finished(done):
+            semaphore.release()
+            if not done.cancelled():
+                done.exception()  # 已放棄等待的請求失敗時不另外報錯
+
+        future.add_done_callback(finished)
+        start = time.perf_counter()
+        result = await asyncio.wait_for(asyncio.shield(future), timeout)
+        self._latencies.append(time.perf_counter() - start)
+        return result
+
+    async def _hedged_attempt(self, fn, args, kwargs, timeout):
+        """先送出一個請求，若超過 p95 仍未完成再送出第二個，取先成功者並取消其餘"""
+        primary = asyncio.ensure_future(self._attempt(fn, args, kwargs, timeout))
+        done, _ = await asyncio.wait({primary}, timeout=self._hedge_delay())
+        if done:
+            return primary.result()
+
+        self.stats["hedges"] += 1
+        backup = asyncio.ensure_future(self._attempt(fn, args, kwargs, timeout))
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    @property
+    def raw(self):
+        """底層客戶端 (例如 boto3 client)，第一次存取時才建立"""
+        if self._raw is None and self._raw_factory is not None:
+            with self._raw_lock:
+                if self._raw is None:
+                    self._raw = self._raw_factory()
+        return self._raw
+
+    @raw.setter
+    def raw(self, client):
+        self._raw = client
+
+    @property
+    def initialized(self):
+        return self._raw is not None
+
+    def percentile(self, q):
+        """回傳最近呼叫延遲的分位數 (秒)"""
+        if not self._latencies:
+            return 0.0
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    async def call(self, fn, *args, deadline=None, hedge=None, **kwargs):
+        """在期限內呼叫阻塞函式 fn，失敗時以指數退避重試
+
+        Args:
+            fn: 實際執行請求 (含讀取回應內容) 的阻塞函式
+            deadline: 整體期限秒數，預設使用 policy.deadline
+            hedge: 是否啟用避險請求，預設使用 policy.hedge
+        """
+        self.stats["calls"] += 1
+        deadline = deadline or self.policy.deadline
+        hedge = self.policy.hedge if hedge is None else hedge
+        end_time = time.monotonic() + deadline
+        last_error = None
+
+        for attempt in range(self.policy.max_retries + 1):
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                break
+            timeout = min(self.policy.attempt_timeout, remaining)
+            try:
+                if hedge:
+                    return await self._hedged_attempt(fn, args, kwargs, timeout)
+                return await self._attempt(fn, args, kwargs, timeout)
+            except Exception as e:
+                last_error = e
+                if isinstance(e, asyncio.TimeoutError):
+                    self.stats["timeouts"] += 1
+                if not is_retryable(e) or attempt == self.policy.max_retries:
+                    break
+                if not self.policy.idempotent and is_ambiguous(e):
+                    # 前一次請求可能仍在執行，重試會重複執行非冪等的操作
+                    break
+                self.stats["retries"] += 1
+                delay = min(self._backoff(attempt), max(0.0, end_time - time.monotonic()))
+                logger.warning(f"{self.name} 呼叫失敗 ({type(e).__name__})，{delay:.2f} 秒後重試")
+                await asyncio.sleep(delay)
+
+        self.stats["failures"] += 1
+        if last_error is None or isinstance(last_error, asyncio.TimeoutError):
+            raise BackendTimeoutError(f"{self.name} 呼叫超過期限 {deadline:.1f} 秒")
+        raise BackendError(f"{self.name} 呼叫失敗: {last_error}") from last_error
+
+    def call_sync(self, fn, *args, **kwargs):
+        """同步版本的 call，在共用的背景事件迴圈上執行"""
+        return AsyncRuntime.get().run(self.call(fn, *args, **kwargs))
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
+
+
+def make_boto_client(service_name, policy, region_name=None, endpoint_env=None):
+    """建立 boto3 客戶端：關閉 botocore 內建重試 (由 AsyncBackendClient 負責)，
+    並允許以環境變數指定 endpoint_url 連到本地 stub 伺服器"""
+    import boto3
+    from botocore.config import Config
+
+    config = Config(
+        connect_timeout=min(5.0, policy.attempt_timeout),
+        read_timeout=policy.attempt_timeout,
+        retries={"max_attempts": 1, "mode": "standard"},
+        max_pool_connections=policy.max_concurrency * 2,
+    )
+    return boto3.client(
+        service_name,
+        region_name=region_name or os.getenv('AWS_REGION', 'us-west-2'),
+        endpoint_url=os.getenv(endpoint_env) if endpoint_env else None,
+        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+        config=config,
+    )
+
+
+def create_backend_client(name, service_name, region_name=None, **policy_defaults):
+    """建立具備期限與重試策略的後端客戶端
+
+    環境變數 <NAME>_ENDPOINT_URL 可將請求導向本地 stub 伺服器以便測試。
+    """
+    policy = CallPolicy(prefix=name.upper(), **policy_defaults)
+    return AsyncBackendClient(
+        name, policy=policy,
+        raw_factory=lambda: make_boto_client(service_name, policy, region_name,
+                                             endpoint_env=f"{name.upper()}_ENDPOINT_URL"))
@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import glob
+import hashlib
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.command_classifier_claude import CommandClassifier
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '../../data')
+DEFAULT_SOURCES = ['transcripts', 'chat_history', 'query_history', 'movement_history']
+COLUMNS = ['source', 'file', 'text', 'original_type', 'command_type', 'model_id', 'examples_version', 'classified_at']
+
+
+def iter_records(sources=None, data_dir=DATA_DIR):
+    """逐筆從磁碟串流歷史記錄，每次只讀一個檔案"""
+    for source in sources or DEFAULT_SOURCES:
+        for path in sorted(glob.glob(os.path.join(data_dir, source, '*.json'))):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except Exception as e:
+                print(f"[Warning] 無法讀取 {path}: {e}")
+                continue
+
+            if 'transcript' in data:
+                texts = [data['transcript']]
+            elif 'transcripts' in data:  # 舊版 Google STT 格式
+                texts = [item.get('text', '') for item in data['transcripts']]
+            else:
+                texts = [data.get('command', '')]
+
+            for index, text in enumerate(texts):
+                if text:
+                    yield {
+                        'key': f"{source}/{os.path.basename(path)}#{index}",
+                        'source': source,
+                        'file': os.path.basename(path),
+                        'text': text,
+                        'original_type': data.get('command_type', '')
+                    }
+
+
+def _batched(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _ColumnarWriter:
+    """逐批寫入欄式檔案：優先寫 Parquet (每累積 row_group_size 筆寫成一個 row group)，
+    未安裝 pyarrow 時退回 CSV；記憶體中最多保留一個 row group"""
+
+    def __init__(self, output_base, row_group_size=1000):
+        self.row_group_size = row_group_size
+        self._buffer = []
+        self.count = 0
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            import csv
+            print("[Warning] 未安裝 pyarrow，改為輸出 CSV")
+            self.path = output_base + '.csv'
+            self._file = open(self.path, 'w', encoding='utf-8', newline='')
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(COLUMNS)
+            self._parquet = None
+            return
+        self.path = output_base + '.parquet'
+        self._pa = pa
+        self._parquet = pq.ParquetWriter(self.path, pa.schema([(name, pa.string()) for name in COLUMNS]))
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        columns = {name: [str(row.get(name, '')) for row in self._buffer] for name in COLUMNS}
+        self._parquet.write_table(self._pa.table(columns))
+        self._buffer = []
+
+    def write(self, rows):
+        for row in rows:
+            self.count += 1
+            if self._parquet is None:
+                self._csv.writerow([row.get(name, '') for name in COLUMNS])
+                continue
+            self._buffer.append(row)
+            if len(self._buffer) >= self.row_group_size:
+                self._flush()
+
+    def close(self):
+        if self._parquet is None:
+            self._file.close()
+        else:
+            self._flush()
+            self._parquet.close()
+
+
+class BatchClassifier:
+    """離線批次重新分類：有限並行、每個提示詞分類多句、可中斷續跑，結果寫入欄式檔案"""
+
+    def __init__(self, classifier=None, output_dir=None, batch_size=8, max_workers=4):
+        self.classifier = classifier or CommandClassifier()
+        self.output_dir = output_dir or os.path.join(DATA_DIR, 'reclassified')
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        # 標記版本：分類範例或模型改變時，使用新的檢查點與輸出檔
+        examples = json.dumps(self.classifier.reference_data, ensure_ascii=False, sort_keys=True)
+        self.examples_version = hashlib.sha1(examples.encode('utf-8')).hexdigest()[:12]
+        run_id = hashlib.sha1(f"{self.classifier.model_id}:{self.examples_version}".encode('utf-8')).hexdigest()[:12]
+        self.checkpoint_file = os.path.join(self.output_dir, f"checkpoint_{run_id}.jsonl")
+        self.output_base = os.path.join(self.output_dir, f"labels_{run_id}")
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _iter_checkpoint(self):
+        """逐筆讀取已完成的記錄，用於續跑"""
+        if not os.path.exists(self.checkpoint_file):
+            return
+        with open(self.checkpoint_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # 中斷時寫到一半的最後一行
+                    continue
+
+    def _classify(self, batch):
+        """分類一個批次；模型調用失敗的記錄 (標籤為 None) 不回傳，保留到下次續跑"""
+        labels = self.classifier.classify_batch([record['text'] for record in batch])
+        classified_at = datetime.now().isoformat()
+        rows = [
+            dict(record, command_type=label, model_id=self.classifier.model_id,
+                 examples_version=self.examples_version, classified_at=classified_at)
+            for record, label in zip(batch, labels) if label is not None
+        ]
+        return rows, len(batch) - len(rows)
+
+    def _drain(self, future, checkpoint, writer):
+        """取得批次結果並立即寫入檢查點與輸出檔"""
+        results, failed = future.result()
+        self.failed += failed
+        for row in results:
+            checkpoint.write(json.dumps(row, ensure_ascii=False) + "\n")
+        checkpoint.flush()
+        writer.write(results)
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    def run(self, sources=None):
+        """分類所有尚未處理的記錄並輸出欄式檔案，回傳輸出路徑
+
+        記錄逐批寫出，不在記憶體中累積；續跑時先從檢查點串流寫出已完成的記錄。
+        模型調用失敗的記錄不寫入檢查點與輸出檔，下次執行時重新分類。
+        """
+        writer = _ColumnarWriter(self.output_base)
+        self.failed = 0
+        done = set()
+        try:
+            for row in self._iter_checkpoint():
+                done.add(row['key'])
+                writer.write([row])
+            pending = (record for record in iter_records(sources) if record['key'] not in done)
+            if done:
+                print(f"[Info] 從檢查點續跑，已完成 {len(done)} 筆")
+
+            with open(self.checkpoint_file, 'a', encoding='utf-8') as checkpoint, \
+                    ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                # 一次只提交有限數量的批次，避免把整個資料集載入記憶體
+                in_flight = []
+                for batch in _batched(pending, self.batch_size):
+                    in_flight.append(executor.submit(self._classify, batch))
+                    if len(in_flight) >= self.max_workers * 2:
+                        self._drain(in_flight.pop(0), checkpoint, writer)
+                for future in in_flight:
+                    self._drain(future, checkpoint, writer)
+        finally:
+            writer.close()
+
+        print(f"[Info] 已分類 {writer.count} 筆記錄，結果已保存至: {writer.path}")
+        if self.failed:
+            print(f"[Warning] {self.failed} 筆因模型調用失敗未分類，未寫入檢查點，再次執行即可重試")
+        return writer.path
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批次重新分類歷史語音記錄")
+    parser.add_argument('--sources', nargs='+', default=DEFAULT_SOURCES, help="要處理的 data/ 子目錄")
+    parser.add_argument('--batch-size', type=int, default=8, help="每個提示詞分類的句數")
+    parser.add_argument('--workers', type=int, default=4, help="同時進行的模型請求數")
+    parser.add_argument('--output-dir', default=None, help="輸出目錄 (預設 data/reclassified)")
+    args = parser.parse_args()
+
+    runner = BatchClassifier(output_dir=args.output_dir, batch_size=args.batch_size, max_workers=args.workers)
+    runner.run(args.sources)
+
+
+if __name__ == "__main__":
+    main()
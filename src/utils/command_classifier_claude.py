@@ -1,32 +1,59 @@
 import os
+import sys
 import json
-import boto3
 from dotenv import load_dotenv
 from datetime import datetime
-import requests
-import pickle
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.conversation_summarizer import ConversationSummarizer
+from utils.prompt_registry import PromptRegistry, cached_system_blocks
+from utils.answer_cache import AnswerCache
+from utils.plan_library import PlanLibrary
+from utils.plan_validator import PlanValidator
+from utils.async_clients import create_backend_client, BackendTimeoutError
+from utils.tracing import traced
+from utils.assistant_response import AssistantResponse
+from utils.history_writer import HistoryWriter
+from utils.log import get_logger, log_payload, shorten
 
 
 # 加载环境变量
 load_dotenv(os.path.join(os.path.dirname(__file__), '../config/.env'))
 
+logger = get_logger("classifier")
+
+# 模型調用失敗時 _send_to_model 的回覆
+MODEL_ERROR_RESPONSE = "無法獲取模型回應"
+
 class CommandClassifier:
     def __init__(self):
-        # 設置 AWS Bedrock 客戶端
-        self.client = boto3.client(
-            service_name="bedrock-runtime",
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.getenv('AWS_REGION', 'us-west-2')
-        )
+        # 設置 AWS Bedrock 客戶端 (含期限、並行上限與重試策略)
+        # boto3 客戶端在第一次呼叫時才建立，縮短啟動時間
+        self.model_client = create_backend_client("bedrock", "bedrock-runtime")
+        
+        # 查詢用的 Lambda 搜尋客戶端；query4 未確認為冪等，不送避險請求，逾時後也不重試 (重複呼叫)
+        self.search_client = create_backend_client("lambda", "lambda", region_name='us-west-2', idempotent=False)
         
         # 設置模型 ID
         self.model_id = "anthropic.claude-3-5-sonnet-20241022-v2:0"
         
-        # 加载参考数据
-        json_path = os.path.join(os.path.dirname(__file__), '../../assets/command_type.json')
-        with open(json_path, 'r', encoding='utf-8') as f:
-            self.reference_data = json.load(f)
+        # 提示詞模板：靜態部分只渲染一次，資產檔變動時自動重新載入
+        self.enable_prompt_cache = os.getenv('BEDROCK_PROMPT_CACHE', '1') == '1'
+        self.prompts = PromptRegistry()
+        self.prompts.register('classify_system', 'command_type.json', self._render_classify_system)
+        self.prompts.register('classify_batch_system', 'command_type.json', self._render_classify_batch_system)
+        self.prompts.register('movement_system', 'movement_deployment.json', self._render_movement_system)
+        
+        # 已驗證動作計劃庫，相近任務不需再請模型拆解；合法動作代號在使用時才從註冊表取得 (見 action_codes)
+        self.plan_library = PlanLibrary(
+            seed_tasks=self.prompts.get_data('movement_system')['任務拆解'],
+            action_codes=lambda: self.action_codes
+        )
+        self.plan_validator = PlanValidator(lambda: self.action_codes)
+        self.max_plan_repairs = int(os.getenv('PLAN_MAX_REPAIRS', 1))
+        
+        # 查詢答案的語意快取，命中時跳過搜尋與摘要
+        self.answer_cache = AnswerCache()
         
         # 定义可用的函数
         self.available_functions = [{
@@ -44,7 +71,27 @@ class CommandClassifier:
         os.makedirs(self.speaker_db_path, exist_ok=True)
         self.speaker_data_file = os.path.join(self.speaker_db_path, 'speaker_data.json')
         self.speaker_db = self._load_speaker_db()
+        # 多個工作者 / 連線同時保存對話時保護資料庫；與 AudioRecorder 共用資料庫時改用其 db_lock (見 VoiceAssistant)
+        self.db_lock = threading.RLock()
+        # 歷史記錄與資料庫寫檔在背景進行，不佔用回應路徑
+        self.history_writer = HistoryWriter()
+        
+        # 背景滾動摘要：歷史對話以「摘要 + 最近幾輪」送入模型
+        self.summarizer = ConversationSummarizer(
+            summarize_fn=self._send_to_model,
+            summary_file=os.path.join(self.speaker_db_path, 'conversation_summaries.json')
+        )
         
+    @property
+    def reference_data(self):
+        """分類參考示例；每次從模板註冊表取得，資產檔重新載入後即為新內容"""
+        return self.prompts.get_data('classify_system')
+    
+    @property
+    def action_codes(self):
+        """動作清單中的合法代號；每次從模板註冊表取得，資產檔重新載入後即為新清單"""
+        return self.prompts.get_data('movement_system')['動作清單'].keys()
+    
     def _load_speaker_db(self):
         """從 JSON 文件載入說話者數據庫"""
         if os.path.exists(self.speaker_data_file):
@@ -52,79 +99,154 @@ class CommandClassifier:
                 with open(self.speaker_data_file, 'r', encoding='utf-8') as f:
                     return json.load(f)
             except Exception as e:
-                print(f"載入說話者數據庫出錯: {e}，重新建立空庫")
+                logger.warning(f"載入說話者數據庫出錯: {e}，重新建立空庫")
         return {'speakers': {}}
     
     def _save_speaker_db(self):
-        """將說話者數據庫寫入 JSON 文件"""
-        with open(self.speaker_data_file, 'w', encoding='utf-8') as f:
-            json.dump(self.speaker_db, f, ensure_ascii=False, indent=2)
+        """將說話者數據庫寫入 JSON 文件 (暫存檔 + 取代，避免寫到一半的檔案)"""
+        with self.db_lock:
+            tmp_path = self.speaker_data_file + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.speaker_db, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.speaker_data_file)
     
     def save_conversation(self, speaker_id, query, response, command_type):
         """保存對話到說話者歷史記錄，儲存於 JSON 文件中"""
         
         if speaker_id:
-            # 如果speaker_id不存在於數據庫中，創建一個新記錄
-            if speaker_id not in self.speaker_db.get('speakers', {}):
-                self.speaker_db['speakers'][speaker_id] = {
-                    'created_at': datetime.now().isoformat(),
-                    'conversations': [],
-                    'embeddings': []  # 添加embeddings字段
-                }
-                print(f"[Info] 在CommandClassifier中創建新用戶: {speaker_id}")
+            with self.db_lock:
+                # 如果speaker_id不存在於數據庫中，創建一個新記錄
+                if speaker_id not in self.speaker_db.get('speakers', {}):
+                    self.speaker_db['speakers'][speaker_id] = {
+                        'created_at': datetime.now().isoformat(),
+                        'conversations': [],
+                        'embeddings': []  # 添加embeddings字段
+                    }
+                    logger.info(f"在CommandClassifier中創建新用戶: {speaker_id}")
                 
-            conv = {
-                'timestamp': datetime.now().isoformat(),
-                'query': query,
-                'response': response,
-                'command_type': command_type
-            }
-            spk = self.speaker_db['speakers'][speaker_id]
-            if 'conversations' not in spk:
-                spk['conversations'] = []
-            spk['conversations'].append(conv)
-            self._save_speaker_db()
-            print(f"已保存對話到說話者 {speaker_id} 的歷史記錄")
+                conv = {
+                    'timestamp': datetime.now().isoformat(),
+                    'query': query,
+                    'response': response,
+                    'command_type': command_type
+                }
+                spk = self.speaker_db['speakers'][speaker_id]
+                if 'conversations' not in spk:
+                    spk['conversations'] = []
+                spk['conversations'].append(conv)
+                # 記憶體中的資料庫已更新；寫檔延後到背景，連續多次保存只寫一次
+                self.history_writer.defer('speaker_db', self._save_speaker_db)
+                logger.debug(f"已保存對話到說話者 {speaker_id} 的歷史記錄")
+            
+            # 非同步更新滾動摘要，不阻塞回應
+            self.summarizer.schedule(speaker_id, spk['conversations'])
     
-    def _send_to_model(self, prompt, speaker_id=None, include_history=False):
+    @staticmethod
+    def _render_classify_system(reference_data):
+        """渲染分類用的靜態系統提示詞（含參考示例）"""
+        examples = "\n".join([f"- 輸入：{item['command']}  類型：{item['command_type']}" for item in reference_data])
+        return f"""
+        根据以下示例對命令進行分類。
+
+        示例：
+        {examples}
+
+        請只回復以下三種類型之一：
+        - 聊天
+        - 查詢
+        - 行動
+        
+        只需回復類型，不需要其他解釋。
+        """
+
+    @staticmethod
+    def _render_classify_batch_system(reference_data):
+        """渲染批次分類用的靜態系統提示詞：示例相同，但要求以 JSON 陣列回覆多句的類型"""
+        examples = "\n".join([f"- 輸入：{item['command']}  類型：{item['command_type']}" for item in reference_data])
+        return f"""
+        根据以下示例對多個編號的命令逐一進行分類。
+
+        示例：
+        {examples}
+
+        每個命令的類型只能是以下三種之一：
+        - 聊天
+        - 查詢
+        - 行動
+        
+        請只回覆一個 JSON 陣列，依編號順序列出每個命令的類型，例如 ["聊天", "查詢"]，
+        陣列長度必須與命令數量相同，不需要其他解釋。
+        """
+
+    @staticmethod
+    def _render_movement_system(movement_data):
+        """渲染行動規劃用的靜態系統提示詞（含動作清單與任務範例）"""
+        return f"""
+        你是一個專業的機器人動作規劃助手。請根據以下系統設定和用戶的任務，生成詳細的動作順序和說明。
+
+        系統可用的動作清單：
+        {json.dumps(movement_data['動作清單'], ensure_ascii=False, indent=2)}
+
+        參考任務範例：
+        {json.dumps(movement_data['任務拆解'], ensure_ascii=False, indent=2)}
+
+        請按照以下格式返回：
+        {{
+            "動作順序": ["動作代號1", "動作代號2", ...],
+            "說明": [
+                "詳細步驟1",
+                "詳細步驟2",
+                ...
+            ]
+        }}
+
+        請確保：
+        1. 動作順序使用動作清單中的代號
+        2. 說明要詳細且符合實際執行順序
+        3. 回覆必須是有效的JSON格式，並使用```json 包裹
+        4. 只能使用動作清單中的動作，不能使用其他動作
+        5. 如果用戶任務無法透過動作清單生成有效的動作計劃，請回覆"無法生成有效的動作計劃"
+        """
+
+    def _send_to_model(self, prompt, speaker_id=None, include_history=False, system=None):
         """發送提示詞到 Claude 模型並獲取回應
         
         Args:
             prompt: 提示詞文本
             speaker_id: 說話者ID (可選)
             include_history: 是否包含歷史對話
+            system: 靜態系統提示詞 (可選)，會標記為 Bedrock 可快取的前綴
         """
         # 如果需要包含歷史對話且有說話者ID
         if include_history and speaker_id:
-            # 如果speaker_id不存在於數據庫中，創建一個新記錄
-            if speaker_id not in self.speaker_db.get('speakers', {}):
-                self.speaker_db['speakers'][speaker_id] = {
-                    'created_at': datetime.now().isoformat(),
-                    'conversations': [],
-                    'embeddings': []  # 添加embeddings字段
-                }
-                print(f"[Info] 在獲取歷史對話時，創建新用戶: {speaker_id}")
-            
-            # 檢查是否存在conversations鍵，若不存在則創建
-            if 'conversations' not in self.speaker_db['speakers'][speaker_id]:
-                self.speaker_db['speakers'][speaker_id]['conversations'] = []
+            with self.db_lock:
+                # 如果speaker_id不存在於數據庫中，創建一個新記錄
+                if speaker_id not in self.speaker_db.get('speakers', {}):
+                    self.speaker_db['speakers'][speaker_id] = {
+                        'created_at': datetime.now().isoformat(),
+                        'conversations': [],
+                        'embeddings': []  # 添加embeddings字段
+                    }
+                    logger.info(f"在獲取歷史對話時，創建新用戶: {speaker_id}")
                 
-            # 獲取用戶的歷史對話
-            conversations = self.speaker_db['speakers'][speaker_id]['conversations']
+                # 檢查是否存在conversations鍵，若不存在則創建
+                if 'conversations' not in self.speaker_db['speakers'][speaker_id]:
+                    self.speaker_db['speakers'][speaker_id]['conversations'] = []
+                    
+                # 獲取用戶的歷史對話 (複本，背景保存時仍可能加入新對話)
+                conversations = list(self.speaker_db['speakers'][speaker_id]['conversations'])
             
             # 如果有歷史對話，將其加入到提示詞中
             if conversations:
                 history_text = "\n\n以下是用戶過去的對話記錄，請參考這些信息來回答當前問題：\n"
                 
-                # 最多使用最近10次對話，避免超出模型的輸入限制
-                for i, conv in enumerate(conversations[-10:]):
-                    history_text += f"用戶: {conv['query']}\n"
-                    history_text += f"助手: {conv['response']}\n\n"
+                # 使用滾動摘要加上最近幾輪對話，讓輸入長度不隨使用時間增長
+                history_text += self.summarizer.build_history(speaker_id, conversations)
                 
                 # 將歷史對話加入到提示詞的開頭
                 prompt = history_text + "\n當前問題:\n" + prompt
         
-        body = json.dumps({
+        request = {
             "max_tokens": 512,
             "messages": [
                 {
@@ -133,65 +255,95 @@ class CommandClassifier:
                 }
             ],
             "anthropic_version": "bedrock-2023-05-31"
-        })
+        }
+        if system:
+            request["system"] = cached_system_blocks(system, self.enable_prompt_cache)
+        body = json.dumps(request)
         
-        try:
-            response = self.client.invoke_model(
+        def invoke():
+            response = self.model_client.raw.invoke_model(
                 body=body,
                 modelId=self.model_id,
                 contentType="application/json"
             )
-            
-            # 解析回應
-            response_body = json.loads(response["body"].read())
+            # 在同一次嘗試內讀完回應，讓期限涵蓋整個傳輸
+            return json.loads(response["body"].read())
+        
+        try:
+            response_body = self.model_client.call_sync(invoke)
             return response_body["content"][0]["text"]
+        except BackendTimeoutError as e:
+            logger.error(f"模型調用逾時: {str(e)}")
+            return MODEL_ERROR_RESPONSE
         except Exception as e:
-            print(f"模型調用錯誤: {str(e)}")
-            return "無法獲取模型回應"
+            logger.error(f"模型調用錯誤: {str(e)}")
+            return MODEL_ERROR_RESPONSE
         
-    def classify_command(self, text):
-        """使用 Claude 模型對命令進行分類"""
-        # 構建提示詞，包含參考示例
-        examples = "\n".join([f"- 輸入：{item['command']}  類型：{item['command_type']}" for item in self.reference_data])
-        
-        prompt = f"""
-        根据以下示例對命令進行分類。
-
-        示例：
-        {examples}
+    @traced()
+    def classify_command(self, text, strict=False):
+        """使用 Claude 模型對命令進行分類
 
+        模型調用失敗時預設歸為聊天；strict=True 時回傳 None，讓離線批次保留該筆待下次重試
+        """
+        # 靜態示例部分由模板註冊表快取，這裡只組合變動的輸入
+        system = self.prompts.get('classify_system')
+        prompt = f"""
         請對以下輸入進行分類：
         輸入："{text}"
-        
-        請只回復以下三種類型之一：
-        - 聊天
-        - 查詢
-        - 行動
-        
-        只需回復類型，不需要其他解釋。
         """
 
-        # 打印提示詞
-        print("\n=== 提示詞內容 ===")
-        print(prompt)
-        print("=== 提示詞結束 ===\n")
+        # 提示詞只在 DEBUG 等級抽樣記錄
+        log_payload(logger, "分類提示詞", prompt)
         
-        result = self._send_to_model(prompt).strip()
+        result = self._send_to_model(prompt, system=system).strip()
         
-        # 打印模型响应
-        print(f"模型響應: {result}\n")
+        logger.debug(f"模型響應: {shorten(result)}")
+        if result == MODEL_ERROR_RESPONSE and strict:
+            logger.warning("模型調用失敗，不產生分類結果")
+            return None
         
-        # 直接根據包含的字符進行分類並返回結果
+        command_type = self.parse_command_type(result)
+        logger.info(f"分類結果: {command_type}")
+        return command_type
+    
+    @staticmethod
+    def parse_command_type(result):
+        """直接根據模型回覆包含的字符決定分類，無法判斷時預設為聊天"""
         if '查' in result or '詢' in result:
-            print(f"分類結果: 查詢 (由於包含 '查' 或 '詢')")
             return '查詢'
         elif '行' in result or '動' in result:
-            print(f"分類結果: 行動 (由於包含 '行' 或 '動')")
             return '行動'
-        else:
-            print(f"分類結果: 聊天 (預設分類)")
-            return '聊天'
+        return '聊天'
+    
+    def classify_batch(self, texts):
+        """在同一個提示詞中分類多句輸入，回傳與輸入順序相同的類型列表
+
+        模型調用失敗的輸入對應 None，而不是預設的聊天
+        """
+        if not texts:
+            return []
+        system = self.prompts.get('classify_batch_system')
+        numbered = "\n".join(f"{i + 1}. {text}" for i, text in enumerate(texts))
+        prompt = f"""
+        請對以下 {len(texts)} 個輸入逐一進行分類：
+        {numbered}
+        """
+        result = self._send_to_model(prompt, system=system)
+        if result == MODEL_ERROR_RESPONSE:
+            logger.warning(f"批次分類模型調用失敗，{len(texts)} 筆未分類")
+            return [None] * len(texts)
         
+        try:
+            labels = json.loads(result[result.index('['):result.rindex(']') + 1])
+        except ValueError:
+            labels = []
+        if len(labels) != len(texts):
+            # 批次回覆格式不符時，退回逐句分類
+            logger.warning(f"批次分類回覆數量不符 ({len(labels)}/{len(texts)})，改為逐句分類")
+            return [self.classify_command(text, strict=True) for text in texts]
+        return [self.parse_command_type(str(label)) for label in labels]
+        
+    @traced('handle_chat')
     def chat_with_gemini(self, text, speaker_id=None):
         """与 Claude 进行聊天，包含歷史上下文"""
         prompt = f"""
@@ -201,15 +353,12 @@ class CommandClassifier:
         用戶說：{text}
         """
         
-        print("\n=== 聊天提示詞內容 ===")
-        print(prompt)
-        print("=== 提示詞結束 ===\n")
+        log_payload(logger, "聊天提示詞", prompt)
         
         # 包含歷史對話
         result = self._send_to_model(prompt, speaker_id, include_history=True)
         
-        print(f"Claude回應: {result}\n")
-        print(f"speaker_id: {speaker_id}")
+        logger.debug(f"聊天回應 (speaker_id: {speaker_id}): {shorten(result)}")
         # 保存對話到說話者歷史記錄
         if speaker_id:
             self.save_conversation(speaker_id, text, result, '聊天')
@@ -218,24 +367,9 @@ class CommandClassifier:
 
     def save_chat_history(self, command, response, command_type):
         """保存聊天历史到JSON文件"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        chat_data = {
-            "timestamp": timestamp,
-            "command": command,
-            "response": response,
-            "command_type": command_type
-        }
-        
-        # 确保目录存在
-        save_dir = os.path.join(os.path.dirname(__file__), '../../data/chat_history')
-        os.makedirs(save_dir, exist_ok=True)
-        
-        # 保存到JSON文件
-        file_path = os.path.join(save_dir, f"chat_{timestamp}.json")
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(chat_data, f, ensure_ascii=False, indent=2)
-            
-        print(f"聊天記錄已保存至: {file_path}\n")
+        file_path = self.history_writer.write(AssistantResponse(command, command_type, response))
+        logger.debug(f"聊天記錄已保存至: {file_path}")
+        return file_path
 
     def web_search(self, query):
         """執行網絡搜索"""
@@ -249,6 +383,7 @@ class CommandClassifier:
         }
         
         try:
+            import requests  # 只有網路搜尋會用到，延後匯入
             response = requests.get(url, params=params)
             results = response.json()
             
@@ -263,29 +398,31 @@ class CommandClassifier:
                 return search_results
             return []
         except Exception as e:
-            print(f"搜索出錯: {str(e)}")
+            logger.error(f"搜索出錯: {str(e)}")
             return []
 
+    @traced()
     def handle_query(self, text, speaker_id=None):
         """處理查詢類型的命令，優先使用歷史對話記錄回答"""
         
         # 首先檢查是否可以從歷史對話中回答
         if speaker_id:
-            # 如果speaker_id不存在於數據庫中，創建一個新記錄
-            if speaker_id not in self.speaker_db.get('speakers', {}):
-                self.speaker_db['speakers'][speaker_id] = {
-                    'created_at': datetime.now().isoformat(),
-                    'conversations': [],
-                    'embeddings': []  # 添加embeddings字段
-                }
-                print(f"[Info] 在查詢處理中，創建新用戶: {speaker_id}")
-                
-            # 確保conversations鍵存在
-            if 'conversations' not in self.speaker_db['speakers'][speaker_id]:
-                self.speaker_db['speakers'][speaker_id]['conversations'] = []
-                
-            # 獲取用戶的歷史對話
-            conversations = self.speaker_db['speakers'][speaker_id]['conversations']
+            with self.db_lock:
+                # 如果speaker_id不存在於數據庫中，創建一個新記錄
+                if speaker_id not in self.speaker_db.get('speakers', {}):
+                    self.speaker_db['speakers'][speaker_id] = {
+                        'created_at': datetime.now().isoformat(),
+                        'conversations': [],
+                        'embeddings': []  # 添加embeddings字段
+                    }
+                    logger.info(f"在查詢處理中，創建新用戶: {speaker_id}")
+                    
+                # 確保conversations鍵存在
+                if 'conversations' not in self.speaker_db['speakers'][speaker_id]:
+                    self.speaker_db['speakers'][speaker_id]['conversations'] = []
+                    
+                # 獲取用戶的歷史對話 (複本，背景保存時仍可能加入新對話)
+                conversations = list(self.speaker_db['speakers'][speaker_id]['conversations'])
             
             # 如果有歷史對話，嘗試使用歷史回答
             if conversations:
@@ -297,10 +434,8 @@ class CommandClassifier:
                 歷史對話：
                 """
                 
-                # 最多使用最近10次對話
-                for i, conv in enumerate(conversations[-10:]):
-                    history_prompt += f"用戶: {conv['query']}\n"
-                    history_prompt += f"助手: {conv['response']}\n\n"
+                # 滾動摘要 + 最近幾輪對話
+                history_prompt += self.summarizer.build_history(speaker_id, conversations)
                 
                 history_prompt += f"""
                 當前問題：{text}
@@ -311,12 +446,11 @@ class CommandClassifier:
                 # 檢查是否可以從歷史對話中回答
                 check_result = self._send_to_model(history_prompt).strip().lower()
                 
-                # 打印檢查結果
-                print(f"檢查結果: {check_result}")
+                logger.debug(f"檢查結果: {check_result}")
                 
                 # 如果可以從歷史回答
                 if "可以" in check_result and "不可以" not in check_result:
-                    print("從歷史對話中找到答案，無需進行網絡搜索")
+                    logger.info("從歷史對話中找到答案，無需進行網絡搜索")
                     
                     # 生成回應使用歷史上下文
                     answer_prompt = f"""
@@ -328,9 +462,7 @@ class CommandClassifier:
                     """
                     
                     # 加入歷史對話
-                    for i, conv in enumerate(conversations[-10:]):
-                        answer_prompt += f"用戶: {conv['query']}\n"
-                        answer_prompt += f"助手: {conv['response']}\n\n"
+                    answer_prompt += self.summarizer.build_history(speaker_id, conversations)
                     
                     answer_prompt += f"""
                     當前問題：{text}
@@ -346,20 +478,39 @@ class CommandClassifier:
                     
                     return response
         
+        # 相似的查詢若已有未過期的答案，直接使用快取
+        cached_response = self.answer_cache.lookup(text)
+        if cached_response is not None:
+            if speaker_id:
+                self.save_conversation(speaker_id, text, cached_response, '查詢')
+            return cached_response
+        
         # 如果沒有從歷史對話中找到答案，使用網絡搜索
-        print("從歷史中找不到答案，進行網絡搜索")
+        logger.info("從歷史中找不到答案，進行網絡搜索")
                     
         # 执行搜索
         #search_results = self.web_search(text)
-        lambda_client = boto3.client('lambda', region_name='us-west-2')
-        resp = lambda_client.invoke(
-            FunctionName='query4',
-            InvocationType='RequestResponse',
-            Payload=json.dumps({'query': text})
-        )
-
-        search_results = json.load(resp['Payload'])
-        # 生成回应，這時加入歷史上下文
+        def search():
+            resp = self.search_client.raw.invoke(
+                FunctionName='query4',
+                InvocationType='RequestResponse',
+                Payload=json.dumps({'query': text})
+            )
+            return json.load(resp['Payload'])
+        
+        search_ok = True
+        try:
+            search_results = self.search_client.call_sync(search)
+        except Exception as e:
+            logger.error(f"搜索出錯: {str(e)}")
+            search_results = []
+            search_ok = False
+        if isinstance(search_results, dict) and 'errorMessage' in search_results:
+            # Lambda 函式本身出錯時仍回傳 200，錯誤在回應內容中
+            logger.error(f"搜索出錯: {search_results['errorMessage']}")
+            search_ok = False
+        # 生成回应；答案會寫入所有說話者共用的快取，因此不加入個人的歷史對話
+        # (能由歷史回答的問題已在上方處理)
         results_prompt = f"""
         基於以下搜索結果，請用繁體中文總結一個完整的回答：
 
@@ -369,7 +520,11 @@ class CommandClassifier:
         用戶查詢: {text}
         """
         
-        final_response = self._send_to_model(results_prompt, speaker_id, include_history=True)
+        final_response = self._send_to_model(results_prompt)
+        
+        # 只快取有搜尋結果的答案；搜尋或模型呼叫失敗的回應不可在主題 TTL 內提供給所有說話者
+        if search_ok and search_results and final_response != MODEL_ERROR_RESPONSE:
+            self.answer_cache.store(text, final_response.strip())
         
         # 保存對話到說話者歷史記錄
         if speaker_id:
@@ -379,149 +534,124 @@ class CommandClassifier:
 
     def save_query_history(self, command, response, command_type):
         """保存查詢歷史到JSON文件"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        query_data = {
-            "timestamp": timestamp,
-            "command": command,
-            "response": response,
-            "command_type": command_type
-        }
-        
-        # 确保目录存在
-        save_dir = os.path.join(os.path.dirname(__file__), '../../data/query_history')
-        os.makedirs(save_dir, exist_ok=True)
-        
-        # 保存到JSON文件
-        file_path = os.path.join(save_dir, f"query_{timestamp}.json")
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(query_data, f, ensure_ascii=False, indent=2)
-            
-        print(f"查詢記錄已保存至: {file_path}\n")
+        file_path = self.history_writer.write(AssistantResponse(command, command_type, response))
+        logger.debug(f"查詢記錄已保存至: {file_path}")
+        return file_path
 
+    @traced()
     def handle_movement(self, text, speaker_id=None):
         """處理行動類型的命令，包含歷史上下文"""
         # 如果有speaker_id但不存在於數據庫中，創建一個新記錄
-        if speaker_id and speaker_id not in self.speaker_db.get('speakers', {}):
-            self.speaker_db['speakers'][speaker_id] = {
-                'created_at': datetime.now().isoformat(),
-                'conversations': [],
-                'embeddings': []  # 添加embeddings字段
-            }
-            print(f"[Info] 在行動處理中，創建新用戶: {speaker_id}")
+        with self.db_lock:
+            if speaker_id and speaker_id not in self.speaker_db.get('speakers', {}):
+                self.speaker_db['speakers'][speaker_id] = {
+                    'created_at': datetime.now().isoformat(),
+                    'conversations': [],
+                    'embeddings': []  # 添加embeddings字段
+                }
+                logger.info(f"在行動處理中，創建新用戶: {speaker_id}")
             
-        # 加载动作部署配置
-        movement_json_path = os.path.join(os.path.dirname(__file__), '../../assets/movement_deployment.json')
-        with open(movement_json_path, 'r', encoding='utf-8') as f:
-            movement_data = json.load(f)
+        # 重複性任務直接套用計劃庫中的既有計劃
+        cached_plan = self.plan_library.match(text)
+        if cached_plan is not None:
+            if speaker_id:
+                response_text = "動作順序: " + ", ".join(cached_plan['動作順序']) + "\n說明: " + "\n- ".join(cached_plan['說明'])
+                self.save_conversation(speaker_id, text, response_text, '行動')
+            return cached_plan
             
+        # 靜態的動作清單與任務範例由模板註冊表快取，僅在資產檔變動時重新渲染
+        system = self.prompts.get('movement_system')
         prompt = f"""
-        你是一個專業的機器人動作規劃助手。請根據以下系統設定和用戶的任務，生成詳細的動作順序和說明。
-
-        系統可用的動作清單：
-        {json.dumps(movement_data['動作清單'], ensure_ascii=False, indent=2)}
-
-        參考任務範例：
-        {json.dumps(movement_data['任務拆解'], ensure_ascii=False, indent=2)}
-
         當前用戶任務：{text}
-
-        請按照以下格式返回：
-        {{
-            "動作順序": ["動作代號1", "動作代號2", ...],
-            "說明": [
-                "詳細步驟1",
-                "詳細步驟2",
-                ...
-            ]
-        }}
-
-        請確保：
-        1. 動作順序使用動作清單中的代號
-        2. 說明要詳細且符合實際執行順序
-        3. 回覆必須是有效的JSON格式，並使用```json 包裹
-        4. 只能使用動作清單中的動作，不能使用其他動作
-        5. 如果用戶任務無法透過動作清單生成有效的動作計劃，請回覆"無法生成有效的動作計劃"
         """
         
-        print("\n=== 行動規劃提示詞內容 ===")
-        print(prompt)
-        print("=== 提示詞結束 ===\n")
+        log_payload(logger, "行動規劃提示詞", prompt)
         
         # 行動規劃也應考慮歷史上下文
-        result = self._send_to_model(prompt, speaker_id, include_history=True)
+        result = self._send_to_model(prompt, speaker_id, include_history=True, system=system)
         
-        print(f"Claude回應: {result}\n")
+        log_payload(logger, "行動規劃回應", result)
         if "無法生成有效的動作計劃" in result:
             movement_plan = {
-                "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"),
-                "command": text,
-                "movement_plan": {
-                    "動作順序": [],
-                "說明": [
-                    "無法生成有效的動作計劃"
-                ]
-            },
-                "command_type": "行動"
+                "動作順序": [],
+                "說明": ["無法生成有效的動作計劃"]
             }
             if speaker_id:
                 # 將JSON轉為文字以保存到對話歷史
                 response_text = "動作順序: " + ", ".join(movement_plan['動作順序']) + "\n說明: " + "\n- ".join(movement_plan['說明'])
                 self.save_conversation(speaker_id, text, response_text, '行動')
             return movement_plan
-        try:
-            # 解析JSON回應
-            # 首先檢查是否包含```json標記
-            if "```json" in result:
-                # 提取JSON部分
-                json_str = result.split("```json")[1].split("```")[0].strip()
-            else:
-                json_str = result.strip()
-            
-            movement_plan = json.loads(json_str)
-            
-            # 驗證JSON格式是否正確
-            if not isinstance(movement_plan, dict) or \
-               '動作順序' not in movement_plan or \
-               '說明' not in movement_plan or \
-               not isinstance(movement_plan['動作順序'], list) or \
-               not isinstance(movement_plan['說明'], list):
-                raise ValueError("JSON格式不符合要求")
-            
-            # 保存對話到說話者歷史記錄
-            if speaker_id:
-                # 將JSON轉為文字以保存到對話歷史
-                response_text = "動作順序: " + ", ".join(movement_plan['動作順序']) + "\n說明: " + "\n- ".join(movement_plan['說明'])
-                self.save_conversation(speaker_id, text, response_text, '行動')
-                
-            return movement_plan
-            
-        except (json.JSONDecodeError, ValueError) as e:
-            print(f"警告：無法解析回應為JSON格式 - {str(e)}")
+        # 本地解析並驗證；失敗時只送出針對錯誤的修復請求，而不重跑整個流程
+        movement_plan, errors = self.plan_validator.parse(result)
+        invalid = bool(errors)
+        repairs = 0
+        while errors and repairs < self.max_plan_repairs:
+            repairs += 1
+            logger.warning(f"動作計劃未通過驗證 - {'; '.join(errors)}，送出修復請求")
+            result = self._send_to_model(self._build_repair_prompt(result, errors), system=system)
+            movement_plan, errors = self.plan_validator.parse(result)
+        self.plan_validator.record(invalid=invalid, repaired=invalid and not errors, failed=bool(errors))
+        
+        if errors:
+            logger.warning(f"無法生成有效的動作計劃 - {'; '.join(errors)}")
             return {
                 "動作順序": [],
                 "說明": ["無法生成有效的動作計劃"]
             }
+        
+        # 通過驗證的計劃加入計劃庫供之後重複使用
+        self.plan_library.add(text, movement_plan)
+        
+        # 保存對話到說話者歷史記錄
+        if speaker_id:
+            # 將JSON轉為文字以保存到對話歷史
+            response_text = "動作順序: " + ", ".join(movement_plan['動作順序']) + "\n說明: " + "\n- ".join(movement_plan['說明'])
+            self.save_conversation(speaker_id, text, response_text, '行動')
+            
+        return movement_plan
+
+    @staticmethod
+    def _build_repair_prompt(previous_result, errors):
+        """只針對驗證錯誤要求模型修正先前的回覆"""
+        error_lines = "\n".join(f"- {error}" for error in errors)
+        return f"""
+        你先前的動作計劃回覆有以下問題：
+        {error_lines}
+
+        先前的回覆：
+        {previous_result}
+
+        請只修正上述問題，保留其餘內容，並以```json 包裹回傳完整的動作計劃。
+        """
 
     def save_movement_history(self, command, response, command_type):
         """保存行動歷史到JSON文件"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        movement_data = {
-            "timestamp": timestamp,
-            "command": command,
-            "movement_plan": response,
-            "command_type": command_type
+        file_path = self.history_writer.write(AssistantResponse(command, command_type, response))
+        logger.debug(f"行動計劃已保存至: {file_path}")
+        return file_path
+
+    def respond(self, text, command_type, speaker_id=None):
+        """依命令類型處理並回傳 AssistantResponse；歷史記錄在背景保存，不需等待寫檔"""
+        handlers = {
+            '聊天': self.chat_with_gemini,
+            '查詢': self.handle_query,
+            '行動': self.handle_movement
         }
-        
-        # 确保目录存在
-        save_dir = os.path.join(os.path.dirname(__file__), '../../data/movement_history')
-        os.makedirs(save_dir, exist_ok=True)
-        
-        # 保存到JSON文件
-        file_path = os.path.join(save_dir, f"movement_{timestamp}.json")
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(movement_data, f, ensure_ascii=False, indent=2)
-            
-        print(f"行動計劃已保存至: {file_path}\n")
+        handler = handlers.get(command_type)
+        if handler is None:
+            return None
+        response = AssistantResponse(text, command_type, handler(text, speaker_id), speaker_id)
+        self.history_writer.submit(response)
+        return response
+
+    def close(self, timeout=None):
+        """等待背景中的對話摘要完成並停止其執行緒，再寫完尚未保存的歷史記錄
+
+        Args:
+            timeout: 等待摘要執行緒的秒數上限，預設等到完成
+        """
+        self.summarizer.close(timeout=timeout)
+        self.history_writer.close()
 
 if __name__ == "__main__":
     # 创建分类器实例
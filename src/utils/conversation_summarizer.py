@@ -0,0 +1,156 @@
+import os
+import json
+import queue
+import threading
+from datetime import datetime
+from utils.log import get_logger
+
+logger = get_logger("summarizer")
+
+
+class ConversationSummarizer:
+    """在背景執行緒中為每位說話者維護滾動對話摘要，讓提示詞長度維持固定。
+
+    較舊的對話會被折疊進摘要，提示詞只帶「摘要 + 最近幾輪原始對話」。
+    摘要的更新在 save_conversation 之後非同步進行，不佔用請求路徑。
+    """
+
+    def __init__(self, summarize_fn, summary_file=None, recent_turns=None, batch_turns=None, max_chars=None):
+        """
+        Args:
+            summarize_fn: 接收提示詞並回傳摘要文字的函式 (通常為 CommandClassifier._send_to_model)
+            summary_file: 摘要儲存路徑
+            recent_turns: 提示詞中保留的最近原始對話輪數
+            batch_turns: 累積多少輪未摘要對話後才觸發一次摘要
+            max_chars: 摘要的最大字數
+        """
+        self.summarize_fn = summarize_fn
+        self.summary_file = summary_file or os.path.join(
+            os.path.dirname(__file__), '../../data/speaker_db/conversation_summaries.json')
+        self.recent_turns = int(recent_turns or os.getenv('HISTORY_RECENT_TURNS', 4))
+        self.batch_turns = int(batch_turns or os.getenv('HISTORY_SUMMARY_BATCH', 6))
+        self.max_chars = int(max_chars or os.getenv('HISTORY_SUMMARY_MAX_CHARS', 600))
+
+        os.makedirs(os.path.dirname(self.summary_file), exist_ok=True)
+        self._lock = threading.Lock()
+        self._summaries = self._load_summaries()
+        self._queue = queue.Queue()
+        self._pending = set()
+
+        self._worker = threading.Thread(target=self._run, name="conversation-summarizer", daemon=True)
+        self._worker.start()
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _load_summaries(self):
+        """從磁碟載入摘要，若無則回傳空字典"""
+        if os.path.exists(self.summary_file):
+            try:
+                with open(self.summary_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception as e:
+                logger.warning(f"載入對話摘要失敗: {e}，將重新建立。")
+        return {}
+
+    def _save_summaries(self):
+        """以暫存檔 + 取代的方式寫入摘要，避免寫到一半的檔案"""
+        with self._lock:
+            data = json.dumps(self._summaries, ensure_ascii=False, indent=2)
+        tmp_path = self.summary_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.summary_file)
+
+    def _run(self):
+        """背景執行緒：依序處理待摘要的說話者"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            speaker_id, conversations = item
+            try:
+                self._fold(speaker_id, conversations)
+            except Exception as e:
+                logger.warning(f"更新說話者 {speaker_id} 的對話摘要失敗: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(speaker_id)
+                self._queue.task_done()
+
+    def _fold(self, speaker_id, conversations):
+        """將超出最近 recent_turns 輪的舊對話折疊進摘要"""
+        entry = self.get_entry(speaker_id)
+        covered = min(entry['covered'], len(conversations))
+        fold_until = len(conversations) - self.recent_turns
+        if fold_until - covered < self.batch_turns:
+            return
+
+        turns = "".join(
+            f"用戶: {conv['query']}\n助手: {conv['response']}\n\n"
+            for conv in conversations[covered:fold_until]
+        )
+        prompt = f"""
+        請將以下的「既有摘要」與「新對話」整合成一份更新後的用戶對話摘要。
+        保留用戶的偏好、身分資訊、未完成的請求與重要事實，省略寒暄。
+        使用繁體中文，不超過 {self.max_chars} 字，只輸出摘要內容。
+
+        既有摘要：
+        {entry['summary'] or '（無）'}
+
+        新對話：
+        {turns}
+        """
+        summary = self.summarize_fn(prompt).strip()
+        if not summary or summary == "無法獲取模型回應":
+            return
+
+        with self._lock:
+            self._summaries[speaker_id] = {
+                'summary': summary[:self.max_chars],
+                'covered': fold_until,
+                'updated_at': datetime.now().isoformat()
+            }
+        self._save_summaries()
+        logger.debug(f"已更新說話者 {speaker_id} 的對話摘要 (涵蓋 {fold_until} 輪)")
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    def get_entry(self, speaker_id):
+        """取得說話者目前的摘要記錄"""
+        with self._lock:
+            entry = self._summaries.get(speaker_id)
+            if entry is None:
+                return {'summary': '', 'covered': 0}
+            return dict(entry)
+
+    def schedule(self, speaker_id, conversations):
+        """在對話保存後排程摘要更新；同一說話者已在佇列中時不重複排程"""
+        if not speaker_id:
+            return
+        with self._lock:
+            if speaker_id in self._pending:
+                return
+            self._pending.add(speaker_id)
+        # 傳入快照，避免背景執行緒讀到正在被修改的列表
+        self._queue.put((speaker_id, list(conversations)))
+
+    def build_history(self, speaker_id, conversations):
+        """組合「摘要 + 最近原始對話」的歷史文字，長度與對話總數無關"""
+        entry = self.get_entry(speaker_id)
+        covered = min(entry['covered'], len(conversations))
+        # 摘要落後時最多帶 recent_turns + batch_turns 輪原始對話
+        raw_turns = conversations[covered:][-(self.recent_turns + self.batch_turns):]
+
+        history_text = ""
+        if entry['summary']:
+            history_text += f"對話摘要：\n{entry['summary']}\n\n最近的對話：\n"
+        for conv in raw_turns:
+            history_text += f"用戶: {conv['query']}\n"
+            history_text += f"助手: {conv['response']}\n\n"
+        return history_text
+
+    def close(self, timeout=None):
+        """等待佇列中的摘要完成並停止背景執行緒"""
+        self._queue.put(None)
+        self._worker.join(timeout)
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
@@ -0,0 +1,87 @@
+import os
+import json
+import queue
+import threading
+from utils.log import get_logger
+
+logger = get_logger("history")
+
+
+class HistoryWriter:
+    """在背景執行緒保存歷史記錄，讓磁碟寫入不佔用回應路徑。
+
+    除了歷史記錄檔，也可延後執行任意寫入工作 (例如語者資料庫)；
+    相同 key 的工作在執行前重複提交只會執行一次。
+    """
+
+    def __init__(self, data_dir=None):
+        self.data_dir = data_dir or os.path.join(os.path.dirname(__file__), '../../data')
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending_keys = set()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._worker.start()
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            key, fn, args = item
+            if key is not None:
+                with self._lock:
+                    self._pending_keys.discard(key)
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"背景保存失敗: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _path_for(self, response):
+        save_dir = os.path.join(self.data_dir, f"{response.history_kind}_history")
+        os.makedirs(save_dir, exist_ok=True)
+        # 同一秒內的多筆回應以 response_id 區分，避免互相覆蓋
+        return os.path.join(save_dir, f"{response.history_kind}_{response.timestamp}_{response.response_id}.json")
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    def write(self, response):
+        """同步寫入一筆回應的歷史記錄檔，回傳檔案路徑"""
+        file_path = self._path_for(response)
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(response.to_history_record(), f, ensure_ascii=False, indent=2)
+        return file_path
+
+    def submit(self, response):
+        """排入背景寫入歷史記錄檔"""
+        self.defer(None, self.write, response)
+
+    def defer(self, key, fn, *args):
+        """排入背景執行 fn(*args)；key 不為 None 時，尚未執行的相同工作不重複排入"""
+        with self._lock:
+            if not self._closed:
+                if key is not None:
+                    if key in self._pending_keys:
+                        return
+                    self._pending_keys.add(key)
+                self._queue.put((key, fn, args))
+                return
+        fn(*args)
+
+    def flush(self):
+        """等待目前排入的工作完成"""
+        self._queue.join()
+
+    def close(self):
+        """寫完佇列中的工作後停止背景執行緒；之後的工作改為同步執行"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._worker.join()
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
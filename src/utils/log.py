@@ -0,0 +1,108 @@
+import os
+import sys
+import queue
+import atexit
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+ROOT_LOGGER = "voice"
+
+# 沿用專案原本的 [Info] / [Warning] / [Error] 前綴
+LEVEL_NAMES = {
+    logging.DEBUG: "Debug",
+    logging.INFO: "Info",
+    logging.WARNING: "Warning",
+    logging.ERROR: "Error",
+    logging.CRITICAL: "Critical",
+}
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+class _PrefixFormatter(logging.Formatter):
+    def format(self, record):
+        record.level_tag = LEVEL_NAMES.get(record.levelno, record.levelname)
+        record.component = record.name[len(ROOT_LOGGER) + 1:] or ROOT_LOGGER
+        return super().format(record)
+
+
+def setup_logging(level=None, log_file=None):
+    """設定日誌：所有元件寫入佇列，由背景執行緒輸出到終端機 (及檔案)，記錄日誌不會阻塞管線
+
+    Args:
+        level: 預設等級 (LOG_LEVEL，預設 INFO)；個別元件可用 LOG_LEVEL_<元件名稱> 覆寫
+        log_file: 另外寫入的日誌檔 (LOG_FILE)，超過 10 MB 時輪替
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        level = level or os.getenv("LOG_LEVEL", "INFO")
+        log_file = log_file or os.getenv("LOG_FILE")
+
+        handlers = []
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(_PrefixFormatter("[%(level_tag)s][%(component)s] %(message)s"))
+        handlers.append(console)
+        if log_file:
+            os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+            file_handler = RotatingFileHandler(log_file, maxBytes=10 * 1024 * 1024, backupCount=3, encoding="utf-8")
+            file_handler.setFormatter(_PrefixFormatter(
+                "%(asctime)s [%(level_tag)s][%(component)s][%(threadName)s] %(message)s"))
+            handlers.append(file_handler)
+
+        log_queue = queue.Queue(-1)
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(level.upper())
+        root.addHandler(QueueHandler(log_queue))
+        root.propagate = False
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """輸出佇列中剩餘的日誌並停止背景執行緒"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def get_logger(component):
+    """取得元件的日誌記錄器，例如 get_logger("classifier")"""
+    setup_logging()
+    logger = logging.getLogger(f"{ROOT_LOGGER}.{component}")
+    level = os.getenv(f"LOG_LEVEL_{component.upper()}")
+    if level:
+        logger.setLevel(level.upper())
+    return logger
+
+
+def log_payload(logger, title, payload, sample_rate=None):
+    """記錄大型內容 (提示詞、模型回覆等)：只在 DEBUG 等級且被抽樣到時輸出全文，否則只記錄長度
+
+    Args:
+        sample_rate: 輸出全文的機率 (LOG_PAYLOAD_SAMPLE_RATE，預設 0.1)
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if sample_rate is None:
+        sample_rate = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", 0.1))
+    text = str(payload)
+    if random.random() < sample_rate:
+        logger.debug("%s (%d 字)：\n%s", title, len(text), text)
+    else:
+        logger.debug("%s (%d 字，未抽樣，已省略)", title, len(text))
+
+
+def shorten(text, limit=80):
+    """截斷過長的文字，用於 INFO 等級的單行摘要"""
+    text = str(text).replace("\n", " ")
+    return text if len(text) <= limit else f"{text[:limit]}…(共 {len(text)} 字)"
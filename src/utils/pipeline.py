@@ -0,0 +1,256 @@
+import os
+import sys
+import asyncio
+import inspect
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.log import get_logger
+
+logger = get_logger("pipeline")
+
+
+class _Stop:
+    """佇列中的結束標記"""
+
+
+STOP = _Stop()
+
+# 佇列已滿時的處理方式
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'coalesce', 'reject')
+
+
+class Stage:
+    """管線中的一個階段
+
+    Args:
+        name: 階段名稱
+        fn: 處理函式，接收 item 並回傳 item；可為同步函式 (在執行緒中執行) 或協程函式
+        workers: 同時處理的工作者數量
+        queue_size: 此階段輸入佇列的容量
+        ordered: 是否依來源順序 (item.seq) 處理；需搭配 workers=1
+        include_skipped: 是否也處理被略過的 item (例如結果輸出)
+        overflow: 輸入佇列已滿時的策略
+            block — 上游等待 (預設)
+            drop_oldest — 捨棄佇列中最舊的 item，放入新的
+            coalesce — 以 coalesce(最後一個排隊的 item, 新 item) 合併；無法合併時等待
+            reject — 捨棄新的 item
+        coalesce: 合併函式，將新 item 併入排隊中的 item 並回傳 True；不能合併時回傳 False
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=2, ordered=False, include_skipped=False,
+                 overflow='block', coalesce=None):
+        if ordered and workers != 1:
+            raise ValueError(f"階段 {name} 需要依序處理，workers 必須為 1")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"階段 {name} 的溢出策略 {overflow} 不存在，可用: {', '.join(OVERFLOW_POLICIES)}")
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.include_skipped = include_skipped
+        self.overflow = overflow
+        self.coalesce = coalesce
+        self.processed = 0
+        self.failed = 0
+        # 因佇列已滿而卸載的數量，依策略分類
+        self.shed = {}
+
+
+class Pipeline:
+    """以有界佇列串接各階段的管線：來源持續產生 item，各階段可同時處理不同的 item。
+
+    item 需具備 seq (來源順序) 與 skipped (是否略過後續處理) 屬性；
+    被略過的 item 仍會往下游傳遞，讓需要依序處理的階段不會卡住；
+    因佇列已滿而卸載的 item 不再往下游傳遞，依序處理的階段會跳過它的 seq。
+
+    Args:
+        on_error: 階段處理失敗時呼叫 on_error(stage, item, error)
+        on_shed: item 被卸載時呼叫 on_shed(stage, item, reason)
+    """
+
+    def __init__(self, stages, on_error=None, on_shed=None):
+        self.stages = stages
+        self.on_error = on_error
+        self.on_shed = on_shed
+        self._queues = []
+        # 各階段最後放入佇列的 item；佇列已滿時它必定仍在排隊，供 coalesce 合併
+        self._last_queued = []
+        # 各階段已卸載、不會到達的 seq (只有依序處理的階段需要)
+        self._shed_seqs = []
+        self._tasks = []
+        self._stopping = None
+        # 來源產生的第一個 seq；依序處理的階段由此開始，避免上游並行時先到的 item 不是第一個
+        self._first_seq = None
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    async def _call(self, fn, item):
+        if inspect.iscoroutinefunction(fn):
+            return await fn(item)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, fn, item)
+
+    async def _process(self, stage, item):
+        """執行單一 item；例外時標記為略過並交由 on_error 處理"""
+        if getattr(item, 'skipped', False) and not stage.include_skipped:
+            return item
+        try:
+            result = await self._call(stage.fn, item)
+            stage.processed += 1
+            return item if result is None else result
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stage.failed += 1
+            logger.error(f"階段 {stage.name} 處理失敗: {e}")
+            item.skipped = True
+            if self.on_error:
+                self.on_error(stage, item, e)
+            return item
+
+    def _shed(self, index, item, reason):
+        """卸載 item：記錄數量，並讓此階段與下游依序處理的階段不再等待它"""
+        stage = self.stages[index]
+        stage.shed[reason] = stage.shed.get(reason, 0) + 1
+        item.skipped = True
+        for later in range(index, len(self.stages)):
+            if self.stages[later].ordered:
+                self._shed_seqs[later].add(item.seq)
+        logger.warning(f"階段 {stage.name} 佇列已滿，卸載 seq {item.seq} ({reason})")
+        if self.on_shed:
+            self.on_shed(stage, item, reason)
+
+    async def _put(self, index, item):
+        """放入第 index 個階段的佇列；佇列已滿時依該階段的溢出策略處理"""
+        stage, queue = self.stages[index], self._queues[index]
+        last = self._last_queued[index]
+        if stage.overflow == 'block' or not queue.full():
+            await queue.put(item)
+        elif stage.overflow == 'drop_oldest':
+            self._shed(index, queue.get_nowait(), 'drop_oldest')
+            queue.put_nowait(item)
+        elif stage.overflow == 'reject':
+            self._shed(index, item, 'reject')
+            return
+        elif stage.coalesce is not None and last is not None and stage.coalesce(last, item):
+            # 佇列已滿時結束標記尚未放入，最後放入的 item 必定仍在排隊
+            self._shed(index, item, 'coalesce')
+            return
+        else:
+            await queue.put(item)
+        self._last_queued[index] = item
+
+    async def _worker(self, index, in_queue, out_queue, remaining):
+        stage = self.stages[index]
+        shed_seqs = self._shed_seqs[index]
+        pending, next_seq = {}, None
+        while True:
+            item = await in_queue.get()
+            if item is STOP:
+                # 來源已結束：暫存中仍在等待的 seq 已被卸載，其餘依序處理完
+                for seq in sorted(pending):
+                    ready = await self._process(stage, pending.pop(seq))
+                    if out_queue is not None:
+                        await self._put(index + 1, ready)
+                # 通知同階段的其他工作者，最後一個離開者再通知下游
+                await in_queue.put(STOP)
+                remaining[index] -= 1
+                if remaining[index] == 0 and out_queue is not None:
+                    await out_queue.put(STOP)
+                return
+
+            if not stage.ordered:
+                item = await self._process(stage, item)
+                if out_queue is not None:
+                    await self._put(index + 1, item)
+                continue
+
+            # 依序處理：暫存提早到達的 item，直到輪到它
+            pending[item.seq] = item
+            if next_seq is None:
+                next_seq = self._first_seq
+            while next_seq in pending or next_seq in shed_seqs:
+                if next_seq in shed_seqs:
+                    shed_seqs.discard(next_seq)
+                else:
+                    ready = await self._process(stage, pending.pop(next_seq))
+                    if out_queue is not None:
+                        await self._put(index + 1, ready)
+                next_seq += 1
+
+    async def _put_first(self, item):
+        if self._first_seq is None:
+            self._first_seq = item.seq
+        await self._put(0, item)
+
+    async def _feed(self, source):
+        """從來源取得 item 放入第一個佇列；同步來源在執行緒中迭代"""
+        first = self._queues[0]
+        try:
+            if hasattr(source, '__aiter__'):
+                async for item in source:
+                    if self._stopping.is_set():
+                        break
+                    await self._put_first(item)
+            else:
+                loop = asyncio.get_running_loop()
+                iterator = iter(source)
+                done = object()
+                while not self._stopping.is_set():
+                    item = await loop.run_in_executor(None, next, iterator, done)
+                    if item is done:
+                        break
+                    await self._put_first(item)
+        finally:
+            await first.put(STOP)
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    async def run(self, source):
+        """執行管線直到來源結束或呼叫 stop()，並等待在途的 item 處理完畢"""
+        self._stopping = asyncio.Event()
+        self._first_seq = None
+        self._queues = [asyncio.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        self._shed_seqs = [set() for _ in self.stages]
+        self._last_queued = [None for _ in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+
+        self._tasks = []
+        for index, stage in enumerate(self.stages):
+            out_queue = self._queues[index + 1] if index + 1 < len(self.stages) else None
+            for _ in range(stage.workers):
+                self._tasks.append(asyncio.ensure_future(
+                    self._worker(index, self._queues[index], out_queue, remaining)))
+
+        feeder = asyncio.ensure_future(self._feed(source))
+        try:
+            await asyncio.gather(feeder, *self._tasks)
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+    def stop(self):
+        """停止接收新的 item，已在管線中的 item 會繼續處理完畢"""
+        if self._stopping is not None:
+            self._stopping.set()
+
+    def cancel(self):
+        """立即取消所有階段 (執行緒中的阻塞呼叫會在完成後被丟棄)"""
+        self.stop()
+        for task in self._tasks:
+            task.cancel()
+
+    def stats(self):
+        """各階段的處理數量、卸載數量與目前佇列深度"""
+        return {
+            stage.name: {
+                'processed': stage.processed,
+                'failed': stage.failed,
+                'shed': dict(stage.shed),
+                'overflow': stage.overflow,
+                'queue_depth': self._queues[i].qsize() if self._queues else 0,
+                'queue_size': stage.queue_size
+            }
+            for i, stage in enumerate(self.stages)
+        }
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
@@ -0,0 +1,236 @@
+import os
+import re
+import json
+import threading
+from datetime import datetime
+
+from utils.text_similarity import normalize_text, embed_text, cosine_similarity
+from utils.log import get_logger
+
+logger = get_logger("plan_library")
+
+
+class PlanLibrary:
+    """已驗證動作計劃的資料庫：相近任務直接套用既有計劃，只有新任務才交給 LLM。
+
+    任務文字中的地點、物品與對象會被替換為參數槽 (例如 {地點0})，
+    比對時以模板文字的正規化結果或向量相似度判斷，命中後再把新的值填回說明。
+    說明中可用別名指稱同一個值 (任務說「茶水間」、說明寫「飲水機」)，別名定義於詞庫的「別名」。
+    """
+
+    def __init__(self, seed_tasks=None, action_codes=None, library_file=None, slots_file=None,
+                 similarity_threshold=None, max_plans=None):
+        """
+        Args:
+            seed_tasks: movement_deployment.json 中的任務拆解範例
+            action_codes: 動作清單中的合法代號，或每次使用時回傳代號的函式 (動作清單可能重新載入)，用於過濾無效計劃
+            library_file: 學到的計劃儲存路徑
+            slots_file: 參數槽詞庫路徑
+        """
+        self.library_file = library_file or os.path.join(
+            os.path.dirname(__file__), '../../data/plan_library/plans.json')
+        slots_file = slots_file or os.path.join(os.path.dirname(__file__), '../../assets/plan_slots.json')
+        self.similarity_threshold = float(similarity_threshold or os.getenv('PLAN_MATCH_SIM', 0.9))
+        self.max_plans = int(max_plans or os.getenv('PLAN_LIBRARY_SIZE', 500))
+        self._action_codes = action_codes
+
+        os.makedirs(os.path.dirname(self.library_file), exist_ok=True)
+        self._lock = threading.Lock()
+        self._slot_terms, self._aliases = self._load_slot_terms(slots_file)
+        # 最長匹配：一次掃描即可找出說明中的所有詞庫詞與別名
+        names = sorted({term for term, _ in self._slot_terms} |
+                       {alias for aliases in self._aliases.values() for alias in aliases}, key=len, reverse=True)
+        self._term_re = re.compile("|".join(re.escape(name) for name in names)) if names else None
+        self._plans = []
+        for task in seed_tasks or []:
+            if self._add(task['任務'], task, source='seed'):
+                self._check_seed(self._plans[-1])
+        for entry in self._load_learned():
+            self._add(entry['task'], entry, source='learned', created_at=entry.get('created_at'))
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    @property
+    def action_codes(self):
+        """目前的合法動作代號 (字串集合)；空集合表示不過濾"""
+        codes = self._action_codes() if callable(self._action_codes) else self._action_codes
+        return {str(code) for code in codes or []}
+
+    @staticmethod
+    def _load_slot_terms(slots_file):
+        """載入詞庫並依長度由長到短排序，確保最長匹配 (例如「咖啡機」優先於「咖啡」)
+
+        回傳 (詞庫詞列表, {詞: 說明中可能使用的別名列表})
+        """
+        try:
+            with open(slots_file, 'r', encoding='utf-8') as f:
+                slots = json.load(f)
+        except Exception as e:
+            logger.warning(f"載入參數槽詞庫失敗: {e}，將只使用完整文字比對。")
+            slots = {}
+        aliases = slots.pop('別名', {})
+        terms = [(term, category) for category, values in slots.items() for term in values]
+        return sorted(terms, key=lambda item: len(item[0]), reverse=True), aliases
+
+    def _names(self, value):
+        """值本身與其別名"""
+        return [value] + self._aliases.get(value, [])
+
+    def _terms_in(self, step):
+        """說明中出現的詞庫詞與別名 (最長匹配，「咖啡機」不會被算成「咖啡」)"""
+        return self._term_re.findall(step) if self._term_re else []
+
+    def _check_seed(self, entry):
+        """任務範例應能參數化；有無法替換的參數槽時提示修正詞庫或範例"""
+        blocked = [
+            f"{slot}={value}" for slot, value in entry['slot_values'].items()
+            if not self._can_vary(entry, slot)
+        ]
+        if not entry['slot_values']:
+            logger.warning(f"任務範例沒有任何參數槽，只能完全相同時命中: {entry['task']}")
+        elif blocked:
+            logger.warning(f"任務範例的參數槽無法替換 ({', '.join(blocked)}): {entry['task']}")
+
+    def _load_learned(self):
+        if os.path.exists(self.library_file):
+            try:
+                with open(self.library_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception as e:
+                logger.warning(f"載入動作計劃庫失敗: {e}，將重新建立。")
+        return []
+
+    def _save_learned(self):
+        with self._lock:
+            learned = [
+                {'task': p['task'], '動作順序': p['動作順序'], '說明': p['raw_steps'], 'created_at': p['created_at']}
+                for p in self._plans if p['source'] == 'learned'
+            ]
+        tmp_path = self.library_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(learned, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.library_file)
+
+    def _templatize(self, text):
+        """將文字中的詞庫詞替換為參數槽，回傳 (模板文字, {槽名: 值})"""
+        template, values, counters = "", {}, {}
+        i = 0
+        while i < len(text):
+            for term, category in self._slot_terms:
+                if text.startswith(term, i):
+                    index = counters.get(category, 0)
+                    counters[category] = index + 1
+                    slot = f"{{{category}{index}}}"
+                    values[slot] = term
+                    template += slot
+                    i += len(term)
+                    break
+            else:
+                template += text[i]
+                i += 1
+        return template, values
+
+    def _fixed_terms(self, steps, slot_values):
+        """找出說明中寫死、但不屬於任務參數槽 (含別名) 的詞庫詞 (依類別)"""
+        fixed = {}
+        task_terms = {name for value in slot_values.values() for name in self._names(value)}
+        categories = dict((term, category) for term, category in self._slot_terms)
+        for step in steps:
+            for term in self._terms_in(step):
+                if term not in task_terms and term in categories:
+                    fixed.setdefault(categories[term], set()).add(term)
+        return fixed
+
+    @staticmethod
+    def _category(slot):
+        return slot.strip("{}").rstrip("0123456789")
+
+    def _can_vary(self, entry, slot):
+        """參數槽的值出現在說明中 (含別名)，且說明沒有同類別的寫死詞，才能安全替換"""
+        names = set(self._names(entry['slot_values'][slot]))
+        mentioned = any(term in names for step in entry['raw_steps'] for term in self._terms_in(step))
+        return mentioned and not entry['fixed_terms'].get(self._category(slot))
+
+    def _add(self, task, plan, source, created_at=None):
+        codes = [str(code) for code in plan['動作順序']]
+        action_codes = self.action_codes
+        if action_codes and not set(codes) <= action_codes:
+            return False
+        template, slot_values = self._templatize(task)
+        steps = list(plan['說明'])
+
+        entry = {
+            'task': task,
+            'key': normalize_text(template),
+            'vector': embed_text(template),
+            'slot_values': slot_values,
+            'fixed_terms': self._fixed_terms(steps, slot_values),
+            '動作順序': codes,
+            'raw_steps': steps,
+            'source': source,
+            'created_at': created_at or datetime.now().isoformat(),
+            'hits': 0
+        }
+        with self._lock:
+            self._plans = [p for p in self._plans if p['key'] != entry['key'] or p['source'] == 'seed']
+            self._plans.append(entry)
+            learned = [p for p in self._plans if p['source'] == 'learned']
+            if len(learned) > self.max_plans:
+                oldest = min(learned, key=lambda p: p['created_at'])
+                self._plans.remove(oldest)
+        return True
+
+    def _fill(self, entry, slot_values):
+        """判斷既有計劃能否安全參數化，可以則回傳填入新值後的說明，否則回傳 None
+
+        只替換變動的值 (與其別名)，其餘保留原本說明的用詞
+        """
+        if set(slot_values) != set(entry['slot_values']):
+            return None
+        replacements = {}
+        for slot, value in slot_values.items():
+            if value == entry['slot_values'][slot]:
+                continue
+            if not self._can_vary(entry, slot):
+                return None
+            for name in self._names(entry['slot_values'][slot]):
+                replacements[name] = value
+        if not replacements:
+            return list(entry['raw_steps'])
+        # 一次掃描替換，互換兩個值時不會互相覆蓋
+        return [self._term_re.sub(lambda m: replacements.get(m.group(), m.group()), step)
+                for step in entry['raw_steps']]
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    def match(self, text):
+        """尋找可直接套用的計劃，回傳 {"動作順序", "說明"} 或 None"""
+        template, slot_values = self._templatize(text)
+        key = normalize_text(template)
+        if not key:
+            return None
+        vector = embed_text(template)
+
+        action_codes = self.action_codes
+        with self._lock:
+            candidates = []
+            for entry in self._plans:
+                # 動作清單重新載入後，含已移除代號的計劃不再使用
+                if action_codes and not set(entry['動作順序']) <= action_codes:
+                    continue
+                sim = 1.0 if entry['key'] == key else cosine_similarity(vector, entry['vector'])
+                if sim >= self.similarity_threshold:
+                    candidates.append((sim, entry))
+        for sim, entry in sorted(candidates, key=lambda item: item[0], reverse=True):
+            steps = self._fill(entry, slot_values)
+            if steps is None:
+                continue
+            entry['hits'] += 1
+            logger.info(f"動作計劃庫命中 (相似度 {sim:.2f}): {entry['task']}")
+            return {"動作順序": list(entry['動作順序']), "說明": steps}
+        return None
+
+    def add(self, text, plan):
+        """加入一份已驗證的計劃並持久化"""
+        if self._add(text, plan, source='learned'):
+            self._save_learned()
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
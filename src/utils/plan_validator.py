@@ -0,0 +1,145 @@
+import re
+import json
+import threading
+
+
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+
+class IncrementalJSONExtractor:
+    """逐段餵入模型輸出，偵測到第一個完整的 JSON 物件時立即取出。
+
+    會略過 ```json 圍欄與前後說明文字，並正確處理字串中的括號與跳脫字元，
+    可直接用在串流回應上，不需等整個回應結束。
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._started = False
+        self.result = None
+
+    def feed(self, chunk):
+        """餵入一段文字；取得完整物件時回傳其字串，否則回傳 None"""
+        if self.result is not None:
+            return self.result
+        for char in chunk:
+            if not self._started:
+                if char != "{":
+                    continue
+                self._started = True
+
+            self._buffer.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.result = "".join(self._buffer)
+                    return self.result
+        return None
+
+
+def extract_json_object(text):
+    """從模型回覆中取出第一個 JSON 物件並解析，容忍圍欄、前後文字與結尾多餘逗號"""
+    extractor = IncrementalJSONExtractor()
+    json_str = extractor.feed(text)
+    if json_str is None:
+        raise ValueError("回應中找不到完整的JSON物件")
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError:
+        return json.loads(_TRAILING_COMMA_RE.sub(r"\1", json_str))
+
+
+class PlanValidator:
+    """本地驗證動作計劃的結構與動作代號，並統計需要修復的比例"""
+
+    def __init__(self, action_codes):
+        """
+        Args:
+            action_codes: 合法動作代號，或每次驗證時回傳代號的函式 (動作清單可能重新載入)
+        """
+        self._action_codes = action_codes
+        self._lock = threading.Lock()
+        self.stats = {"plans": 0, "invalid": 0, "repairs": 0, "repair_failures": 0}
+
+    @property
+    def action_codes(self):
+        """目前的合法動作代號 (字串集合)"""
+        codes = self._action_codes() if callable(self._action_codes) else self._action_codes
+        return {str(code) for code in codes}
+
+    def validate(self, plan):
+        """回傳錯誤訊息列表；空列表代表計劃有效。整數代號會就地轉成字串"""
+        if not isinstance(plan, dict):
+            return ["回覆必須是 JSON 物件"]
+        errors = []
+        for key in ("動作順序", "說明"):
+            if key not in plan:
+                errors.append(f"缺少欄位「{key}」")
+            elif not isinstance(plan[key], list):
+                errors.append(f"欄位「{key}」必須是列表")
+        if errors:
+            return errors
+
+        plan["動作順序"] = [str(code) for code in plan["動作順序"]]
+        if not plan["動作順序"]:
+            errors.append("「動作順序」不可為空")
+        action_codes = self.action_codes
+        unknown = [code for code in plan["動作順序"] if code not in action_codes]
+        if unknown:
+            errors.append(f"動作代號 {', '.join(unknown)} 不在動作清單中，只能使用 {', '.join(sorted(action_codes))}")
+        if not plan["說明"] or not all(isinstance(step, str) and step.strip() for step in plan["說明"]):
+            errors.append("「說明」必須是非空字串組成的列表")
+        return errors
+
+    def parse(self, text):
+        """解析並驗證模型回覆，回傳 (計劃或 None, 錯誤訊息列表)"""
+        try:
+            plan = extract_json_object(text)
+        except (json.JSONDecodeError, ValueError) as e:
+            return None, [f"無法解析為JSON: {e}"]
+        return plan, self.validate(plan)
+
+    def record(self, invalid=False, repaired=False, failed=False):
+        """記錄一次計劃處理結果
+
+        Args:
+            invalid: 首次回覆是否未通過驗證
+            repaired: 修復請求後是否得到有效計劃
+            failed: 修復後是否仍然無效
+        """
+        with self._lock:
+            self.stats["plans"] += 1
+            self.stats["invalid"] += int(invalid)
+            self.stats["repairs"] += int(repaired)
+            self.stats["repair_failures"] += int(failed)
+
+    @property
+    def repair_rate(self):
+        """首次回覆未通過驗證、需要修復的比例"""
+        with self._lock:
+            if not self.stats["plans"]:
+                return 0.0
+            return self.stats["invalid"] / self.stats["plans"]
+
+    def metrics(self):
+        """匯出計劃驗證指標"""
+        with self._lock:
+            metrics = dict(self.stats)
+        metrics["repair_rate"] = self.repair_rate
+        return metrics
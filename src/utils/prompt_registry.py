@@ -0,0 +1,81 @@
+import os
+import json
+import threading
+from utils.log import get_logger
+
+logger = get_logger("prompts")
+
+
+class PromptRegistry:
+    """提示詞模板註冊表：靜態部分只載入、渲染一次，資產檔的 mtime 改變時才重新載入。"""
+
+    def __init__(self, assets_dir=None):
+        self.assets_dir = assets_dir or os.path.join(os.path.dirname(__file__), '../../assets')
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _resolve(self, path):
+        """相對路徑以 assets 目錄為基準"""
+        if os.path.isabs(path):
+            return path
+        return os.path.join(self.assets_dir, path)
+
+    def _refresh(self, name):
+        """檢查資產檔 mtime，有變動時重新解析並渲染"""
+        entry = self._entries[name]
+        mtime = os.stat(entry['path']).st_mtime_ns
+        if entry['mtime'] == mtime:
+            return entry
+
+        with open(entry['path'], 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        entry['data'] = data
+        entry['rendered'] = entry['render'](data)
+        entry['mtime'] = mtime
+        if entry['loaded']:
+            logger.info(f"資產檔已更新，重新載入提示詞模板: {name}")
+        entry['loaded'] = True
+        return entry
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    def register(self, name, path, render=None):
+        """註冊一個由 JSON 資產檔產生的模板
+
+        Args:
+            name: 模板名稱
+            path: 資產檔路徑（相對於 assets 目錄）
+            render: 將解析後的 JSON 轉成靜態提示詞文字的函式
+        """
+        with self._lock:
+            self._entries[name] = {
+                'path': self._resolve(path),
+                'render': render or (lambda data: json.dumps(data, ensure_ascii=False, indent=2)),
+                'mtime': None,
+                'data': None,
+                'rendered': None,
+                'loaded': False
+            }
+
+    def get(self, name):
+        """取得渲染後的靜態提示詞"""
+        with self._lock:
+            return self._refresh(name)['rendered']
+
+    def get_data(self, name):
+        """取得資產檔解析後的原始資料"""
+        with self._lock:
+            return self._refresh(name)['data']
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
+
+
+def cached_system_blocks(text, enable_cache=True):
+    """將靜態系統提示詞包成 Bedrock Anthropic 的 system 區塊，並標記可快取
+
+    Bedrock 會快取帶有 cache_control 的前綴，後續請求只需預填變動的部分。
+    """
+    block = {"type": "text", "text": text}
+    if enable_cache:
+        block["cache_control"] = {"type": "ephemeral"}
+    return [block]
@@ -0,0 +1,53 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+
+
+class JsonlSink:
+    """將每一輪的結果以 JSON Lines 寫入檔案，並統計吞吐量"""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(
+            os.path.dirname(__file__), '../../data/results',
+            f"results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._started = time.time()
+        self.count = 0
+
+    def write(self, turn):
+        """寫入一輪結果；可作為管線最後一個階段"""
+        record = {
+            'turn_id': turn.turn_id,
+            'trace_id': turn.trace_id,
+            'seq': turn.seq,
+            'audio_file': os.path.basename(turn.audio_file) if turn.audio_file else None,
+            'speaker_id': turn.speaker_id,
+            'similarity': round(float(turn.similarity), 4),
+            'transcript': turn.transcript,
+            'command_type': turn.command_type,
+            'response': turn.response.content if turn.response is not None else None,
+            'skipped': turn.skipped,
+            'shed': getattr(turn, 'shed', None),
+            'merged_seqs': getattr(turn, 'merged_seqs', []),
+            'latency_s': round(time.time() - turn.created_at, 3),
+            'finished_at': datetime.now().isoformat()
+        }
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            self.count += 1
+        return turn
+
+    def summary(self):
+        """回傳處理數量與每秒處理輪數"""
+        elapsed = time.time() - self._started
+        return {'turns': self.count, 'elapsed_s': round(elapsed, 2),
+                'turns_per_s': round(self.count / elapsed, 3) if elapsed > 0 else 0.0}
+
+    def close(self):
+        with self._lock:
+            self._file.close()
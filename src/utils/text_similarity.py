@@ -0,0 +1,59 @@
+import re
+import math
+import zlib
+import unicodedata
+
+
+# 不影響語意的客套用語，只在句首 / 句尾移除 (句中的「酒吧」、「申請」等詞不受影響)；
+# 單字的「請」、「吧」常是詞的一部分 (請假、酒吧)，不列入
+LEADING_FILLERS = ["請問", "請你", "請幫我", "幫我", "麻煩你", "麻煩", "可以"]
+TRAILING_FILLERS = ["一下", "嗎", "呢"]
+
+_PUNCTUATION_RE = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def _strip_fillers(text):
+    """反覆移除句首與句尾的客套用語 (例如「可以幫我…嗎」)"""
+    changed = True
+    while changed and text:
+        changed = False
+        for word in LEADING_FILLERS:
+            if text.startswith(word) and len(text) > len(word):
+                text, changed = text[len(word):], True
+        for word in TRAILING_FILLERS:
+            if text.endswith(word) and len(text) > len(word):
+                text, changed = text[:-len(word)], True
+    return text
+
+
+def normalize_text(text):
+    """正規化文字：全半形統一、轉小寫、移除標點空白與句首句尾的客套用語"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _PUNCTUATION_RE.sub("", text)
+    return _strip_fillers(text)
+
+
+def embed_text(text, dim=512, ngram_sizes=(1, 2, 3)):
+    """以字元 n-gram 雜湊產生本地稀疏向量 (不需要外部模型)
+
+    回傳 {維度索引: 權重} 且已做 L2 正規化，適合短中文句子的相似度比對。
+    """
+    normalized = normalize_text(text)
+    vector = {}
+    for n in ngram_sizes:
+        for i in range(len(normalized) - n + 1):
+            gram = normalized[i:i + n]
+            index = zlib.crc32(gram.encode("utf-8")) % dim
+            # 較長的 n-gram 攜帶較多語序資訊，給予較高權重
+            vector[index] = vector.get(index, 0.0) + float(n)
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    if norm == 0:
+        return {}
+    return {k: v / norm for k, v in vector.items()}
+
+
+def cosine_similarity(vec_a, vec_b):
+    """計算兩個已正規化稀疏向量的餘弦相似度"""
+    if len(vec_a) > len(vec_b):
+        vec_a, vec_b = vec_b, vec_a
+    return sum(v * vec_b.get(k, 0.0) for k, v in vec_a.items())
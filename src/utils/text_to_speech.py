@@ -1,111 +1,265 @@
 import os
+import io
 import json
-import requests
+import uuid
+import time
+import wave
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import pygame
+import threading
 from dotenv import load_dotenv
-import base64
-from google.cloud import texttospeech
-from google.oauth2 import service_account
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.tracing import get_tracer
+from utils.assistant_response import AssistantResponse, split_sentences
+from utils.tts_cache import TTSCache
+from audio.playback import PCMPlayer, PygamePlayer, completed
+from utils.log import get_logger, shorten
 
 # 加載環境變量
 load_dotenv(os.path.join(os.path.dirname(__file__), '../config/.env'))
 
+logger = get_logger("tts")
+
 class ResponseSpeaker:
     def __init__(self):
-        # 加載服務賬號認證
-        credentials_path = os.path.join(os.path.dirname(__file__), '../config/google_cloud_credentials.json')
-        credentials = service_account.Credentials.from_service_account_file(credentials_path)
-        
-        # 初始化客戶端
-        self.client = texttospeech.TextToSpeechClient(credentials=credentials)
+        # 服務賬號認證與客戶端延後到第一次合成時才建立 (匯入 google.cloud 約需數百毫秒)
+        self.credentials_path = os.path.join(os.path.dirname(__file__), '../config/google_cloud_credentials.json')
+        self._client = None
+        self._texttospeech = None
+        self._client_lock = threading.Lock()
         
         # 設置語音參數
-        self.voice = texttospeech.VoiceSelectionParams(
-            language_code='cmn-Hant-TW',
-            name='cmn-TW-Standard-A',
-            ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
-        )
+        self.language_code = 'cmn-Hant-TW'
+        self.voice_name = 'cmn-TW-Standard-A'
         
-        # 設置音訊參數
-        self.audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3,
-            speaking_rate=1.0,
-            pitch=0.0
-        )
+        # 設置音訊參數：要求 16-bit PCM，直接寫入音訊裝置，不經 MP3 檔與解碼
+        self.sample_rate = 16000
+        self.speaking_rate = 1.0
+        self.pitch = 0.0
+        
+        # 相同 (文字, 聲音, 語速, 格式) 的合成結果直接取自快取，不經網路
+        self.tts_cache = TTSCache() if os.getenv('TTS_CACHE', '1') == '1' else None
+        
+        # 分段播放時，播放目前這段的同時最多預先合成幾段
+        self.synth_concurrency = max(1, int(os.getenv('TTS_SYNTH_CONCURRENCY', 2)))
+        self._synth_executor = ThreadPoolExecutor(max_workers=self.synth_concurrency,
+                                                  thread_name_prefix="tts-synth")
+        
+        # 播放器：排入音訊後立即回傳 Future，播完或被中斷時完成；音訊檔由 pygame 播放
+        self.player = PCMPlayer(sample_rate=self.sample_rate)
+        self.file_player = PygamePlayer()
         
-        # 初始化 pygame 用於播放音訊
-        pygame.mixer.init()
+        # 插話時由其他執行緒要求停止播放
+        self._stop_requested = threading.Event()
         
-        # 創建音訊文件存儲目錄
+        # 音訊存檔 (選用)：TTS_ARCHIVE=1 時每次合成結果另存一份到 data/audio_output
+        self.archive = os.getenv('TTS_ARCHIVE', '0') == '1'
         self.audio_dir = os.path.join(os.path.dirname(__file__), '../../data/audio_output')
-        os.makedirs(self.audio_dir, exist_ok=True)
 
-    def text_to_speech(self, text):
-        """將文本轉換為語音並保存為文件"""
-        try:
-            # 構建合成請求
-            synthesis_input = texttospeech.SynthesisInput(text=text)
-            
-            # 發送請求
-            response = self.client.synthesize_speech(
-                input=synthesis_input,
-                voice=self.voice,
-                audio_config=self.audio_config
+    @property
+    def client(self):
+        """Google Text-to-Speech 客戶端，第一次存取時才匯入套件並建立"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from google.cloud import texttospeech
+                    from google.oauth2 import service_account
+                    credentials = service_account.Credentials.from_service_account_file(self.credentials_path)
+                    self._texttospeech = texttospeech
+                    self._client = texttospeech.TextToSpeechClient(credentials=credentials)
+        return self._client
+
+    def _synthesize_remote(self, text):
+        """呼叫 Google 合成語音，回傳含標頭的 WAV 位元組"""
+        client = self.client
+        texttospeech = self._texttospeech
+        response = client.synthesize_speech(
+            input=texttospeech.SynthesisInput(text=text),
+            voice=texttospeech.VoiceSelectionParams(
+                language_code=self.language_code,
+                name=self.voice_name,
+                ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
+            ),
+            audio_config=texttospeech.AudioConfig(
+                audio_encoding=texttospeech.AudioEncoding.LINEAR16,
+                sample_rate_hertz=self.sample_rate,
+                speaking_rate=self.speaking_rate,
+                pitch=self.pitch
             )
-            
-            # 生成文件名
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            audio_file = os.path.join(self.audio_dir, f'speech_{timestamp}.mp3')
-            
-            # 保存音訊文件
-            with open(audio_file, 'wb') as out:
-                out.write(response.audio_content)
-                
-            return audio_file
+        )
+        return response.audio_content
+
+    def synthesize(self, text, archive=None):
+        """將文本轉換為 16-bit PCM 位元組 (不含 WAV 標頭)；快取命中時不呼叫 Google
+
+        Args:
+            archive: 是否另存 WAV 檔 (預設依 TTS_ARCHIVE)
+        """
+        archive = self.archive if archive is None else archive
+        try:
+            key, audio_content = None, None
+            if self.tts_cache is not None:
+                key = self.tts_cache.key(text, self.voice_name, self.speaking_rate, 'pcm',
+                                         engine='google', language=self.language_code,
+                                         pitch=self.pitch, sample_rate=self.sample_rate)
+                audio_content = self.tts_cache.get(key)
+
+            if audio_content is None:
+                # LINEAR16 回傳的是含標頭的 WAV，只保留 PCM 資料
+                with wave.open(io.BytesIO(self._synthesize_remote(text)), 'rb') as wf:
+                    audio_content = wf.readframes(wf.getnframes())
+                if key is not None:
+                    self.tts_cache.put(key, audio_content, 'pcm')
+            if archive:
+                self._archive_audio(audio_content)
+            return audio_content
             
         except Exception as e:
-            print(f"轉換語音時出錯: {str(e)}")
+            logger.error(f"轉換語音時出錯: {str(e)}")
             return None
 
-    def play_audio(self, audio_file):
-        """播放音訊文件"""
-        if audio_file and os.path.exists(audio_file):
-            try:
-                pygame.mixer.music.load(audio_file)
-                pygame.mixer.music.play()
-                while pygame.mixer.music.get_busy():
-                    pygame.time.Clock().tick(10)
-            except Exception as e:
-                print(f"播放音訊時出錯: {str(e)}")
+    def _archive_audio(self, audio_content):
+        """將 PCM 存成 WAV 檔 (毫秒時間戳 + 隨機碼，同一秒內不會互相覆蓋)"""
+        os.makedirs(self.audio_dir, exist_ok=True)
+        name = f"speech_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')[:-3]}_{uuid.uuid4().hex[:6]}.wav"
+        audio_file = os.path.join(self.audio_dir, name)
+        with wave.open(audio_file, 'wb') as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(self.sample_rate)
+            wf.writeframes(audio_content)
+        return audio_file
+
+    @staticmethod
+    def _log_playback(playback):
+        if playback.result():
+            logger.debug("語音播放完成！")
         else:
-            print("音訊文件不存在或生成失敗")
+            logger.info("語音播放已被中斷")
+
+    def text_to_speech(self, text):
+        """將文本轉換為語音並保存為 WAV 文件"""
+        self._stop_requested.clear()
+        audio_content = self.synthesize(text, archive=False)
+        if audio_content is None:
+            return None
+        try:
+            return self._archive_audio(audio_content)
+        except Exception as e:
+            logger.error(f"保存語音文件時出錯: {str(e)}")
+            return None
+
+    def play_audio(self, audio, wait=True):
+        """播放音訊並回傳 Future (結果為是否完整播放)：PCM 位元組直接寫入音訊裝置，音訊檔由 pygame 播放
+
+        Args:
+            wait: 是否等到播完才返回
+        """
+        # 合成期間已被插話中斷時不再播放
+        if self._stop_requested.is_set():
+            return completed(False)
+        try:
+            if isinstance(audio, (bytes, bytearray)):
+                playback = self.player.play(audio)
+            elif audio and os.path.exists(audio):
+                playback = self.file_player.play(audio)
+            else:
+                logger.warning("音訊文件不存在或生成失敗")
+                return completed(False)
+            if wait:
+                playback.result()
+            return playback
+        except Exception as e:
+            logger.error(f"播放音訊時出錯: {str(e)}")
+            return completed(False)
+
+    def stop_playback(self):
+        """立即停止目前的播放 (可從其他執行緒呼叫)"""
+        self._stop_requested.set()
+        self.player.stop()
+        self.file_player.stop()
+
+    @property
+    def interrupted(self):
+        """最近一次播放是否被中斷"""
+        return self._stop_requested.is_set()
+
+    def speak_segments(self, segments, wait=True):
+        """逐段合成並依序播放：播放目前這段的同時預先合成後面的段落 (最多 synth_concurrency 段)
+
+        被插話中斷時不再播放後面的段落。回傳最後一段的播放 Future。
+
+        Args:
+            wait: 是否等到播完才返回；False 時所有段落排入播放後即返回
+        """
+        segments = [segment for segment in segments if segment and segment.strip()]
+        if not segments:
+            return completed(True)
+        self._stop_requested.clear()
+        started = time.time()
+        upcoming = iter(segments[1:])
+        in_flight = deque()
+
+        def submit_ahead():
+            while len(in_flight) < self.synth_concurrency:
+                segment = next(upcoming, None)
+                if segment is None:
+                    return
+                # 沿用目前的追蹤 ID，合成的 span 才會歸到這一輪
+                context = contextvars.copy_context()
+                in_flight.append(self._synth_executor.submit(context.run, self.synthesize, segment))
+
+        submit_ahead()
+        try:
+            # Google 的合成結果一次回傳，第一段合成完即開始播放
+            first = self.synthesize(segments[0])
+            get_tracer().record('tts_first_audio', time.time() - started, start=started,
+                                segments=len(segments))
+            playback = self.play_audio(first, wait=False) if first else completed(False)
+            while in_flight and not self._stop_requested.is_set():
+                audio_content = in_flight.popleft().result()
+                submit_ahead()
+                if audio_content and not self._stop_requested.is_set():
+                    playback = self.play_audio(audio_content, wait=False)
+        finally:
+            # 尚未開始的合成不再需要；已在進行中的會完成並寫入快取
+            for future in in_flight:
+                future.cancel()
+        if wait:
+            playback.result()
+        return playback
+
+    def speak_text(self, text, wait=True):
+        """分句後合成並播放一段文字，回傳播放的 Future"""
+        return self.speak_segments(split_sentences(text), wait=wait)
+
+    def speak_response(self, response, wait=True):
+        """直接合成並播放處理結果 (AssistantResponse)，不經過歷史記錄檔；回傳播放的 Future
+
+        Args:
+            wait: 是否等到播完才返回；False 時合成完並排入播放後即返回，呼叫端可繼續其他工作
+        """
+        segments = response.speech_segments
+        if not segments:
+            return completed(True)
+        logger.info(f"正在轉換文本為語音 ({len(segments)} 段)：{shorten(response.speech_text)}")
+        
+        # 分段轉換並直接從記憶體播放
+        playback = self.speak_segments(segments, wait=wait)
+        playback.add_done_callback(self._log_playback)
+        return playback
 
     def process_history_file(self, file_path):
         """處理歷史記錄文件並播放對應的回應"""
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-            
-            # 根據文件類型提取要播放的文本
-            if 'movement_plan' in data:  # movement_history
-                text = "\n".join(data['movement_plan']['說明'])
-            elif 'response' in data:  # chat_history 或 query_history
-                text = data['response']
-            else:
-                raise ValueError("不支援的文件格式")
-            
-            print(f"正在轉換文本為語音：\n{text}\n")
-            
-            # 轉換並播放
-            audio_file = self.text_to_speech(text)
-            if audio_file:
-                print(f"開始播放語音...")
-                self.play_audio(audio_file)
-                print(f"語音播放完成！\n")
-            
+            self.speak_response(AssistantResponse.from_history_record(data))
         except Exception as e:
-            print(f"處理文件時出錯: {str(e)}")
+            logger.error(f"處理文件時出錯: {str(e)}")
 
 def main():
     speaker = ResponseSpeaker()
@@ -120,10 +274,10 @@ def main():
     for file_path in test_files:
         abs_path = os.path.join(os.path.dirname(__file__), file_path)
         if os.path.exists(abs_path):
-            print(f"\n處理文件: {file_path}")
+            logger.info(f"處理文件: {file_path}")
             speaker.process_history_file(abs_path)
         else:
-            print(f"文件不存在: {file_path}")
+            logger.warning(f"文件不存在: {file_path}")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
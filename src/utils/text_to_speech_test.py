@@ -1,100 +1,303 @@
 import os
 import json
-import requests
+import time
+import uuid
+import wave
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
 from datetime import datetime
-import pygame
+import threading
 from dotenv import load_dotenv
-import base64
-import boto3
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.async_clients import create_backend_client
+from utils.tracing import traced, get_tracer
+from utils.assistant_response import AssistantResponse, split_sentences
+from utils.tts_cache import TTSCache
+from audio.playback import PCMPlayer, PygamePlayer, completed
+from utils.log import get_logger, shorten
 
 # 加載環境變量
 load_dotenv(os.path.join(os.path.dirname(__file__), '../config/.env'))
 
+logger = get_logger("tts")
+
 class ResponseSpeaker:
     def __init__(self):
-        # 設置 AWS Polly 客戶端
-        self.client = boto3.client(
-            "polly", 
-            region_name="us-east-1",
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-        )
+        # 設置 AWS Polly 客戶端 (含期限與重試)；回應是邊下載邊播放的串流，不送避險請求
+        # (落敗的請求只會被放棄等待，其 StreamingBody 與連線不會被關閉)
+        self.tts_client = create_backend_client("polly", "polly", region_name="us-east-1",
+                                                deadline=10.0, attempt_timeout=5.0)
+        # boto3 客戶端在第一次合成時才建立 (見 AsyncBackendClient.raw)
         
-        # 設置語音參數
+        # 設置語音參數；預設要求 16-bit PCM，直接寫入音訊裝置，不經檔案與解碼 (TTS_FORMAT=mp3 時改用 pygame)
         self.voice_id = "Zhiyu"  # 中文女聲
         self.language_code = "cmn-CN"
-        self.output_format = "mp3"
+        self.output_format = os.getenv('TTS_FORMAT', 'pcm')
+        self.sample_rate = 16000  # Polly 的 PCM 最高 16 kHz
+        self.speaking_rate = float(os.getenv('TTS_RATE', 1.0))
+        
+        # 相同 (文字, 聲音, 語速, 格式) 的合成結果直接取自快取，不經網路
+        self.tts_cache = TTSCache() if os.getenv('TTS_CACHE', '1') == '1' else None
+        
+        # 分段播放時，播放目前這段的同時最多預先合成幾段
+        self.synth_concurrency = max(1, int(os.getenv('TTS_SYNTH_CONCURRENCY', 2)))
+        self._synth_executor = ThreadPoolExecutor(max_workers=self.synth_concurrency,
+                                                  thread_name_prefix="tts-synth")
+        
+        # 播放器：排入音訊後立即回傳 Future，播完或被中斷時完成，不佔用呼叫的執行緒
+        # PCM 直接寫入音訊裝置；MP3 與音訊檔由 pygame 播放 (第一次使用時才匯入)
+        self.player = PCMPlayer(sample_rate=self.sample_rate)
+        self.file_player = PygamePlayer()
         
-        # 初始化 pygame 用於播放音訊
-        pygame.mixer.init()
+        # 插話時由其他執行緒要求停止播放
+        self._stop_requested = threading.Event()
         
-        # 創建音訊文件存儲目錄
+        # 音訊存檔 (選用)：TTS_ARCHIVE=1 時每段合成結果另存一份到 data/audio_output
+        self.archive = os.getenv('TTS_ARCHIVE', '0') == '1'
         self.audio_dir = os.path.join(os.path.dirname(__file__), '../../data/audio_output')
-        os.makedirs(self.audio_dir, exist_ok=True)
 
-    def text_to_speech(self, text):
-        """將文本轉換為語音並保存為文件"""
-        try:
-            # 調用 Polly 語音合成
-            response = self.client.synthesize_speech(
-                Text=text,
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _cache_key(self, text):
+        if self.tts_cache is None:
+            return None
+        extra = {'sample_rate': self.sample_rate} if self.output_format == 'pcm' else {}
+        return self.tts_cache.key(text, self.voice_id, self.speaking_rate, self.output_format,
+                                  engine='polly', language=self.language_code, **extra)
+
+    def _request_stream(self, text):
+        """呼叫 Polly 並回傳尚未讀取的音訊串流；非預設語速以 SSML 指定"""
+        request = {'Text': text}
+        if self.speaking_rate != 1.0:
+            rate = f"{self.speaking_rate * 100:.0f}%"
+            request = {'Text': f'<speak><prosody rate="{rate}">{escape(text)}</prosody></speak>',
+                       'TextType': 'ssml'}
+        if self.output_format == 'pcm':
+            request['SampleRate'] = str(self.sample_rate)
+
+        def synthesize():
+            response = self.tts_client.raw.synthesize_speech(
                 OutputFormat=self.output_format,
                 VoiceId=self.voice_id,
-                LanguageCode=self.language_code
+                LanguageCode=self.language_code,
+                **request
             )
-            
-            # 生成文件名
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            audio_file = os.path.join(self.audio_dir, f'speech_{timestamp}.mp3')
-            
-            # 保存音訊文件
+            return response["AudioStream"]
+
+        return self.tts_client.call_sync(synthesize, hedge=False)
+
+    def _archive_audio(self, audio_bytes):
+        """另存一份合成結果；PCM 存成 WAV 以便直接播放"""
+        os.makedirs(self.audio_dir, exist_ok=True)
+        # 毫秒時間戳 + 隨機碼，同一秒內的多段不會互相覆蓋
+        name = f"speech_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')[:-3]}_{uuid.uuid4().hex[:6]}"
+        if self.output_format == 'pcm':
+            audio_file = os.path.join(self.audio_dir, f"{name}.wav")
+            with wave.open(audio_file, 'wb') as wf:
+                wf.setnchannels(1)
+                wf.setsampwidth(2)
+                wf.setframerate(self.sample_rate)
+                wf.writeframes(audio_bytes)
+        else:
+            audio_file = os.path.join(self.audio_dir, f"{name}.{self.output_format}")
             with open(audio_file, 'wb') as out:
-                out.write(response["AudioStream"].read())
-                
-            return audio_file
-            
+                out.write(audio_bytes)
+        return audio_file
+
+    @staticmethod
+    def _log_playback(playback):
+        if playback.result():
+            logger.debug("語音播放完成！")
+        else:
+            logger.info("語音播放已被中斷")
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    def synthesize_stream(self, text, chunk_size=4096, archive=None):
+        """合成語音並在資料到達時逐塊產生，不必等整段音訊下載完；快取命中時一次產生整段
+
+        Args:
+            archive: 是否另存音訊檔 (預設依 TTS_ARCHIVE)
+        """
+        archive = self.archive if archive is None else archive
+        key = self._cache_key(text)
+        if key is not None:
+            audio_bytes = self.tts_cache.get(key)
+            if audio_bytes is not None:
+                logger.debug(f"語音快取命中：{shorten(text)}")
+                yield audio_bytes
+                if archive:
+                    self._archive_audio(audio_bytes)
+                return
+        try:
+            stream = self._request_stream(text)
         except Exception as e:
-            print(f"轉換語音時出錯: {str(e)}")
+            logger.error(f"轉換語音時出錯: {str(e)}")
+            return
+
+        received = []
+        try:
+            for chunk in stream.iter_chunks(chunk_size):
+                received.append(chunk)
+                yield chunk
+        except Exception as e:
+            logger.error(f"接收語音資料時出錯: {str(e)}")
+            return
+        finally:
+            stream.close()
+
+        # 完整收到才寫入快取 (播放中途被打斷時不保存不完整的音訊)
+        audio_bytes = b"".join(received)
+        if key is not None:
+            self.tts_cache.put(key, audio_bytes, self.output_format)
+        if archive:
+            self._archive_audio(audio_bytes)
+
+    @traced('text_to_speech')
+    def synthesize(self, text, archive=None):
+        """將文本轉換為語音並回傳完整的音訊位元組；快取命中時不呼叫 Polly"""
+        audio_bytes = b"".join(self.synthesize_stream(text, archive=archive))
+        return audio_bytes or None
+
+    def text_to_speech(self, text):
+        """將文本轉換為語音並保存為文件 (PCM 存為 WAV)"""
+        self._stop_requested.clear()
+        audio_bytes = self.synthesize(text, archive=False)
+        if audio_bytes is None:
+            return None
+        try:
+            return self._archive_audio(audio_bytes)
+        except Exception as e:
+            logger.error(f"保存語音文件時出錯: {str(e)}")
             return None
 
-    def play_audio(self, audio_file):
-        """播放音訊文件"""
-        if audio_file and os.path.exists(audio_file):
-            try:
-                pygame.mixer.music.load(audio_file)
-                pygame.mixer.music.play()
-                while pygame.mixer.music.get_busy():
-                    pygame.time.Clock().tick(10)
-            except Exception as e:
-                print(f"播放音訊時出錯: {str(e)}")
-        else:
-            print("音訊文件不存在或生成失敗")
+    @traced()
+    def play_audio(self, audio, wait=True):
+        """播放音訊並回傳 Future (結果為是否完整播放)
+
+        PCM 位元組或逐塊產生的 PCM 直接寫入音訊裝置；MP3 位元組與音訊檔由 pygame 播放。
+        前一段還在播放時接在其後，不會有空隙。
+
+        Args:
+            wait: 是否等到播完才返回；False 時排入後立即返回，
+                可用 Future 的 add_done_callback() 或 asyncio.wrap_future() 得知播完
+        """
+        # 合成期間已被插話中斷時不再播放
+        if self._stop_requested.is_set():
+            return completed(False)
+        try:
+            if isinstance(audio, str):
+                if not os.path.exists(audio):
+                    logger.warning("音訊文件不存在或生成失敗")
+                    return completed(False)
+                playback = self.file_player.play(audio)
+            elif self.output_format == 'pcm':
+                playback = self.player.play(audio)
+            elif audio:
+                playback = self.file_player.play(audio)
+            else:
+                logger.warning("音訊文件不存在或生成失敗")
+                return completed(False)
+            if wait:
+                playback.result()
+            return playback
+        except Exception as e:
+            logger.error(f"播放音訊時出錯: {str(e)}")
+            return completed(False)
+
+    def stop_playback(self):
+        """立即停止目前的播放 (可從其他執行緒呼叫)"""
+        self._stop_requested.set()
+        self.player.stop()
+        self.file_player.stop()
+
+    @property
+    def interrupted(self):
+        """最近一次播放是否被中斷"""
+        return self._stop_requested.is_set()
+
+    def speak_segments(self, segments, wait=True):
+        """逐段合成並依序播放：第一段邊接收邊播放，同時預先合成後面的段落 (最多 synth_concurrency 段)
+
+        被插話中斷時不再播放後面的段落。回傳最後一段的播放 Future。
+
+        Args:
+            wait: 是否等到播完才返回；False 時所有段落排入播放後即返回
+        """
+        segments = [segment for segment in segments if segment and segment.strip()]
+        if not segments:
+            return completed(True)
+        self._stop_requested.clear()
+        started = time.time()
+        upcoming = iter(segments[1:])
+        in_flight = deque()
+
+        def submit_ahead():
+            while len(in_flight) < self.synth_concurrency:
+                segment = next(upcoming, None)
+                if segment is None:
+                    return
+                # 沿用目前的追蹤 ID，合成的 span 才會歸到這一輪
+                context = contextvars.copy_context()
+                in_flight.append(self._synth_executor.submit(context.run, self.synthesize, segment))
+
+        def first_audio(chunks):
+            for i, chunk in enumerate(chunks):
+                if i == 0:
+                    get_tracer().record('tts_first_audio', time.time() - started, start=started,
+                                        segments=len(segments))
+                yield chunk
+
+        submit_ahead()
+        try:
+            first = first_audio(self.synthesize_stream(segments[0]))
+            if self.output_format != 'pcm':
+                first = b"".join(first)  # MP3 需完整下載後才能交給 pygame
+            playback = self.play_audio(first, wait=False)
+            while in_flight and not self._stop_requested.is_set():
+                audio_bytes = in_flight.popleft().result()
+                submit_ahead()
+                if audio_bytes and not self._stop_requested.is_set():
+                    playback = self.play_audio(audio_bytes, wait=False)
+        finally:
+            # 尚未開始的合成不再需要；已在進行中的會完成並寫入快取
+            for future in in_flight:
+                future.cancel()
+        if wait:
+            playback.result()
+        return playback
+
+    def speak_text(self, text, wait=True):
+        """分句後合成並播放一段文字，回傳播放的 Future"""
+        return self.speak_segments(split_sentences(text), wait=wait)
+
+    def speak_response(self, response, wait=True):
+        """直接合成並播放處理結果 (AssistantResponse)，不經過歷史記錄檔；回傳播放的 Future
+
+        Args:
+            wait: 是否等到播完才返回；False 時合成完並排入播放後即返回，呼叫端可繼續其他工作
+        """
+        segments = response.speech_segments
+        if not segments:
+            return completed(True)
+        logger.debug(f"正在轉換文本為語音 ({len(segments)} 段)：{shorten(response.speech_text)}")
+        
+        # 分段轉換並直接從記憶體播放
+        playback = self.speak_segments(segments, wait=wait)
+        playback.add_done_callback(self._log_playback)
+        return playback
 
     def process_history_file(self, file_path):
         """處理歷史記錄文件並播放對應的回應"""
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-            
-            # 根據文件類型提取要播放的文本
-            if 'movement_plan' in data:  # movement_history
-                text = "\n".join(data['movement_plan']['說明'])
-            elif 'response' in data:  # chat_history 或 query_history
-                text = data['response']
-            else:
-                raise ValueError("不支援的文件格式")
-            
-            print(f"正在轉換文本為語音：\n{text}\n")
-            
-            # 轉換並播放
-            audio_file = self.text_to_speech(text)
-            if audio_file:
-                print(f"開始播放語音...")
-                self.play_audio(audio_file)
-                print(f"語音播放完成！\n")
-            
+            self.speak_response(AssistantResponse.from_history_record(data))
         except Exception as e:
-            print(f"處理文件時出錯: {str(e)}")
+            logger.error(f"處理文件時出錯: {str(e)}")
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
 
 def main():
     speaker = ResponseSpeaker()
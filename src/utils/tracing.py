@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import uuid
+import queue
+import bisect
+import threading
+import functools
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from utils.log import get_logger
+
+logger = get_logger("tracing")
+
+
+# 目前的追蹤 ID 與所在的 span；執行緒 / 協程各自獨立
+_current_trace = contextvars.ContextVar('trace_id', default=None)
+_current_span = contextvars.ContextVar('span', default=None)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace_id():
+    return _current_trace.get()
+
+
+class _StageMetrics:
+    """單一階段的延遲直方圖與最近樣本 (用於計算分位數)"""
+
+    def __init__(self, buckets, window):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds, error=False):
+        index = bisect.bisect_left(self.buckets, seconds)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.errors += int(error)
+        self.recent.append(seconds)
+
+    def quantile(self, q):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Tracer:
+    """輕量的逐階段延遲追蹤：span 寫入 JSON Lines，並彙整成 Prometheus 格式的直方圖與分位數
+
+    Args:
+        trace_file: span 輸出檔案，預設 data/traces/trace_<日期>.jsonl
+        enabled: 是否啟用 (TRACE_ENABLED)
+        window: 計算 p50/p95/p99 時保留的最近樣本數
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, trace_file=None, enabled=None, window=1024):
+        if enabled is None:
+            enabled = os.getenv('TRACE_ENABLED', '1') == '1'
+        self.enabled = enabled
+        self.trace_file = trace_file or os.getenv('TRACE_FILE') or os.path.join(
+            os.path.dirname(__file__), '../../data/traces',
+            f"trace_{datetime.now().strftime('%Y%m%d')}.jsonl")
+        self.window = window
+        self._stages = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+        # 由背景執行緒寫檔，避免 span 結束時在熱路徑上做磁碟 I/O
+        self._queue = queue.Queue()
+        self._writer = None
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(self.trace_file)), exist_ok=True)
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _write_loop(self):
+        with open(self.trace_file, 'a', encoding='utf-8') as f:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    return
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                if self._queue.empty():
+                    f.flush()
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    @contextmanager
+    def trace(self, trace_id=None):
+        """將區塊內 (同一執行緒) 的 span 歸屬到指定的追蹤 ID"""
+        token = _current_trace.set(trace_id or new_trace_id())
+        try:
+            yield _current_trace.get()
+        finally:
+            _current_trace.reset(token)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """量測區塊耗時並記錄為一個 span"""
+        if not self.enabled:
+            yield
+            return
+        parent_token = _current_span.set(name)
+        start_wall, start = time.time(), time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(parent_token)
+            parent = _current_span.get()
+            self.record(name, time.perf_counter() - start, start=start_wall, parent=parent,
+                        error=error, **attrs)
+
+    def record(self, name, seconds, start=None, parent=None, error=None, **attrs):
+        """記錄一個已量測好的 span (例如整輪延遲)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = _StageMetrics(self.BUCKETS, self.window)
+            stage.observe(seconds, error is not None)
+        record = {
+            'trace_id': _current_trace.get(),
+            'span': name,
+            'parent': parent,
+            'start': start if start is not None else time.time() - seconds,
+            'duration_ms': round(seconds * 1000, 3),
+            'thread': threading.current_thread().name
+        }
+        if error:
+            record['error'] = error
+        record.update(attrs)
+        self._queue.put(record)
+
+    def add_collector(self, fn):
+        """註冊額外指標來源：fn() 回傳 (名稱, 標籤字典, 數值) 的序列"""
+        self._collectors.append(fn)
+
+    def summary(self):
+        """各階段的次數、平均與 p50/p95/p99 (秒)"""
+        with self._lock:
+            return {
+                name: dict(
+                    count=stage.count,
+                    errors=stage.errors,
+                    avg=round(stage.total / stage.count, 4) if stage.count else 0.0,
+                    **{f"p{int(q * 100)}": round(stage.quantile(q), 4) for q in self.QUANTILES}
+                )
+                for name, stage in self._stages.items()
+            }
+
+    def prometheus(self):
+        """以 Prometheus 文字格式輸出所有指標"""
+        lines = [
+            "# HELP voice_stage_duration_seconds 各階段延遲",
+            "# TYPE voice_stage_duration_seconds histogram"
+        ]
+        quantile_lines = [
+            "# HELP voice_stage_duration_quantile_seconds 各階段最近樣本的延遲分位數",
+            "# TYPE voice_stage_duration_quantile_seconds summary"
+        ]
+        with self._lock:
+            for name, stage in sorted(self._stages.items()):
+                cumulative = 0
+                for le, count in zip(stage.buckets, stage.bucket_counts):
+                    cumulative += count
+                    lines.append(f'voice_stage_duration_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'voice_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {stage.count}')
+                lines.append(f'voice_stage_duration_seconds_sum{{stage="{name}"}} {stage.total:.6f}')
+                lines.append(f'voice_stage_duration_seconds_count{{stage="{name}"}} {stage.count}')
+                for q in self.QUANTILES:
+                    quantile_lines.append(
+                        f'voice_stage_duration_quantile_seconds{{stage="{name}",quantile="{q}"}} {stage.quantile(q):.6f}')
+        lines.extend(quantile_lines)
+
+        seen = set()
+        for collector in self._collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                logger.warning(f"指標收集失敗: {e}")
+                continue
+            for metric, labels, value in samples:
+                if metric not in seen:
+                    lines.append(f"# TYPE {metric} gauge")
+                    seen.add(metric)
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{metric}{{{label_text}}} {float(value)}" if label_text else f"{metric} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        """寫完佇列中的 span 後停止背景寫檔"""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join(timeout=2)
+            self._writer = None
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """取得程序內共用的 Tracer"""
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = Tracer()
+    return _tracer
+
+
+def traced(name=None):
+    """裝飾器：以共用 Tracer 記錄 span (呼叫時才取得 Tracer，不在匯入時建立)"""
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with get_tracer().span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_metrics_server(port=None, host='0.0.0.0', tracer=None):
+    """在背景執行緒提供 GET /metrics (Prometheus 文字格式)；未設定連接埠時不啟動"""
+    port = int(port or os.getenv('METRICS_PORT', 0))
+    if not port:
+        return None
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # 只有啟用指標端點時才需要
+    tracer = tracer or get_tracer()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = tracer.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Prometheus 指標位於 http://{host}:{port}/metrics")
+    return server
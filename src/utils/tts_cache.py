@@ -0,0 +1,137 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class TTSCache:
+    """語音合成結果的內容定址快取：以 (文字, 聲音, 語速, 格式) 的雜湊為鍵。
+
+    兩層：記憶體中保留最近使用的音訊 (熱層)，磁碟保存較大的 LRU；
+    兩層都以總位元組數為上限，超過時淘汰最久未使用的項目。
+    磁碟項目以檔案修改時間記錄最近使用順序，重新啟動後仍然有效。
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None, memory_bytes=None):
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(__file__), '../../data/tts_cache')
+        self.max_bytes = int(max_bytes or float(os.getenv('TTS_CACHE_MAX_MB', 200)) * 1024 * 1024)
+        self.memory_bytes = int(memory_bytes or float(os.getenv('TTS_CACHE_MEMORY_MB', 16)) * 1024 * 1024)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> bytes，越後面越新
+        self._memory_size = 0
+        self._disk = OrderedDict()  # key -> (檔案路徑, 位元組數)，越後面越新
+        self._disk_size = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self._scan()
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _scan(self):
+        """依修改時間 (最近使用時間) 載入磁碟上的快取索引"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                os.remove(path)  # 上次寫入到一半的檔案
+                continue
+            key, ext = os.path.splitext(name)
+            if len(key) != 64 or not ext:
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, key, path, stat.st_size))
+        for _, key, path, size in sorted(entries):
+            self._disk[key] = (path, size)
+            self._disk_size += size
+        self._evict_disk()
+
+    def _remember(self, key, data):
+        """放入記憶體熱層；單一項目超過熱層容量時不放入"""
+        if len(data) > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _evict_disk(self):
+        while self._disk_size > self.max_bytes and self._disk:
+            _, (path, size) = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # 播放中的檔案 (Windows) 或已被移除
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    @staticmethod
+    def key(text, voice, rate=1.0, audio_format='mp3', **extra):
+        """計算快取鍵；extra 可加入其他會影響音訊的參數 (例如引擎、語言)"""
+        material = json.dumps({'text': text, 'voice': voice, 'rate': float(rate), 'format': audio_format,
+                               **extra}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """回傳快取的音訊位元組，沒有時回傳 None"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return data
+            entry = self._disk.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._disk.move_to_end(key)
+        try:
+            with open(entry[0], 'rb') as f:
+                data = f.read()
+            os.utime(entry[0])  # 更新最近使用時間
+        except OSError:
+            with self._lock:
+                if self._disk.pop(key, None) is not None:
+                    self._disk_size -= entry[1]
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits_disk += 1
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data, audio_format='mp3'):
+        """保存音訊到記憶體與磁碟；回傳磁碟上的檔案路徑"""
+        path = os.path.join(self.cache_dir, f"{key}.{audio_format}")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._remember(key, data)
+            if key in self._disk:
+                self._disk_size -= self._disk.pop(key)[1]
+            self._disk[key] = (path, len(data))
+            self._disk_size += len(data)
+            self._evict_disk()
+        return path
+
+    def stats(self):
+        """命中次數與目前容量"""
+        with self._lock:
+            return {
+                'hits_memory': self.hits_memory,
+                'hits_disk': self.hits_disk,
+                'misses': self.misses,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_size,
+                'disk_entries': len(self._disk),
+                'disk_bytes': self._disk_size,
+            }
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
@@ -0,0 +1,410 @@
+import os
+import sys
+import json
+import time
+import uuid
+import wave
+import asyncio
+import threading
+from concurrent.futures import TimeoutError as FutureTimeout
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.pipeline import Pipeline, Stage
+from utils.tracing import get_tracer, new_trace_id
+from utils.log import get_logger
+
+logger = get_logger("pipeline")
+
+
+class Turn:
+    """一次語音互動在管線中傳遞的狀態"""
+
+    def __init__(self, seq, audio_file=None, trace_id=None):
+        self.seq = seq
+        self.turn_id = uuid.uuid4().hex[:12]
+        # 同一輪在各階段 (各執行緒) 產生的 span 都以此 ID 串起
+        self.trace_id = trace_id or new_trace_id()
+        self.audio_file = audio_file
+        self.speaker_id = None
+        self.similarity = 0.0
+        self.transcript = None
+        self.command_type = None
+        # AssistantResponse：處理結果直接交給語音輸出
+        self.response = None
+        self.skipped = False
+        # 因管線過載被卸載時的階段與策略，例如 "transcribe:drop_oldest"
+        self.shed = None
+        # 過載時併入此輪的其他語音 seq
+        self.merged_seqs = []
+        self.created_at = time.time()
+
+
+class VoiceAssistant:
+    """將錄音、語者辨識、語音轉文字、指令分類、處理與語音回應串成管線的各個階段"""
+
+    def __init__(self, recorder, transcriber, classifier, speaker, barge_in=None):
+        self.recorder = recorder
+        self.transcriber = transcriber
+        self.classifier = classifier
+        self.speaker = speaker
+        # 播放期間的插話偵測器 (BargeInDetector)；None 表示播放時暫停收音
+        self.barge_in = barge_in
+
+        # 確保共用同一個speaker_db文件路徑、資料庫物件與鎖 (語者辨識與背景保存對話都會修改資料庫)
+        self.classifier.speaker_data_file = self.recorder.speaker_data_file
+        self.classifier.speaker_db = self.recorder.speaker_db
+        self.classifier.db_lock = self.recorder.db_lock
+
+        self.tracer = get_tracer()
+        self.stop_event = threading.Event()
+        # 播放回應中；未啟用插話偵測時據此暫停收音，避免錄到自己的聲音
+        self.speaking = threading.Event()
+        # 回應與「忙碌」提示不同時播放
+        self._playback_lock = threading.Lock()
+        # 最後排入的語音回應 (Future)；播完時才結束「播放中」
+        self._playback = None
+        self._speaking_lock = threading.Lock()
+        self.pipeline = None
+        self._sink = None
+
+        # 過載時拒絕新語音的語音提示；間隔內只提示一次
+        self.busy_cue_text = os.getenv('BUSY_CUE_TEXT', "我現在有點忙，請稍後再說一次。")
+        self.busy_cue_interval = float(os.getenv('BUSY_CUE_INTERVAL', 5))
+        self._last_busy_cue = 0.0
+
+    # ╭─────────────────────────────── 管線階段 ─────────────────────────────╮
+    def capture(self):
+        """來源：持續等待語音並錄音，每段錄音產生一個 Turn"""
+        seq = 0
+        while not self.stop_event.is_set():
+            trace_id = new_trace_id()
+            with self.tracer.trace(trace_id):
+                if self.speaking.is_set():
+                    # 全雙工：播放中偵測到插話時立即停止播放並錄下這句
+                    if self.barge_in is None or not self.barge_in.listen(self.speaking, self.stop_event):
+                        time.sleep(0.05)
+                        continue
+                else:
+                    # 等待期間開始播放時返回，改由上方的插話偵測 (或暫停收音) 接手
+                    if not self.recorder.wait_for_speech(self.stop_event, paused=self.speaking):
+                        if self.stop_event.is_set():
+                            break
+                        continue
+                    if self.speaking.is_set():
+                        continue  # 偵測到的可能是剛開始播放的回應
+                audio_file = self.recorder.capture()
+            yield Turn(seq, audio_file, trace_id=trace_id)
+            seq += 1
+
+    def identify(self, turn, embed=None):
+        """語者辨識 (會修改語者資料庫，須單一工作者)
+
+        Args:
+            embed: 已在其他程序算好的語者嵌入；None 時從錄音提取
+        """
+        if embed is None:
+            turn.speaker_id, turn.similarity = self.recorder.identify_speaker(turn.audio_file)
+        else:
+            turn.speaker_id, turn.similarity = self.recorder.identify_embedding(embed)
+
+        # 將recorder的speaker_db同步到classifier
+        self.classifier.speaker_db = self.recorder.speaker_db
+
+        # 顯示識別結果和相似度
+        if turn.similarity < self.recorder.similarity_threshold:
+            logger.info(f"⚠️ 相似度低於閾值 ({turn.similarity:.2f} < {self.recorder.similarity_threshold})，"
+                        f"已自動註冊為新用戶: {turn.speaker_id}")
+        else:
+            logger.info(f"🎤 已識別為已知說話者: {turn.speaker_id} (相似度 {turn.similarity:.2f})")
+        return turn
+
+    def transcribe(self, turn):
+        """轉換為文字；沒有辨識結果時略過後續階段"""
+        turn.transcript = self.transcriber.transcribe_file(turn.audio_file)
+        if not turn.transcript:
+            turn.skipped = True
+            return turn
+        logger.info(f"識別結果: {turn.transcript}")
+        return turn
+
+    def classify(self, turn):
+        """分類命令"""
+        turn.command_type = self.classifier.classify_command(turn.transcript)
+        logger.info(f"命令類型: {turn.command_type}")
+        return turn
+
+    def handle(self, turn):
+        """根據命令類型處理，並傳入語者ID以使用對話歷史；歷史記錄在背景保存"""
+        turn.response = self.classifier.respond(turn.transcript, turn.command_type, turn.speaker_id)
+        if turn.response is None:
+            return turn
+        if turn.response.is_movement:
+            logger.info(f"行動計劃：\n{json.dumps(turn.response.content, ensure_ascii=False, indent=2)}")
+        elif turn.command_type == '查詢':
+            logger.info(f"查詢結果：\n{turn.response.content}")
+        else:
+            logger.info(f"聊天回應：\n{turn.response.content}")
+        return turn
+
+    def speak(self, turn):
+        """合成並排入語音回應；不等播完，播放期間管線繼續處理 (含預先合成) 下一輪"""
+        if turn.response is not None:
+            logger.debug("正在生成語音回應...")
+            with self._playback_lock:
+                with self._speaking_lock:
+                    self._playback = None
+                    self.speaking.set()
+                try:
+                    playback = self.speaker.speak_response(turn.response, wait=False)
+                except Exception:
+                    self.speaking.clear()
+                    raise
+                with self._speaking_lock:
+                    self._playback = playback
+            playback.add_done_callback(self._on_playback_done)
+        return turn
+    # ╰─────────────────────────────── 管線階段 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _traced(self, fn, last=False):
+        """在該輪的追蹤 ID 下執行階段函式；最後一個階段另記錄整輪延遲"""
+        def wrapper(turn):
+            with self.tracer.trace(turn.trace_id):
+                result = fn(turn)
+                if last and not turn.skipped:
+                    self.tracer.record('turn', time.time() - turn.created_at, start=turn.created_at)
+                return result
+        return wrapper
+
+    def _coalesce(self, queued, turn):
+        """過載時將同一說話者連續的語音併入排隊中的那一輪：已轉文字時合併文字，否則合併錄音
+
+        轉錄有多個工作者，較晚的語音可能先排入下一個佇列；合併時依 seq 排列先後。
+        """
+        if queued.skipped or turn.skipped or queued.speaker_id is None or queued.speaker_id != turn.speaker_id:
+            return False
+        if queued.command_type is not None or turn.command_type is not None:
+            return False  # 已分類的命令不能再改內容
+        first, second = (turn, queued) if turn.seq < queued.seq else (queued, turn)
+        if queued.transcript is not None and turn.transcript is not None:
+            queued.transcript = f"{first.transcript}，{second.transcript}"
+        elif queued.transcript is None and turn.transcript is None:
+            merged = self._concat_audio(first, second, f"coalesced_{queued.turn_id}_{turn.seq}.wav")
+            if merged is None:
+                return False
+            queued.audio_file = merged
+        else:
+            return False
+        queued.merged_seqs.append(turn.seq)
+        return True
+
+    def _concat_audio(self, first_turn, second_turn, filename):
+        """將兩段錄音依序接成一個 WAV 檔；格式不同時回傳 None"""
+        try:
+            with wave.open(first_turn.audio_file, 'rb') as first, wave.open(second_turn.audio_file, 'rb') as second:
+                if first.getparams()[:3] != second.getparams()[:3]:
+                    return None
+                params = first.getparams()
+                frames = first.readframes(first.getnframes()) + second.readframes(second.getnframes())
+            merged = os.path.join(self.recorder.audio_dir, filename)
+            with wave.open(merged, 'wb') as out:
+                out.setparams(params)
+                out.writeframes(frames)
+            return merged
+        except (OSError, wave.Error) as e:
+            logger.warning(f"合併錄音失敗: {e}")
+            return None
+
+    def _on_playback_done(self, playback):
+        """回應播完或被中斷時 (由音訊執行緒呼叫)；之後沒有再排入回應才結束「播放中」"""
+        with self._speaking_lock:
+            if self._playback is playback:
+                self.speaking.clear()
+
+    def _on_shed(self, stage, turn, reason):
+        """被卸載的一輪仍寫入結果輸出；拒絕時以語音提示使用者"""
+        turn.shed = f"{stage.name}:{reason}"
+        if self._sink is not None:
+            self._sink.write(turn)
+        if reason == 'reject':
+            self._busy_cue()
+
+    def _busy_cue(self):
+        """在背景播放「忙碌」提示；正在播放或距上次提示太近時略過"""
+        now = time.time()
+        if self.speaker is None or self.speaking.is_set() or now - self._last_busy_cue < self.busy_cue_interval:
+            return
+        self._last_busy_cue = now
+
+        def play():
+            if not self._playback_lock.acquire(blocking=False):
+                return
+            try:
+                self.speaking.set()
+                # 提示語固定，第一次之後都由語音快取直接播放
+                self.speaker.speak_text(self.busy_cue_text)
+            except Exception as e:
+                logger.warning(f"播放忙碌提示失敗: {e}")
+            finally:
+                self.speaking.clear()
+                self._playback_lock.release()
+        threading.Thread(target=play, name="busy-cue", daemon=True).start()
+
+    def _collect_metrics(self):
+        """提供給 Prometheus 端點的管線佇列、卸載、計劃驗證、語音快取、上傳量、轉錄快取與語音轉文字後端指標"""
+        if self.pipeline is not None:
+            for name, stats in self.pipeline.stats().items():
+                labels = {'stage': name}
+                yield 'voice_pipeline_queue_depth', labels, stats['queue_depth']
+                yield 'voice_pipeline_queue_capacity', labels, stats['queue_size']
+                yield 'voice_pipeline_processed_total', labels, stats['processed']
+                yield 'voice_pipeline_failed_total', labels, stats['failed']
+                for reason, count in stats['shed'].items():
+                    yield 'voice_pipeline_shed_total', {'stage': name, 'reason': reason}, count
+        validator = getattr(self.classifier, 'plan_validator', None)
+        if validator is not None:
+            for name, value in validator.metrics().items():
+                yield f'voice_plan_{name}', {}, value
+        tts_cache = getattr(self.speaker, 'tts_cache', None)
+        if tts_cache is not None:
+            for name, value in tts_cache.stats().items():
+                yield f'voice_tts_cache_{name}', {}, value
+        upload = getattr(self.transcriber, 'upload', None)
+        if upload is not None:
+            for name, value in upload.stats().items():
+                yield f'voice_stt_upload_{name}', {}, value
+        transcript_cache = getattr(self.transcriber, 'transcript_cache', None)
+        if transcript_cache is not None:
+            for name, value in transcript_cache.stats().items():
+                yield f'voice_stt_cache_{name}', {}, value
+        router = getattr(self.transcriber, 'router', None)
+        if router is not None:
+            for backend, stats in router.stats().items():
+                for name, value in stats.items():
+                    yield f'voice_stt_backend_{name}', {'backend': backend}, value
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    def replay(self, audio_files):
+        """將錄音檔來源 (例如 WavDirectorySource) 轉為 Turn 來源"""
+        for seq, audio_file in enumerate(audio_files):
+            if self.stop_event.is_set():
+                break
+            yield Turn(seq, audio_file)
+
+    def build_pipeline(self, stt_workers=None, handler_workers=None, queue_size=None, speak=True, sink=None,
+                       overflow=None):
+        """建立管線；語者辨識、處理與播放維持單一工作者以保持資料庫與回應順序一致
+
+        Args:
+            speak: 是否播放語音回應 (無音訊輸出的伺服器可關閉)
+            sink: 結果輸出 (例如 JsonlSink)，會收到每一輪 (含被略過與被卸載的) 結果
+            overflow: 語者辨識到處理各階段佇列已滿時的策略 (PIPELINE_OVERFLOW，預設 block)；
+                個別階段可用 PIPELINE_OVERFLOW_<階段名稱> 覆寫。coalesce 只適用於
+                transcribe 與 classify，其他階段無法合併時等待。播放與結果輸出一律等待。
+        """
+        stt_workers = int(stt_workers or os.getenv('PIPELINE_STT_WORKERS', 2))
+        handler_workers = int(handler_workers or os.getenv('PIPELINE_HANDLER_WORKERS', 1))
+        queue_size = int(queue_size or os.getenv('PIPELINE_QUEUE_SIZE', 2))
+        overflow = overflow or os.getenv('PIPELINE_OVERFLOW', 'block')
+
+        def policy(name):
+            return os.getenv(f'PIPELINE_OVERFLOW_{name.upper()}', overflow)
+
+        stages = [
+            Stage('identify', self.identify, workers=1, queue_size=queue_size, ordered=True,
+                  overflow=policy('identify')),
+            Stage('transcribe', self.transcribe, workers=stt_workers, queue_size=queue_size,
+                  overflow=policy('transcribe'), coalesce=self._coalesce),
+            Stage('classify', self.classify, workers=stt_workers, queue_size=queue_size,
+                  overflow=policy('classify'), coalesce=self._coalesce),
+            Stage('handle', self.handle, workers=handler_workers, queue_size=queue_size,
+                  ordered=handler_workers == 1, overflow=policy('handle')),
+        ]
+        if speak:
+            stages.append(Stage('speak', self.speak, workers=1, queue_size=queue_size, ordered=True))
+        if sink is not None:
+            stages.append(Stage('sink', sink.write, workers=1, queue_size=queue_size, include_skipped=True))
+        for stage in stages:
+            stage.fn = self._traced(stage.fn, last=stage is stages[-1])
+        self._sink = sink
+        self.pipeline = Pipeline(stages, on_shed=self._on_shed)
+        return self.pipeline
+
+    async def run(self, source=None):
+        """以管線模式持續運作，直到來源結束或呼叫 stop()"""
+        pipeline = self.pipeline or self.build_pipeline()
+        try:
+            await pipeline.run(source if source is not None else self.capture())
+            # 最後一則回應可能還在播放
+            if self._playback is not None:
+                await asyncio.wrap_future(self._playback)
+        except asyncio.CancelledError:
+            if self.speaker is not None:
+                self.speaker.stop_playback()
+            raise
+
+    def run_turn(self):
+        """相容模式：依序完成一輪錄音到語音回應"""
+        trace_id = new_trace_id()
+        with self.tracer.trace(trace_id):
+            if not self.recorder.wait_for_speech(self.stop_event):
+                return None
+            turn = Turn(0, self.recorder.capture(), trace_id=trace_id)
+            for step in (self.identify, self.transcribe, self.classify, self.handle, self.speak):
+                if turn.skipped:
+                    break
+                step(turn)
+            if not turn.skipped:
+                self.tracer.record('turn', time.time() - turn.created_at, start=turn.created_at)
+        # 播完才開始下一輪收音，避免錄到自己的聲音
+        self.wait_playback()
+        return turn
+
+    def register_metrics(self):
+        """將管線與計劃驗證指標加入 Prometheus 輸出"""
+        self.tracer.add_collector(self._collect_metrics)
+
+    def warm_up(self, encoder=True):
+        """啟動後在背景載入延後的資源 (聲紋模型、後端客戶端與本機語音模型)，等待第一句話時順便完成
+
+        Args:
+            encoder: 是否載入聲紋模型 (嵌入改在其他程序計算時不需要)
+        """
+        def load():
+            try:
+                if encoder:
+                    self.recorder.encoder
+                clients = [backend.client for backend in getattr(self.transcriber, 'backends', [])]
+                for owner, attr in ((self.classifier, 'model_client'), (self.classifier, 'search_client'),
+                                    (self.speaker, 'tts_client')):
+                    clients.append(getattr(owner, attr, None))
+                for client in clients:
+                    if client is not None:
+                        client.raw
+            except Exception as e:
+                logger.warning(f"預先載入資源失敗，改於第一次使用時載入: {e}")
+        threading.Thread(target=load, name="warm-up", daemon=True).start()
+
+    def wait_playback(self, timeout=None):
+        """等待已排入的語音回應播完或被中斷；回傳是否已結束"""
+        playback = self._playback
+        if playback is None:
+            return True
+        try:
+            playback.result(timeout)
+        except FutureTimeout:
+            return False
+        return True
+
+    def stop(self):
+        """停止收音，管線中的語音會處理完畢"""
+        self.stop_event.set()
+        if self.pipeline is not None:
+            self.pipeline.stop()
+
+    def close(self):
+        """結束前寫完背景中的歷史記錄與追蹤 span (寫檔執行緒為 daemon，程序結束時不會自行寫完)"""
+        self.classifier.close()
+        self.tracer.close()
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
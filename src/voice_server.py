@@ -0,0 +1,325 @@
+import os
+import sys
+import json
+import time
+import uuid
+import wave
+import asyncio
+import argparse
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from aiohttp import web, WSMsgType
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from utils.voice_pipeline import Turn
+from batch_audio import init_embed_worker, embed_file
+from utils.log import get_logger
+
+logger = get_logger("server")
+
+
+class Session:
+    """單一客戶端 (機器人 / 服務機) 的連線狀態"""
+
+    def __init__(self, client_name=None):
+        self.session_id = uuid.uuid4().hex
+        self.client_name = client_name
+        self.created_at = time.time()
+        self.last_active = self.created_at
+        self.turn_count = 0
+        self.last_speaker_id = None
+        # 同一個 session 的語句依序處理，不同 session 之間並行
+        self.lock = asyncio.Lock()
+
+    def to_dict(self):
+        return {
+            'session_id': self.session_id,
+            'client_name': self.client_name,
+            'created_at': datetime.fromtimestamp(self.created_at).isoformat(),
+            'turn_count': self.turn_count,
+            'last_speaker_id': self.last_speaker_id
+        }
+
+
+class VoiceServer:
+    """HTTP + WebSocket 語音服務：只載入一次共用資源 (語者資料庫、快取、AWS 客戶端)，所有 session 共用
+
+    CPU 密集的語者嵌入交給工作程序池計算，session 與語者資料庫仍只存在主程序中。
+    """
+
+    def __init__(self, assistant, max_concurrent_turns=None, session_ttl=None, embed_processes=None):
+        self.assistant = assistant
+        self.sample_rate = assistant.recorder.sample_rate
+        self.channels = assistant.recorder.channels
+        self.audio_dir = os.path.join(os.path.dirname(__file__), '../data/audio/sessions')
+        os.makedirs(self.audio_dir, exist_ok=True)
+
+        self.max_concurrent_turns = int(max_concurrent_turns or os.getenv('SERVER_MAX_TURNS', 8))
+        self.session_ttl = float(session_ttl or os.getenv('SERVER_SESSION_TTL', 30 * 60))
+        self.sessions = {}
+        self.embed_processes = int(embed_processes or os.getenv('SERVER_EMBED_PROCESSES', os.cpu_count() or 2))
+        self._turn_slots = None
+        self._embed_pool = None
+        self.stats = {'turns': 0, 'failed': 0, 'sessions_created': 0}
+        self.assistant.register_metrics()
+
+    # ╭─────────────────────────────── 私有方法 ─────────────────────────────╮
+    def _audio_path(self, session):
+        """每段語音各自的檔名；同一 session 並行上傳的語句不會寫到同一個檔案"""
+        return os.path.join(self.audio_dir, f"{session.session_id[:8]}_{uuid.uuid4().hex[:12]}.wav")
+
+    def _save_wav(self, session, pcm):
+        path = self._audio_path(session)
+        with wave.open(path, "wb") as wf:
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(2)  # int16 -> 2 bytes
+            wf.setframerate(self.sample_rate)
+            wf.writeframes(pcm)
+        return path
+
+    async def _embed(self, turn):
+        """在工作程序中提取語者嵌入，不佔用主程序的 CPU 與語者資料庫鎖"""
+        import numpy as np
+
+        embed, seconds = await asyncio.wrap_future(self._embed_pool.submit(embed_file, turn.audio_file))
+        with self.assistant.tracer.trace(turn.trace_id):
+            self.assistant.tracer.record('extract_embedding', seconds, error='EmbedError' if embed is None else None)
+        return np.array(embed) if embed is not None else None
+
+    def _run_turn(self, turn, embed):
+        """在執行緒中依序執行辨識、轉文字、分類與處理
+
+        比對與註冊語者由 identify_embedding 在資料庫鎖內完成
+        """
+        tracer = self.assistant.tracer
+        with tracer.trace(turn.trace_id):
+            if embed is None:
+                # 嵌入失敗 (例如無法讀取的音檔)：與本機辨識相同，視為未知語者
+                turn.speaker_id, turn.similarity = self.assistant.recorder.identify_embedding(None)
+            else:
+                self.assistant.identify(turn, embed)
+            for step in (self.assistant.transcribe, self.assistant.classify, self.assistant.handle):
+                if turn.skipped:
+                    break
+                step(turn)
+            if not turn.skipped:
+                tracer.record('turn', time.time() - turn.created_at, start=turn.created_at)
+        return turn
+
+    async def _process(self, session, audio_file):
+        """處理一段語音並回傳結果字典"""
+        async with session.lock:
+            turn = Turn(session.turn_count, audio_file)
+            session.turn_count += 1
+            session.last_active = time.time()
+            loop = asyncio.get_running_loop()
+            async with self._turn_slots:
+                try:
+                    embed = await self._embed(turn)
+                    await loop.run_in_executor(None, self._run_turn, turn, embed)
+                    self.stats['turns'] += 1
+                except Exception as e:
+                    self.stats['failed'] += 1
+                    logger.error(f"session {session.session_id[:8]} 處理失敗: {e}")
+                    turn.skipped = True
+            session.last_speaker_id = turn.speaker_id or session.last_speaker_id
+            return {
+                'turn_id': turn.turn_id,
+                'trace_id': turn.trace_id,
+                'seq': turn.seq,
+                'speaker_id': turn.speaker_id,
+                'similarity': float(turn.similarity),
+                'transcript': turn.transcript,
+                'command_type': turn.command_type,
+                'response': turn.response.content if turn.response is not None else None,
+                'skipped': turn.skipped,
+                'latency_s': round(time.time() - turn.created_at, 3)
+            }
+
+    def _get_session(self, request):
+        session = self.sessions.get(request.match_info['session_id'])
+        if session is None:
+            raise web.HTTPNotFound(text=json.dumps({'error': 'session 不存在'}), content_type='application/json')
+        return session
+
+    async def _expire_sessions(self):
+        """定期清除閒置過久的 session"""
+        while True:
+            await asyncio.sleep(60)
+            now = time.time()
+            for session_id, session in list(self.sessions.items()):
+                if now - session.last_active > self.session_ttl and not session.lock.locked():
+                    del self.sessions[session_id]
+    # ╰─────────────────────────────── 私有方法 ─────────────────────────────╯
+
+    # ╭─────────────────────────────── HTTP / WebSocket ─────────────────────╮
+    async def create_session(self, request):
+        """POST /sessions {"client_name": "..."}"""
+        try:
+            body = await request.json() if request.can_read_body else {}
+        except json.JSONDecodeError:
+            body = None
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text=json.dumps({'error': '請求內容須為 JSON 物件'}),
+                                     content_type='application/json')
+        session = Session(body.get('client_name'))
+        self.sessions[session.session_id] = session
+        self.stats['sessions_created'] += 1
+        return web.json_response(session.to_dict(), status=201)
+
+    async def get_session(self, request):
+        """GET /sessions/{session_id}"""
+        return web.json_response(self._get_session(request).to_dict())
+
+    async def delete_session(self, request):
+        """DELETE /sessions/{session_id}"""
+        session = self._get_session(request)
+        self.sessions.pop(session.session_id, None)
+        return web.json_response({'deleted': session.session_id})
+
+    async def post_utterance(self, request):
+        """POST /sessions/{session_id}/utterances，內容為 audio/wav 或原始 16-bit PCM"""
+        session = self._get_session(request)
+        data = await request.read()
+        if request.content_type in ('audio/wav', 'audio/x-wav', 'audio/wave'):
+            path = self._audio_path(session)
+            with open(path, 'wb') as f:
+                f.write(data)
+        else:
+            path = self._save_wav(session, data)
+        return web.json_response(await self._process(session, path))
+
+    async def stream(self, request):
+        """GET /sessions/{session_id}/stream (WebSocket)
+
+        客戶端傳送二進位 PCM 區塊，傳送 {"type": "end"} 表示一句結束；
+        伺服器處理完成後回傳 {"type": "result", ...}。
+        """
+        session = self._get_session(request)
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        buffer = bytearray()
+        pending = set()
+
+        async def process_and_reply(pcm):
+            path = self._save_wav(session, pcm)
+            result = await self._process(session, path)
+            if not ws.closed:
+                await ws.send_json(dict(result, type='result'))
+
+        async for message in ws:
+            if message.type == WSMsgType.BINARY:
+                buffer.extend(message.data)
+            elif message.type == WSMsgType.TEXT:
+                try:
+                    command = json.loads(message.data)
+                except json.JSONDecodeError:
+                    await ws.send_json({'type': 'error', 'error': '無效的訊息格式'})
+                    continue
+                if command.get('type') == 'end' and buffer:
+                    # 處理期間仍可繼續接收下一句
+                    task = asyncio.ensure_future(process_and_reply(bytes(buffer)))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                    buffer = bytearray()
+                elif command.get('type') == 'close':
+                    break
+            elif message.type == WSMsgType.ERROR:
+                logger.warning(f"WebSocket 錯誤: {ws.exception()}")
+
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        await ws.close()
+        return ws
+
+    async def health(self, request):
+        """GET /healthz"""
+        return web.json_response({'status': 'ok', 'pid': os.getpid()})
+
+    async def get_stats(self, request):
+        """GET /stats"""
+        return web.json_response(dict(self.stats, active_sessions=len(self.sessions), pid=os.getpid(),
+                                      latency=self.assistant.tracer.summary()))
+
+    async def metrics(self, request):
+        """GET /metrics (Prometheus 文字格式)"""
+        return web.Response(text=self.assistant.tracer.prometheus(), content_type='text/plain',
+                            charset='utf-8')
+    # ╰─────────────────────────────── HTTP / WebSocket ─────────────────────╯
+
+    # ╭─────────────────────────────── Public API ───────────────────────────╮
+    def create_app(self):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post('/sessions', self.create_session)
+        app.router.add_get('/sessions/{session_id}', self.get_session)
+        app.router.add_delete('/sessions/{session_id}', self.delete_session)
+        app.router.add_post('/sessions/{session_id}/utterances', self.post_utterance)
+        app.router.add_get('/sessions/{session_id}/stream', self.stream)
+        app.router.add_get('/healthz', self.health)
+        app.router.add_get('/stats', self.get_stats)
+        app.router.add_get('/metrics', self.metrics)
+
+        async def on_startup(app):
+            self._turn_slots = asyncio.Semaphore(self.max_concurrent_turns)
+            # spawn：主程序已有背景執行緒 (寫檔、預先載入)，fork 可能複製到持有中的鎖
+            self._embed_pool = ProcessPoolExecutor(max_workers=self.embed_processes,
+                                                   mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=init_embed_worker)
+            app['expire_task'] = asyncio.ensure_future(self._expire_sessions())
+
+        async def on_cleanup(app):
+            app['expire_task'].cancel()
+            self._embed_pool.shutdown(wait=True)
+            self.assistant.close()
+
+        app.on_startup.append(on_startup)
+        app.on_cleanup.append(on_cleanup)
+        return app
+    # ╰─────────────────────────────── Public API ───────────────────────────╯
+
+
+def create_server_assistant():
+    """建立伺服器用的共用資源：不需要麥克風或本地播放"""
+    from audio.recorder import AudioRecorder
+    from audio.speech_to_text_test import SpeechToText
+    from utils.command_classifier_claude import CommandClassifier
+    from utils.voice_pipeline import VoiceAssistant
+
+    return VoiceAssistant(AudioRecorder(), SpeechToText(), CommandClassifier(), speaker=None)
+
+
+def serve(host, port, max_concurrent_turns=None, embed_processes=None):
+    """載入一次共用資源後提供服務
+
+    session、語者資料庫與各種快取都只存在這個程序中，所有連線共用；
+    並行處理的語句數由 max_concurrent_turns (SERVER_MAX_TURNS) 控制，在執行緒中進行；
+    語者嵌入由 embed_processes (SERVER_EMBED_PROCESSES) 個工作程序計算，可用滿多個 CPU 核心。
+    """
+    assistant = create_server_assistant()
+    # 後端客戶端在背景預先載入，不延後開始監聽；聲紋模型只在工作程序中載入
+    assistant.warm_up(encoder=False)
+    server = VoiceServer(assistant, max_concurrent_turns=max_concurrent_turns, embed_processes=embed_processes)
+    logger.info(f"語音服務 {os.getpid()} 監聽於 {host}:{port}")
+    web.run_app(server.create_app(), host=host, port=port, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多連線語音服務 (HTTP + WebSocket)")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-turns', type=int, default=None,
+                        help="同時處理的語句數上限 (預設 SERVER_MAX_TURNS 或 8)")
+    parser.add_argument('--embed-processes', type=int, default=None,
+                        help="計算語者嵌入的工作程序數 (預設 SERVER_EMBED_PROCESSES 或 CPU 核心數)")
+    args = parser.parse_args()
+
+    try:
+        serve(args.host, args.port, args.max_turns, args.embed_processes)
+    except KeyboardInterrupt:
+        print("\n服務已終止")
+
+
+if __name__ == "__main__":
+    main()